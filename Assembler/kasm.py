@@ -2,35 +2,23 @@
 #     WM-6 AdvCompArch
 
  
+import argparse
+import glob
+import hashlib
+import json
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+
+# Bumped whenever a change to the assembler changes its output, so old cached builds aren't reused
+assembler_version = 2
 
 # Memory sizes
 instruction_memory_size = 2048
 data_memory_size = 1024
 
-# Global variables
-line = ""
-linenumber = 0
-mode = 0
-filename = ""
-
-# Keeps track of if a memory location is assigned to something
-instruction_memory = [False] * instruction_memory_size
-data_memory = [False] * data_memory_size
-
-# Stores the instructions before they are written to the output file,
-# this is needed because in the first pass through the file, because subprocesses can be anywhere in the file.
-# Their tokens, when used, are written as text into the binary, for example JMP Finish, would store as
-# 0000Finish in the memory lines array. Once the file is fully scanned once, it goes through these memory lines
-# and replaces all the tokens with their actual values. If the token doesn't exist, it throws an error
-memory_lines = []
-
-# Keeps track of user-made subprocess names
-subprocess_names = {}
-
-# Variable names
-user_defined_tokens = {}
-
 # Dictionary of all the K86 instruction codes
 k86_tokens = {
     "JMP": "0001",
@@ -111,419 +99,1250 @@ registers = {
 
 }
 
+# The same tables as integers, used by the encoders. Each opcode is stored already shifted into the top
+# bits of the word, so an instruction is built by OR-ing its operand fields into the opcode
+opcodes = {name: int(bits, 2) << (16 - len(bits)) for name, bits in k86_tokens.items()}
+register_numbers = {name: int(bits, 2) for name, bits in registers.items()}
 
-def run():
-    global line
-    global filename
-    global linenumber
-    global mode
-    with open(filename, "r") as reader:
-        for line in reader:
-            linenumber += 1
-            line = line.strip()  # Removes whitespace surrounding line
-            temp = line.split("#")  # makes '#' into the comment character
-            tempstr = temp[0]
-            lineargs = tempstr.split()
-            if len(lineargs) > 0:  # this if statement just makes sure to skip all empty lines
-
-                # parse statement can do multiple things depending on if it's in the .data or
-                # .code section, so this changes it if a new section appears, otherwise parses the line
-                if lineargs[0] == ".data":
-                    mode = 1
-                elif lineargs[0] == ".code":
-                    mode = 2
-                else:
-                    parse(lineargs)
-
-    # After the file is fully scanned, this replaces any subprocess and variable names that were defined,
-    # then writes it to the file
-    index = 0
-    for line in memory_lines:
-        if not isdigit(line[4:]):
-            if line[4:] in subprocess_names:
-                memory_lines[index] = line[0:4] + subprocess_names[line[4:]]
-            elif line[4:] in user_defined_tokens:
-                memory_lines[index] = line[0:4] + user_defined_tokens[line[4:]]
+# Identifies the instruction set and assembler that produced an image, part of every build cache key
+isa_version = hashlib.sha256(repr((assembler_version, k86_tokens, registers,
+                                   instruction_memory_size, data_memory_size)).encode()).hexdigest()
+
+# Version of the object file layout written by assemble_object()
+object_version = 2
+
+# Field masks for the parts of a word a symbol can be patched into
+ADDRESS_FIELD = 0x0FFF
+HALT_WORD = opcodes["HALT"]
+
+
+
+# Raised for any error in the program being assembled. The message is the same text that used to
+# be printed when the assembler exited, and linenumber is the source line it happened on (if known)
+class KasmError(Exception):
+    def __init__(self, message, linenumber=None):
+        super().__init__(message)
+        self.message = message
+        self.linenumber = linenumber
+
+
+# Holds all the state for assembling one program, so any number of programs can be
+# assembled in the same process without interfering with each other
+class Assembler:
+    def __init__(self, instruction_memory_size=instruction_memory_size, data_memory_size=data_memory_size,
+                 optimize=False, data_image=False):
+        self.instruction_memory_size = instruction_memory_size
+        self.data_memory_size = data_memory_size
+        self.optimize = optimize
+        self.data_image = data_image
+        self.reset()
+
+    # Clears everything from the last program
+    def reset(self):
+        self.line = ""
+        self.statement = ""  # the current line without its comment
+        self.linenumber = 0
+        self.mode = 0
+
+        # Location counters for each memory. Memory is handed out in order, so the next free
+        # address is always the counter itself and allocating never has to scan for a free slot
+        self.next_instr_addr = 0
+        self.next_data_addr = 0
+
+        # Stores the machine words before they are returned
+        self.words = array('H')
+
+        # Starting contents of data memory when the .data section is preloaded instead of set up by code
+        self.data = array('H')
+
+        # The source line every word came from, indexed by address, so a listing or a debugger can go from an
+        # address straight to its line. 0 means the word isn't from any line, like the HALT added at the end
+        self.word_lines = array('I')
+        self.data_lines = array('I')
+
+        # Subprocesses can be anywhere in the file, so a word that uses a name can't always be finished on the
+        # first pass. Those words are stored with the name's field left as zero, and a relocation of
+        # (word index, name, field mask, line number) is recorded. Once the file is fully scanned, every
+        # relocation is patched with the name's address. If the name doesn't exist, it throws an error
+        self.relocations = []
+
+        # Keeps track of user-made subprocess names
+        self.subprocess_names = {}
+
+        # Variable names
+        self.user_defined_tokens = {}
+
+        # Names this module shares with others (.global) and uses from others (.extern), for object files
+        self.global_names = {}  # name -> line number it was declared on
+        self.extern_names = set()
+
+        # Set by the optimizer, which decides for itself whether the program needs a HALT at the end
+        self.halt_added = False
+
+        # Set when a HALT instruction is made. A second word that happens to be 0xFFFF doesn't count
+        self.has_halt = False
+
+        # Set by .nohalt, for programs that must not get a HALT at the end, like the ones kdis.py writes for
+        # images that don't have one
+        self.no_halt = False
+
+    # Assembles the KASM source text and returns the program as a list of 16-bit machine words.
+    # Nothing is read from or written to disk, errors are raised as KasmError
+    def assemble(self, text):
+        self.reset()
+        for line in text.splitlines():
+            self.read_line(line)
+        if self.optimize:
+            self.run_optimizer()
+        self.resolve()
+        return self.words
+
+    # Runs the -O pass from kopt.py, roots are labels that other modules can jump to
+    def run_optimizer(self, roots=()):
+        import kopt
+        kopt.optimize(self, roots)
+
+    # Processes one line of source
+    def read_line(self, line):
+        self.handle_line(self.split_line(line))
+
+    # Splits one line of source into its tokens
+    def split_line(self, line):
+        self.linenumber += 1
+        self.line = line.strip()  # Removes whitespace surrounding line
+        tempstr = strip_comment(self.line)  # makes '#' into the comment character
+        self.statement = tempstr
+        return tokenize(tempstr)
+
+    # Handles the tokens of one line
+    def handle_line(self, lineargs):
+        if len(lineargs) > 0:  # this if statement just makes sure to skip all empty lines
+
+            # parse statement can do multiple things depending on if it's in the .data or
+            # .code section, so this changes it if a new section appears, otherwise parses the line
+            if lineargs[0] == ".data":
+                self.mode = 1
+            elif lineargs[0] == ".code":
+                self.mode = 2
+            elif lineargs[0] == ".global":
+                for name in lineargs[1:]:
+                    self.global_names.setdefault(name, self.linenumber)
+            elif lineargs[0] == ".extern":
+                self.extern_names.update(lineargs[1:])
+            elif lineargs[0] == ".word":
+                self.raw_words(lineargs[1:])
+            elif lineargs[0] == ".nohalt":
+                if len(lineargs) > 1:
+                    self.fail(f"Error at line {self.linenumber}: Invalid instruction syntax.")
+                self.no_halt = True
             else:
-                sys.exit(f"Undefined token at line {linenumber}")
-        index += 1
-    fileparts = filename.split('.')
-    filename =fileparts[0]
-    file = open(f"{filename}.bin", "w")
-    for i in memory_lines:
-        file.write(i + "\n")
+                self.parse(lineargs)
+
+    # Assembles one module of a program into an object for klink.py, a dictionary that can be saved as JSON.
+    # Nothing is resolved: every use of a name stays a relocation, and labels and variables are listed as
+    # symbols relative to the start of the module's code or data. The .data section always goes in the
+    # object's data image, since the linker decides where it ends up
+    def assemble_object(self, text, source_name=""):
+        self.reset()
+        self.data_image = True
+        for line in text.splitlines():
+            self.read_line(line)
+        symbols = {}
+        for name, address in self.subprocess_names.items():
+            symbols[name] = ["code", address, name in self.global_names]
+        for name, address in self.user_defined_tokens.items():
+            symbols[name] = ["data", address - self.instruction_memory_size, name in self.global_names]
+        for name, linenumber in self.global_names.items():
+            if name not in symbols:
+                raise KasmError(f"Undefined global token at line {linenumber}", linenumber)
+        for name in self.extern_names:
+            if name in symbols:
+                raise KasmError(f"Token {name} is defined here and declared .extern")
+        for index, name, mask, linenumber in self.relocations:
+            if name not in symbols and name not in self.extern_names:
+                raise KasmError(f"Undefined token at line {linenumber}", linenumber)
+        if self.optimize:
+            self.run_optimizer(self.global_names)
+            for name, address in self.subprocess_names.items():
+                symbols[name][1] = address
+        return {
+            "kasm_object": object_version,
+            "isa": isa_version,
+            "source": source_name,
+            "optimized": self.optimize,
+            "code": list(self.words),
+            "data": list(self.data),
+            "symbols": symbols,
+            "externs": sorted(self.extern_names),
+            "relocations": [list(relocation) for relocation in self.relocations],
+            # Whether assembling the file on its own would add a HALT at the end, the linker does the same
+            # after the first module
+            "needs_halt": not (self.has_halt or self.halt_added or self.no_halt),
+        }
+
+    # After the file is fully scanned, this replaces any subprocess and variable names that were defined
+    def resolve(self):
+        words = self.words
+        for index, name, mask, linenumber in self.relocations:
+            address = self.lookup(name, linenumber)
+            words[index] = relocate(words[index], address, mask, linenumber)
 
         # if there's no halt command, the program will run forever, since 16
         # zeros is technically an instruction, this adds a halt at the end in case
-    if "1111111111111111" not in memory_lines:
-        file.write("1111111111111111\n")
+        if not self.halt_added and not self.has_halt and not self.no_halt:
+            words.append(HALT_WORD)
+            self.word_lines.append(0)
 
+    # Address of a label or variable, labels first, for the relocation from the given line
+    def lookup(self, name, linenumber):
+        if name in self.subprocess_names:
+            return self.subprocess_names[name]
+        if name in self.user_defined_tokens:
+            return self.user_defined_tokens[name]
+        raise KasmError(f"Undefined token at line {linenumber}", linenumber)
 
-def parse(lineargs):
-    global linenumber
+    # Stops assembling with an error for the current line
+    def fail(self, message):
+        raise KasmError(message, self.linenumber)
 
-    # Mode 1 is the .data section, is used for defining variable names
-    if mode == 1:
-        if len(lineargs) != 2:
-            sys.exit(
-                f"Error at line {linenumber}:  Variable declarations in the .data section must be 2 arguments: a "
-                f"token and a value.")
-        else:
-            if lineargs[0] in k86_tokens or lineargs[0] in registers:
-                sys.exit(f"Error at line {linenumber}:  Provided token is a K86 token.")
-            if lineargs[0] in user_defined_tokens:
-                sys.exit(f"Error at line {linenumber}:  Duplicate token.")
-            else:
-                memalloc(lineargs[0], lineargs[1])
-
-    # Mode 2 is the .code section, mostly made of one switch statement
-    # which decides how to process each line in the code section
-    if mode == 2:
-        match lineargs[0]: # Ugliest part of the code
-            case "JMP":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JZ":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JNZ":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JC":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JNC":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JGT":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JLT":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JO":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JNO":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JP":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "JNP":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                jump_type(lineargs[0], lineargs[1])
-            case "ADD":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "SUB":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "MULT":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "DIV":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "AND":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "OR":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "XOR":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "SHL":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                shifters(lineargs[0], lineargs[1], lineargs[2])
-            case "SHR":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                shifters(lineargs[0], lineargs[1], lineargs[2])
-            case "ROL":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                shifters(lineargs[0], lineargs[1], lineargs[2])
-            case "ROR":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                shifters(lineargs[0], lineargs[1], lineargs[2])
-            case "LOADR":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "SWAP":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "CMP":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "TEST":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_register(lineargs[0], lineargs[1], lineargs[2])
-            case "ADDI":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                immediate_type(lineargs[0], lineargs[1], lineargs[2])
-            case "SUBI":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                immediate_type(lineargs[0], lineargs[1], lineargs[2])
-            case "MULTI":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                immediate_type(lineargs[0], lineargs[1], lineargs[2])
-            case "DIVI":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                immediate_type(lineargs[0], lineargs[1], lineargs[2])
-            case "LOADI":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                immediate_type(lineargs[0], lineargs[1], lineargs[2])
-            case "LOADM":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_word_memory_type(lineargs[0], lineargs[1], lineargs[2])
-            case "LOADA":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_word_memory_type(lineargs[0], lineargs[1], lineargs[2])
-            case "STORE":
-                if len(lineargs) != 3: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                two_word_memory_type(lineargs[0], lineargs[1], lineargs[2])
-            case "CLEAR":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "NOT":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "NEG":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "PUSH":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "POP":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "PRINT":
-                if len(lineargs) != 2: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                one_operand(lineargs[0], lineargs[1])
-            case "SKIPZ":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPNZ":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPC":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPNC":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPGT":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPLT":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPO":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPNO":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPP":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SKIPNP":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "PUSHPC":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "RET":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "INPUT":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "NOP":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "SYS":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case "HALT":
-                if len(lineargs) != 1: sys.exit(f"Error at line {linenumber}: Invalid instruction syntax.")
-                no_operand(lineargs[0])
-            case _:  # This case handles the subprocess names
+    def parse(self, lineargs):
+        # Mode 1 is the .data section, is used for defining variable names, arrays and strings
+        if self.mode == 1:
+            self.declare(lineargs)
+
+        # Mode 2 is the .code section, each instruction is looked up in the instruction table
+        # which says how many operands it takes and which encoder makes its words
+        if self.mode == 2:
+            entry = instruction_table.get(lineargs[0])
+            if entry is not None:
+                encoder, count = entry[1], entry[2]
+                if len(lineargs) != count + 1:
+                    self.fail(f"Error at line {self.linenumber}: Invalid instruction syntax.")
+                encoder(self, *lineargs)
+            else:  # This handles the subprocess names
                 temp = lineargs[0]
                 length = len(temp)
                 if len(lineargs) == 1 and temp[length - 1] == ':':
                     temp = temp[0:length - 1]
-                    subprocess_names[temp] = get_next_instr_addr()
+                    self.subprocess_names[temp] = self.get_next_instr_addr()
                 else:
-                    sys.exit(f"Unexpected token at line {linenumber}")
+                    self.fail(f"Unexpected token at line {self.linenumber}")
 
+    # Puts words into the program as they are, for words that aren't instructions, like the ones kdis.py finds
+    # in a memory dump. "ADD R1, R2" and ".word 0xF012" make the same word
+    def raw_words(self, values):
+        if self.mode != 2:
+            self.fail(f"Error at line {self.linenumber}: .word can only be used in the .code section.")
+        if not values:
+            self.fail(f"Error at line {self.linenumber}: Invalid instruction syntax.")
+        for value in values:
+            number = value if isinstance(value, int) else to_number(value)
+            if number is None:
+                self.fail(f"Invalid value format: {value}")
+            self.check_range(number, 16, signed=True)
+            self.emit(number & 0xFFFF)
+            self.setinstrmem1()
+            if number & 0xFFFF == HALT_WORD:
+                self.has_halt = True
 
-# Only being used by the subprocess handler above.
-# it fetches the next unused instruction address without actually assigning it
-def get_next_instr_addr():
-    index = 0
-    while instruction_memory[index]:
-        index += 1
-    return format(index, f'0{12}b')
+    # Only being used by the subprocess handler above.
+    # it fetches the next unused instruction address without actually assigning it
+    def get_next_instr_addr(self):
+        return self.next_instr_addr
 
+    # Reads one line of the .data section. There are three kinds of declaration:
+    #   name value              one word
+    #   name[size] values...    an array, any values not given are 0. "name[]" takes its size from the values
+    #   name "text"             a string, one character per word and a 0 at the end. Can also have a [size]
+    def declare(self, lineargs):
+        token = lineargs[0]
+        is_array = "[" in token and token.endswith("]")
+        if is_array:
+            token, _, size = token[:-1].partition("[")
+        if token in k86_tokens or token in registers:
+            self.fail(f"Error at line {self.linenumber}:  Provided token is a K86 token.")
+        if token in self.user_defined_tokens:
+            self.fail(f"Error at line {self.linenumber}:  Duplicate token.")
 
-# Allocates memory for the variables in the data section
-def memalloc(token, value):
-    finalval = ""
+        is_string = len(lineargs) > 1 and lineargs[1].startswith('"')
+        if is_string:
+            # The string is everything after the name, which can be followed by a comma or whitespace
+            rest = self.statement.lstrip(", \t")[len(lineargs[0]):].strip()
+            if rest.startswith(","):
+                rest = rest[1:]
+            values = parse_string(rest)
+            if values is None:
+                self.fail(f"Error at line {self.linenumber}: Invalid string.")
+            values.append(0)
+        else:
+            values = [self.data_value(value) for value in lineargs[1:]]
 
-    # For unknown vars
-    if value == "?":
-        value = "0"
-        finalval = to_signed_binary(0)
+        if is_array:
+            if size:
+                count = to_number(size)
+                if count is None or count < 1:
+                    self.fail(f"Error at line {self.linenumber}: Invalid array size.")
+                if len(values) > count:
+                    self.fail(f"Error at line {self.linenumber}: Array has more than {count} values.")
+                values += [0] * (count - len(values))
+            elif not values:
+                self.fail(f"Error at line {self.linenumber}: Array needs a size or a list of values.")
+        elif len(values) != 1 and not is_string:
+            self.fail(
+                f"Error at line {self.linenumber}:  Variable declarations in the .data section must be 2 arguments: a "
+                f"token and a value.")
+        self.memalloc(token, values)
 
-    # Hexadecimal value
-    elif value.startswith("0x"):
-        finalval = to_signed_binary(int(value, 16))
+    # Reads one value for the data section, ? is an unknown value and starts as 0
+    def data_value(self, value):
+        if value == "?":
+            return 0
+        number = to_number(value)  # Decimal or hexadecimal value
+        if number is None:
+            self.fail(f"Invalid value format: {value}")
+        self.check_range(number, 16, signed=True)
+        return number
 
-    # Decimal value
-    elif isdigit(value) or (value[0] == "-" and isdigit(value[1:])):
-        finalval = to_signed_binary(int(value))
-    else:
-        sys.exit(f"Invalid value format: {value}")
-
-    # Allocates memory for whatever variable it's processing
-    index = 0
-    while data_memory[index]:
-        index += 1
-        if index >= data_memory_size:
-            sys.exit("Out of data memory!")
-    data_memory[index] = True
-    index = index + instruction_memory_size  # puts it in the data memory zone
-
-    # Adds the variable to the user defined tokens, then creates load and store instructions for that value
-    user_defined_tokens[token] = format(index, f'0{12}b')
-    immediate_type("LOADI", "R0", value)
-    two_word_memory_type("STORE", "R0", index)
-
-
-# Converts the input number to a signed binary value
-def to_signed_binary(number):
-    number = int(number)  # Ensure it's an integer
-    if number < 0:
-        number = (1 << 16) + number  # Convert to two's complement
-    return format(number & 0xFFFF, f'0{16}b')
-
-
-# ISA Section 1
-# Handles all the jump instructions
-def jump_type(instruction_code, op1):
-    if isdigit(op1):
-        temp = format(op1, f'0{12}b')
-        memory_lines.append(k86_tokens[instruction_code] + temp)
-    else:
-        memory_lines.append(k86_tokens[instruction_code] + op1)
-    setinstrmem1()
+    # Allocates memory for a variable or array in the data section. With a data image the values go straight
+    # into it, otherwise every word gets a load and store instruction at the start of the program
+    def memalloc(self, token, values):
+        index = self.datamemalloc(len(values))
+        index = index + self.instruction_memory_size  # puts it in the data memory zone
 
+        # Adds the variable to the user defined tokens, then fills in its words
+        self.user_defined_tokens[token] = index
+        if self.data_image:
+            self.data.extend(value & 0xFFFF for value in values)
+            self.data_lines.extend([self.linenumber] * len(values))
+            return
+        for offset, value in enumerate(values):
+            self.immediate_type("LOADI", "R0", value)
+            self.two_word_memory_type("STORE", "R0", index + offset)
 
-# ISA Section 2
-# Handles add, sub, mult, div, and, or, xor, loadr, swap, cmp, test
-def two_register(instruction_code, op1, op2):
-    if ',' in op1:
-        op1 = op1[0:op1.find(',')]
-    if op1 in registers and op2 in registers:
-        memory_lines.append(k86_tokens[instruction_code] + registers[op1] + registers[op2])
-    else:
-        sys.exit(f"Invalid format at line {linenumber}.")
-    setinstrmem1()
+    # ISA Section 1
+    # Handles all the jump instructions
+    def jump_type(self, instruction_code, op1):
+        self.emit_address(opcodes[instruction_code], op1)
+        self.setinstrmem1()
 
+    # ISA Section 2
+    # Handles add, sub, mult, div, and, or, xor, loadr, swap, cmp, test
+    def two_register(self, instruction_code, op1, op2):
+        if op1 in registers and op2 in registers:
+            self.emit(opcodes[instruction_code] | register_numbers[op1] << 4 | register_numbers[op2])
+        else:
+            self.fail(f"Invalid format at line {self.linenumber}.")
+        self.setinstrmem1()
 
-# Handles shl, shr, rol, ror
-def shifters(instruction_code, op1, op2):
-    if ',' in op1:
-        op1 = op1[0:op1.find(',')]
-    if op1 in registers and isdigit(op2):
-        memory_lines.append(k86_tokens[instruction_code] + registers[op1] + format(op2, f'0{4}b'))
-    else:
-        sys.exit(f"Invalid format at line {linenumber}.")
-    setinstrmem1()
-
-
-# ISA Section 3
-# Handles addi, subi, multi, divi, loadi
-def immediate_type(instruction_code, op1, op2):
-    if ',' in op1:
-        op1 = op1[0:op1.find(',')]
-    if op1 in registers:
-        memory_lines.append(k86_tokens[instruction_code] + registers[op1])
-        memory_lines.append(to_signed_binary(op2))
-    else:
-        sys.exit(f"Invalid format at line {linenumber}.")
-    index = 0
-    while instruction_memory[index]:
-        index += 1
-    instruction_memory[index] = True
-    instruction_memory[index + 1] = True
-
-
-# Handles loadm, loada, store
-def two_word_memory_type(instruction_code, op1, op2):
-    if ',' in op1:
-        op1 = op1[0:op1.find(',')]
-    if op1 in registers:
-        memory_lines.append(k86_tokens[instruction_code] + registers[op1])
-        if isdigit(op2):
-            memory_lines.append("0000" + format(op2, f'0{12}b'))
+    # Handles shl, shr, rol, ror
+    def shifters(self, instruction_code, op1, op2):
+        amount = op2 if isinstance(op2, int) else to_number(op2)
+        if op1 in registers and amount is not None:
+            self.check_range(amount, 4)
+            self.emit(opcodes[instruction_code] | register_numbers[op1] << 4 | amount)
         else:
-            memory_lines.append("0000" + op2)
-        index = 0
-        while instruction_memory[index]:
-            index += 1
-        instruction_memory[index] = True
-        instruction_memory[index + 1] = True
-    else:
-        sys.exit(f"Invalid format at line {linenumber}.")
+            self.fail(f"Invalid format at line {self.linenumber}.")
+        self.setinstrmem1()
 
+    # ISA Section 3
+    # Handles addi, subi, multi, divi, loadi
+    def immediate_type(self, instruction_code, op1, op2):
+        value = op2 if isinstance(op2, int) else to_number(op2)
+        if op1 in registers and value is not None:
+            self.check_range(value, 16, signed=True)
+            self.emit(opcodes[instruction_code] | register_numbers[op1])
+            self.emit(value & 0xFFFF)  # negative values become two's complement
+        else:
+            self.fail(f"Invalid format at line {self.linenumber}.")
+        self.instrmemalloc(2)
+
+    # Handles loadm, loada, store
+    def two_word_memory_type(self, instruction_code, op1, op2):
+        if op1 in registers:
+            self.emit(opcodes[instruction_code] | register_numbers[op1])
+            self.emit_address(0, op2)
+            self.instrmemalloc(2)
+        else:
+            self.fail(f"Invalid format at line {self.linenumber}.")
+
+    # Handles clear, not, neg, push, pop, ret, and print
+    def one_operand(self, instruction_code, op1):
+        if op1 in registers:
+            self.emit(opcodes[instruction_code] | register_numbers[op1])
+            self.setinstrmem1()
+        else:
+            self.fail(f"Invalid format at line {self.linenumber}.")
+
+    # ISA Section 4
+    # Handles the skips, input, nop, sys, halt
+    def no_operand(self, instruction_code):
+        self.emit(opcodes[instruction_code])
+        self.setinstrmem1()
+        if instruction_code == "HALT":
+            self.has_halt = True
+
+    # Appends a word with a 12-bit address in its low bits. The address is either a number, or a name
+    # (with an optional +offset, like "table+3") that gets a relocation so resolve() can fill it in later.
+    # Numbers are checked even when they come from the assembler, like a variable's address, since memory
+    # can be made bigger than the field can reach
+    def emit_address(self, word, address):
+        value = address if isinstance(address, int) else to_number(address)
+        name = None
+        if value is None:
+            name, value = split_offset(address)
+            if value is None:
+                self.fail(f"Invalid format at line {self.linenumber}.")
+        self.check_range(value, 12)  # before the relocation, so a failed line doesn't leave one behind
+        if name is not None:
+            self.relocations.append((self.word_count(), name, ADDRESS_FIELD, self.linenumber))
+        self.emit(word | value & ADDRESS_FIELD)
+
+    # Stops with an error if a number from the source doesn't fit in its field. A signed field also takes
+    # negative numbers, which are stored as two's complement
+    def check_range(self, value, bits, signed=False):
+        low = -(1 << (bits - 1)) if signed else 0
+        if not low <= value < 1 << bits:
+            self.fail(f"Error at line {self.linenumber}: {value} does not fit in a {bits}-bit field.")
+
+    # Adds a finished word to the program
+    def emit(self, word):
+        self.words.append(word)
+        self.word_lines.append(self.linenumber)
+
+    # Number of words emitted so far, which is also the index the next word will have
+    def word_count(self):
+        return len(self.words)
+
+    # Updates what instruction memory is being used
+    def setinstrmem1(self):
+        self.instrmemalloc(1)
+
+    # Reserves the next `count` words of instruction memory and returns the first address
+    def instrmemalloc(self, count):
+        index = self.next_instr_addr
+        if index + count > self.instruction_memory_size:
+            self.fail(f"Error at line {self.linenumber}: Out of instruction memory!")
+        self.next_instr_addr = index + count
+        return index
+
+    # Reserves the next `count` words of data memory and returns the first address (relative to the data zone)
+    def datamemalloc(self, count):
+        index = self.next_data_addr
+        if index + count > self.data_memory_size:
+            self.fail(f"Error at line {self.linenumber}: Out of data memory!")
+        self.next_data_addr = index + count
+        return index
+
+
+# Assembles in a single pass, writing each word to a seekable output file as soon as it's made instead of keeping
+# the program in memory. Words that use a name that isn't defined yet are written with the field left as zero and
+# recorded as fix-ups, then resolve() seeks back and patches them. Names that are already defined are filled in
+# straight away, so only forward references are held in memory while assembling
+class StreamingAssembler(Assembler):
+    def __init__(self, output, output_format="img", **sizes):
+        if output_format not in stream_formats:
+            raise ValueError(f"Can't stream the {output_format} format, use one of {', '.join(stream_formats)}")
+        self.output = output
+        self.width, self.encode = stream_formats[output_format]
+        super().__init__(**sizes)
+
+    def reset(self):
+        super().reset()
+        self.count = 0
+
+    # Assembles lines from any iterable (a file, stdin, a generator) and returns how many words were written
+    def assemble_stream(self, lines):
+        self.reset()
+        for line in lines:
+            self.read_line(line)
+        self.resolve()
+        return self.count
+
+    def emit(self, word):
+        self.output.write(self.encode(word))
+        self.count += 1
+
+    def word_count(self):
+        return self.count
+
+    def emit_address(self, word, address):
+        if isinstance(address, str) and to_number(address) is None:
+            name, offset = split_offset(address)
+            if offset is not None and (name in self.subprocess_names or name in self.user_defined_tokens):
+                self.check_range(offset, 12)
+                address = self.lookup(name, self.linenumber) + offset
+                self.check_range(address, 12)
+        super().emit_address(word, address)
+
+    # Patches every forward reference in the output, then adds the HALT if there wasn't one
+    def resolve(self):
+        end = self.output.tell()
+        for index, name, mask, linenumber in self.relocations:
+            address = self.lookup(name, linenumber)
+            self.output.seek(index * self.width)
+            word = self.decode(self.output.read(self.width))
+            self.output.seek(index * self.width)
+            self.output.write(self.encode(relocate(word, address, mask, linenumber)))
+        self.relocations = []
+        self.output.seek(end)
+        if not self.has_halt and not self.no_halt:
+            self.emit(HALT_WORD)
+
+    def decode(self, data):
+        return int.from_bytes(data, "big") if self.width == 2 else int(data[:16], 2)
+
+
+# Assembles like Assembler, but also times each phase and counts allocations, for kasm.py --profile and kbench.py.
+# After assembling, profile holds the seconds spent reading and tokenizing lines, parsing them (not counting
+# memory allocation), allocating instruction and data memory, optimizing and resolving names, and the counts
+class ProfilingAssembler(Assembler):
+    def reset(self):
+        super().reset()
+        self.profile = {
+            "seconds": {"read": 0.0, "parse": 0.0, "allocate": 0.0, "optimize": 0.0, "resolve": 0.0},
+            "counts": {"lines": 0, "instruction_allocations": 0, "data_allocations": 0},
+        }
+        self.blocks = sys.getallocatedblocks()
+
+    def assemble(self, text):
+        start = time.perf_counter()
+        words = super().assemble(text)
+        seconds = self.profile["seconds"]
+        seconds["parse"] -= seconds["allocate"]
+        seconds["total"] = time.perf_counter() - start
+        self.profile["counts"].update({
+            "words": len(words),
+            "data_words": self.next_data_addr,
+            "relocations": len(self.relocations),
+            "labels": len(self.subprocess_names),
+            "variables": len(self.user_defined_tokens),
+            "python_blocks": sys.getallocatedblocks() - self.blocks,  # objects Python still has allocated
+        })
+        return words
+
+    def read_line(self, line):
+        start = time.perf_counter()
+        lineargs = self.split_line(line)
+        middle = time.perf_counter()
+        self.handle_line(lineargs)
+        end = time.perf_counter()
+        seconds = self.profile["seconds"]
+        seconds["read"] += middle - start
+        seconds["parse"] += end - middle
+        self.profile["counts"]["lines"] += 1
+
+    def instrmemalloc(self, count):
+        start = time.perf_counter()
+        index = super().instrmemalloc(count)
+        self.profile["seconds"]["allocate"] += time.perf_counter() - start
+        self.profile["counts"]["instruction_allocations"] += 1
+        return index
+
+    def datamemalloc(self, count):
+        start = time.perf_counter()
+        index = super().datamemalloc(count)
+        self.profile["seconds"]["allocate"] += time.perf_counter() - start
+        self.profile["counts"]["data_allocations"] += 1
+        return index
+
+    def run_optimizer(self, roots=()):
+        start = time.perf_counter()
+        super().run_optimizer(roots)
+        self.profile["seconds"]["optimize"] += time.perf_counter() - start
+
+    def resolve(self):
+        start = time.perf_counter()
+        super().resolve()
+        self.profile["seconds"]["resolve"] += time.perf_counter() - start
+
+
+# Formats the streaming assembler can write, every word takes the same number of bytes so it can seek back to any of them
+stream_formats = {
+    "img": (2, lambda word: word.to_bytes(2, "big")),
+    "bin": (17, lambda word: format(word, f'0{16}b').encode() + b"\n"),
+}
+
+
+# Instructions with the same opcode length that take different operands, so they need to be named
+shift_instructions = {"SHL", "SHR", "ROL", "ROR"}
+immediate_instructions = {"ADDI", "SUBI", "MULTI", "DIVI", "LOADI"}
+two_word_memory_instructions = {"LOADM", "LOADA", "STORE"}
+two_word_instructions = immediate_instructions | two_word_memory_instructions
+
+
+# Builds the instruction table from k86_tokens. Every mnemonic maps to
+# (opcode, encoder, number of operands, kind of each operand), where the kinds are
+# "register", "number" (a value in the instruction), or "address" (a number or a name)
+def build_instruction_table():
+    table = {}
+    for name, bits in k86_tokens.items():
+        if len(bits) == 4:
+            encoder, kinds = Assembler.jump_type, ("address",)
+        elif name in shift_instructions:
+            encoder, kinds = Assembler.shifters, ("register", "number")
+        elif len(bits) == 8:
+            encoder, kinds = Assembler.two_register, ("register", "register")
+        elif name in immediate_instructions:
+            encoder, kinds = Assembler.immediate_type, ("register", "number")
+        elif name in two_word_memory_instructions:
+            encoder, kinds = Assembler.two_word_memory_type, ("register", "address")
+        elif len(bits) == 12:
+            encoder, kinds = Assembler.one_operand, ("register",)
+        else:
+            encoder, kinds = Assembler.no_operand, ()
+        table[name] = (opcodes[name], encoder, len(kinds), kinds)
+    return table
+
+
+instruction_table = build_instruction_table()
 
-# Handles clear, not, neg, push, pop, ret, and print
-def one_operand(instruction_code, op1):
-    if op1 in registers:
-        memory_lines.append(k86_tokens[instruction_code] + registers[op1])
-        setinstrmem1()
-    else:
-        sys.exit(f"Invalid format at line {linenumber}.")
 
+# Splits a line (with the comment already removed) into its tokens. Operands can be separated
+# by commas, spaces or both, so "ADD R1, R2", "ADD R1,R2" and "ADD R1 R2" all read the same
+def tokenize(text):
+    return text.replace(",", " ").split()
 
-# ISA Section 4
-# Handles the skips, input, nop, sys, halt
-def no_operand(instruction_code):
-    memory_lines.append(k86_tokens[instruction_code])
-    setinstrmem1()
 
+# Removes the comment from a line. A # inside a string is part of the string, not a comment
+def strip_comment(line):
+    if '"' not in line:
+        return line.split("#")[0]
+    quoted = False
+    escaped = False
+    for index, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = quoted
+        elif char == '"':
+            quoted = not quoted
+        elif char == "#" and not quoted:
+            return line[:index]
+    return line
 
-# Updates what instruction memory is being used
-def setinstrmem1():
-    index = 0
-    while instruction_memory[index]:
-        index += 1
-    instruction_memory[index] = True
 
+# Escapes that can be used in strings
+string_escapes = {"n": 10, "t": 9, "r": 13, "0": 0, "\\": 92, '"': 34}
 
-# Method for checking if a string is made of numbers only
-def isdigit(s):
+
+# Reads a string in double quotes and returns the character codes in it, or None if it isn't a valid string
+def parse_string(text):
+    text = text.strip()
+    if len(text) < 2 or not text.startswith('"') or not text.endswith('"'):
+        return None
+    codes = []
+    escaped = False
+    for char in text[1:-1]:
+        if escaped:
+            if char not in string_escapes:
+                return None
+            codes.append(string_escapes[char])
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            return None
+        else:
+            codes.append(ord(char))
+    return None if escaped else codes
+
+
+# Splits an address operand like "table+3" into the name and the offset. A plain name has an offset of 0,
+# and the offset is None if it isn't a number
+def split_offset(address):
+    name, plus, offset = address.partition("+")
+    if not plus:
+        return address, 0
+    return name, to_number(offset)
+
+
+# Fills the address of a name into the field of a word, which already holds the +offset. Stops with an error
+# if the address plus the offset doesn't fit in the field
+def relocate(word, address, mask, linenumber):
+    value = (word & mask) + address
+    if value > mask:
+        raise KasmError(f"Error at line {linenumber}: {value} does not fit in a {mask.bit_length()}-bit field.",
+                        linenumber)
+    return (word & ~mask) | value
+
+
+# Reads a decimal or 0x hexadecimal number, either can be negative. Returns None if it isn't a number
+def to_number(s):
     try:
-        float(s)
-        return True
+        if s.lstrip("-").startswith(("0x", "0X")):
+            return int(s, 16)
+        return int(s, 10)
     except ValueError:
-        return False
+        return None
 
 
-# Main, just checking the usage is right and then running
-def main():
-    global filename
-    if len(sys.argv) != 2:  # Check if arguments were passed
-        sys.exit("Usage: kasm.py [file name]")
+# Writes the words as text, one 16-bit binary word per line
+def write_bin(words, path):
+    with open(path, "w") as file:
+        for word in words:
+            file.write(format(word, f'0{16}b') + "\n")
+
+
+# Writes the words as a raw big endian image, two bytes per word, which a loader can map straight into memory
+def write_raw(words, path):
+    image = array('H', words)
+    if sys.byteorder == "little":
+        image.byteswap()
+    with open(path, "wb") as file:
+        image.tofile(file)
+
+
+# Writes the words as Intel HEX, 16 bytes per record. The memory is big endian, so word n is at byte 2n.
+# A data memory image goes in the same file, starting at word data_address
+def write_hex(words, path, data=None, data_address=instruction_memory_size):
+    with open(path, "w") as file:
+        write_hex_records(file, words, 0)
+        if data:
+            write_hex_records(file, data, data_address * 2)
+        file.write(":00000001FF\n")
+
+
+# Writes one section of an Intel HEX file starting at a byte address, with an extended address
+# record whenever the address goes past 64 KB
+def write_hex_records(file, words, start):
+    image = array('H', words)
+    if sys.byteorder == "little":
+        image.byteswap()
+    data = image.tobytes()
+    upper = 0
+    for offset in range(0, len(data), 16):
+        address = start + offset
+        if address >> 16 != upper:
+            upper = address >> 16
+            record = bytes([2, 0, 0, 4, upper >> 8, upper & 0xFF])
+            file.write(":" + record.hex().upper() + format(-sum(record) & 0xFF, "02X") + "\n")
+        chunk = data[offset:offset + 16]
+        record = bytes([len(chunk), address >> 8 & 0xFF, address & 0xFF, 0]) + chunk
+        checksum = -sum(record) & 0xFF
+        file.write(":" + record.hex().upper() + format(checksum, "02X") + "\n")
+
+
+# Writes the words as a Multisim word generator pattern, the same layout as the files in Multisim/05_Programs
+def write_dp(words, path):
+    with open(path, "w") as file:
+        file.write("Data:\n")
+        for word in words:
+            file.write(format(word, "08X") + "\n")
+        file.write(f"Initial:\n0000\nFinal:\n{max(len(words) - 1, 0):04X}")
+
+
+# Reads back any of the formats above, picked by the file extension
+def read_words(path):
+    extension = os.path.splitext(path)[1]
+    if extension == ".img":
+        image = array('H')
+        with open(path, "rb") as file:
+            image.frombytes(file.read())
+        if sys.byteorder == "little":
+            image.byteswap()
+        return image
+    with open(path, "r") as file:
+        lines = [line.split("#")[0].strip() for line in file]
+    if extension == ".dp":
+        end = lines.index("Initial:") if "Initial:" in lines else len(lines)
+        return array('H', [int(line, 16) for line in lines[1:end] if line])
+    if extension == ".hex":
+        return read_hex(lines)[0]
+    return array('H', [int(line, 2) for line in lines if line])
+
+
+# Reads the lines of an Intel HEX file into two images, the words before data_address and the words from it on
+def read_hex(lines, data_address=instruction_memory_size):
+    sections = (bytearray(), bytearray())
+    limit = data_address * 2
+    upper = 0
+    for line in lines:
+        if not line.startswith(":"):
+            continue
+        record = bytes.fromhex(line[1:])
+        if record[3] == 4:
+            upper = (record[4] << 8 | record[5]) << 16
+        elif record[3] == 0:
+            address = upper | record[1] << 8 | record[2]
+            section = sections[address >= limit]
+            if address >= limit:
+                address -= limit
+            section[len(section):] = bytes(max(0, address - len(section)))
+            section[address:address + record[0]] = record[4:4 + record[0]]
+    return [array('H', [data[i] << 8 | data[i + 1] for i in range(0, len(data) - 1, 2)]) for data in sections]
+
+
+# Reads the data memory image that goes with a program, from the data section of a .hex file or the .data
+# file written next to any other format. Returns an empty image if the program doesn't have one
+def read_data(path):
+    base, extension = os.path.splitext(path)
+    if extension == ".hex":
+        with open(path, "r") as file:
+            return read_hex([line.strip() for line in file])[1]
+    if os.path.exists(base + ".data" + extension):
+        return read_words(base + ".data" + extension)
+    return array('H')
+
+
+# First words of the instructions that have a second word (with the register field dropped), so a listing
+# can tell which words are operands
+two_word_prefixes = {opcodes[name] >> 4 for name in two_word_instructions}
+
+
+# True if one of the instructions in the words is a HALT. A second word that happens to be 0xFFFF isn't one
+def has_halt(words):
+    address = 0
+    while address < len(words):
+        if words[address] == HALT_WORD:
+            return True
+        address += 2 if words[address] >> 4 in two_word_prefixes else 1
+    return False
+
+
+# Writes a listing of the program: every source line, with the address, hex and binary of each word it made.
+# The second word of a two word instruction is marked with +, and words of the data memory image with *
+def write_listing(assembler, source, path):
+    code = {}
+    for address, line in enumerate(assembler.word_lines):
+        code.setdefault(line, []).append(address)
+    data = {}
+    for offset, line in enumerate(assembler.data_lines):
+        data.setdefault(line, []).append(offset)
+
+    operands = set()
+    address = 0
+    while address < len(assembler.words):
+        if assembler.words[address] >> 4 in two_word_prefixes:
+            operands.add(address + 1)
+            address += 1
+        address += 1
+
+    # One row for each word, the first row of a line has the line's text
+    def rows(number, text):
+        result = []
+        for address in code.get(number, []):
+            word = assembler.words[address]
+            mark = "+" if address in operands else " "
+            result.append(f"{address:04X}{mark} {word:04X}  {word:016b}")
+        for offset in data.get(number, []):
+            word = assembler.data[offset]
+            result.append(f"{assembler.instruction_memory_size + offset:04X}* {word:04X}  {word:016b}")
+        if not result:
+            return [f"{'':28} {number:>5}  {text}"]
+        return [result[0] + f" {number:>5}  {text}"] + result[1:]
+
+    with open(path, "w") as file:
+        file.write("# + marks the second word of a two word instruction, * marks a word of the data memory image\n")
+        file.write(f"{'ADDR':<5} {'WORD':<4}  {'BINARY':<16} {'LINE':>5}  SOURCE\n")
+        for number, text in enumerate(source.splitlines(), 1):
+            file.write("\n".join(rows(number, text.rstrip())) + "\n")
+        if 0 in code:
+            file.write("\n".join(rows(0, "(added by the assembler)")) + "\n")
+
+
+# Writes the symbol map: the address, kind and size of every label and variable, then the source line of
+# every word by address, so a tool can go from a program counter to a line without assembling again
+def write_map(assembler, source, path):
+    variables = sorted(assembler.user_defined_tokens.items(), key=lambda item: item[1])
+    data_end = assembler.instruction_memory_size + assembler.next_data_addr
+    sizes = {name: (variables[index + 1][1] if index + 1 < len(variables) else data_end) - address
+             for index, (name, address) in enumerate(variables)}
+    with open(path, "w") as file:
+        file.write("[symbols]\n")
+        file.write("# name, address, kind, size in words\n")
+        for name, address in sorted(assembler.subprocess_names.items(), key=lambda item: item[1]):
+            file.write(f"{name} {address:04X} label 0\n")
+        for name, address in variables:
+            file.write(f"{name} {address:04X} variable {sizes[name]}\n")
+        file.write("[lines]\n")
+        file.write("# address, source line (0 if the word isn't from a line)\n")
+        for address, line in enumerate(assembler.word_lines):
+            file.write(f"{address:04X} {line}\n")
+
+
+# Reads a symbol map back. Returns the symbols as name -> (address, kind, size), and the source line of
+# every word as an array indexed by address
+def read_map(path):
+    symbols = {}
+    lines = array('I')
+    section = None
+    with open(path, "r") as file:
+        for line in file:
+            line = line.split("#")[0].strip()
+            if line.startswith("["):
+                section = line
+            elif line and section == "[symbols]":
+                name, address, kind, size = line.split()
+                symbols[name] = (int(address, 16), kind, int(size))
+            elif line and section == "[lines]":
+                address, number = line.split()
+                address = int(address, 16)
+                lines.extend([0] * (address + 1 - len(lines)))
+                lines[address] = int(number)
+    return symbols, lines
+
+
+# Writes an object made by Assembler.assemble_object() as JSON
+def write_object(module, path):
+    with open(path, "w") as file:
+        json.dump(module, file, separators=(",", ":"))
+        file.write("\n")
+
+
+# Reads an object file back, raising KasmError if it isn't one or was made for a different instruction set
+def read_object(path):
+    with open(path, "r") as file:
+        try:
+            module = json.load(file)
+        except ValueError:
+            raise KasmError(f"{path} is not a KASM object file")
+    if not isinstance(module, dict) or module.get("kasm_object") != object_version:
+        raise KasmError(f"{path} is not a KASM object file")
+    if module["isa"] != isa_version:
+        raise KasmError(f"{path} was assembled for a different version of K86, assemble it again")
+    return module
+
+
+# Output formats, and the extension and writer for each
+output_formats = {
+    "bin": (".bin", write_bin),
+    "img": (".img", write_raw),
+    "hex": (".hex", write_hex),
+    "dp": (".dp", write_dp),
+}
+
+
+# Formats made from the source and the assembler's tables instead of just the words. These always
+# assemble the file, even with a build cache, since the cache only holds the words
+listing_formats = {
+    "lst": (".lst", write_listing),
+    "map": (".map", write_map),
+}
+
+
+# Default place and size limit for the build cache
+default_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "kasm")
+default_cache_size = 64 * 1024 * 1024
+
+
+# On-disk cache of assembled images, keyed on a hash of the source and the assembler version.
+# Each entry is a raw image file. Using an entry updates its modification time, and when the cache
+# grows past max_bytes the entries that were used longest ago are deleted first
+class BuildCache:
+    def __init__(self, directory=default_cache_dir, max_bytes=default_cache_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    # Key for a source text, anything else that changes the output goes in options
+    @staticmethod
+    def key(source, options=""):
+        digest = hashlib.sha256(isa_version.encode())
+        digest.update(options.encode())
+        digest.update(b"\0")
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    # Returns the cached words, or None if this key hasn't been built
+    def get(self, key):
+        path = self.path(key)
+        try:
+            words = read_words(path)
+            os.utime(path)
+        except OSError:
+            return None
+        return words
+
+    def put(self, key, words):
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}.tmp"
+        write_raw(words, temp)
+        os.replace(temp, path)  # another process may be writing the same entry, this way neither sees half a file
+        self.evict()
+
+    # Deletes the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(".img"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Assembles a .k86 file and writes each of the requested formats next to it. Returns the words and
+# whether they came from the cache. With a cache, an unchanged source isn't assembled again, but the
+# outputs are always written, since they may be from a build with other options. With data_image, the
+# .data section is written as its own image (name.data.bin and so on, or the data section of the .hex file).
+# Given a profile dictionary, the time each phase took and the allocation counts are put in it
+def run(filename, formats=("bin",), cache=None, optimize=False, data_image=False, profile=None):
+    start = time.perf_counter()
+    with open(filename, "r") as reader:
+        source = reader.read()
+    load_time = time.perf_counter() - start
+    base = os.path.splitext(filename)[0]
+    listings = [name for name in formats if name in listing_formats]
+    words = data = None
+    if cache is not None:
+        options = ("O" if optimize else "") + ("D" if data_image else "")
+        key = cache.key(source, options)
+        data_key = cache.key(source, options + ".data")
+        if not listings:
+            words = cache.get(key)
+            data = cache.get(data_key) if data_image else array('H')
+    cached = words is not None and data is not None
+    if not cached:
+        assembler = (Assembler if profile is None else ProfilingAssembler)(optimize=optimize, data_image=data_image)
+        words = assembler.assemble(source)
+        data = assembler.data
+        if cache is not None:
+            cache.put(key, words)
+            if data_image:
+                cache.put(data_key, data)
+
+    start = time.perf_counter()
+    write_outputs(base, formats, words, data, data_image)  # even on a hit, the files may be from other options
+    for name in listings:
+        extension, writer = listing_formats[name]
+        writer(assembler, source, base + extension)
+    if profile is not None:
+        profile.update(assembler.profile if not cached else {"seconds": {}, "counts": {"words": len(words)}})
+        profile["file"] = filename
+        profile["cached"] = cached
+        profile["seconds"]["load"] = load_time
+        profile["seconds"]["output"] = time.perf_counter() - start
+    return words, cached
+
+
+# Writes a program in each of the formats, named base plus the format's extension. With data_image, the data
+# memory image goes next to it as base.data plus the extension, or in the same file for .hex. Listing formats
+# are left to run()
+def write_outputs(base, formats, words, data=None, data_image=False):
+    for name in formats:
+        if name not in output_formats:
+            continue
+        extension, writer = output_formats[name]
+        if data_image and name == "hex":
+            write_hex(words, base + extension, data)
+        else:
+            writer(words, base + extension)
+            if data_image:
+                writer(data, base + ".data" + extension)
+
+
+# Assembles a .k86 file into a relocatable object next to it (name.ko) and returns the object
+def run_object(filename, optimize=False):
+    with open(filename, "r") as reader:
+        source = reader.read()
+    module = Assembler(optimize=optimize).assemble_object(source, os.path.basename(filename))
+    write_object(module, os.path.splitext(filename)[0] + ".ko")
+    return module
+
+
+# Assembles from a file name, or stdin for "-", with the streaming assembler.
+# Returns the number of words written to the output file. The words go to a temporary file that only
+# replaces the output once the whole program has assembled, so an error doesn't leave half a program behind
+def run_stream(filename, output_path, output_format="img"):
+    temp = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp, "w+b") as output:
+            assembler = StreamingAssembler(output, output_format)
+            if filename == "-":
+                count = assembler.assemble_stream(sys.stdin)
+            else:
+                with open(filename, "r") as reader:
+                    count = assembler.assemble_stream(reader)
+        os.replace(temp, output_path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return count
+
+
+# Turns the command line inputs into a list of files. Directories are searched for .k86 files,
+# and anything with wildcards is expanded as a glob
+def expand_inputs(inputs):
+    filenames = []
+    for name in inputs:
+        if os.path.isdir(name):
+            filenames += sorted(glob.glob(os.path.join(glob.escape(name), "**", "*.k86"), recursive=True))
+        elif glob.has_magic(name):
+            filenames += sorted(glob.glob(name, recursive=True))
+        else:
+            filenames.append(name)
+    return list(dict.fromkeys(filenames))
+
+
+# Assembles one file of a batch. Runs in a worker process, so it reports errors
+# in its result instead of raising, and a bad file doesn't stop the others.
+# Returns (file name, error message or None, words emitted, seconds taken, came from the cache, profile or None)
+def batch_job(filename, formats, cache=None, optimize=False, data_image=False, profile=False):
+    start = time.perf_counter()
+    phases = {} if profile else None
+    try:
+        if os.path.splitext(filename)[1] != ".k86":
+            raise KasmError("KASM can only process .k86 files!")
+        words, cached = run(filename, formats, cache, optimize, data_image, phases)
+        return filename, None, len(words), time.perf_counter() - start, cached, phases
+    except KasmError as error:
+        return filename, error.message, 0, time.perf_counter() - start, False, None
+    except OSError as error:
+        return filename, f"{error.strerror}: {filename}", 0, time.perf_counter() - start, False, None
+
+
+# Assembles every file across a pool of worker processes, prints a report, and returns how many failed.
+# With profiles, the profile of every file that assembled is added to it
+def run_batch(filenames, formats, jobs=None, cache=None, optimize=False, data_image=False, profiles=None):
+    start = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    count = len(filenames)
+    profile = profiles is not None
+    if jobs == 1 or count == 1:
+        results = [batch_job(filename, formats, cache, optimize, data_image, profile) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(batch_job, filenames, [formats] * count, [cache] * count, [optimize] * count,
+                                    [data_image] * count, [profile] * count, chunksize=4))
+
+    failures = 0
+    width = max([len(filename) for filename in filenames] + [4])
+    for filename, message, count, seconds, cached, phases in results:
+        if phases is not None:
+            profiles.append(phases)
+        if message is None:
+            status = "CACHED" if cached else "OK"
+            print(f"{status:<6}  {filename:<{width}}  {count:>5} words  {seconds * 1000:8.1f} ms")
+        else:
+            failures += 1
+            print(f"{'FAIL':<6}  {filename:<{width}}  {message}")
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} files, {len(results) - failures} assembled, {failures} failed in {elapsed:.2f} s")
+    return failures
+
+
+# Writes --profile results as JSON, to stdout for "-"
+def write_profile(profile, path):
+    text = json.dumps(profile, indent=2) + "\n"
+    if path == "-":
+        sys.stdout.write(text)
     else:
-        filename = sys.argv[1]
-        temp = filename.split('.')
-        if temp[1] == "k86":
-            run()
+        with open(path, "w") as file:
+            file.write(text)
+
+
+# Splits a --format value like "bin,dp" into its formats
+def format_list(text):
+    names = [name.strip() for name in text.split(",") if name.strip()]
+    choices = list(output_formats) + list(listing_formats)
+    for name in names:
+        if name not in choices:
+            raise argparse.ArgumentTypeError(f"unknown format '{name}' (choose from {', '.join(choices)})")
+    return names
+
+
+# Main, just checking the usage is right and then running. One file is assembled quietly like always,
+# several files, directories or globs are assembled as a batch with a report at the end
+def main():
+    parser = argparse.ArgumentParser(prog="kasm.py", description="Assembles KASM programs for the K86 computer.")
+    parser.add_argument("filenames", nargs="+", metavar="filename",
+                        help=".k86 files to assemble, or directories and globs to search for them")
+    parser.add_argument("-f", "--format", type=format_list, action="append",
+                        help="output formats, any of bin (text, the default), img (raw big endian image), "
+                             "hex (Intel HEX), dp (Multisim word generator), lst (listing) and map (symbol and "
+                             "line map). Can be repeated or comma separated")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes for batch assembly (default: one per CPU)")
+    parser.add_argument("--cache", action="store_true",
+                        help="skip files that haven't changed since they were last assembled")
+    parser.add_argument("--cache-dir", default=default_cache_dir, help=f"build cache location (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=default_cache_size // (1024 * 1024),
+                        help="build cache size limit in MB (default: %(default)s)")
+    parser.add_argument("--stream", action="store_true",
+                        help="assemble in one pass, writing words as they're made (reads stdin if the file is -)")
+    parser.add_argument("-o", "--output", help="output file for --stream")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="remove dead code, redundant loads and stores, and thread jumps")
+    parser.add_argument("-D", "--data-image", action="store_true",
+                        help="write the .data section as a data memory image (name.data.bin and so on) instead of "
+                             "setting it up with LOADI and STORE instructions")
+    parser.add_argument("-c", "--object", action="store_true",
+                        help="assemble each file into a relocatable object (name.ko) for klink.py")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time each phase took and allocation counts as JSON to FILE (- for stdout)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and reassemble files as they're saved")
+    args = parser.parse_args()
+    formats = [name for names in args.format for name in names] if args.format else ["bin"]
+    formats = tuple(dict.fromkeys(formats))
+    cache = BuildCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache else None
+    if args.profile and (args.object or args.watch or args.stream):
+        sys.exit("--profile can't be used with -c, --watch or --stream")
+
+    if args.object:
+        failures = 0
+        for filename in expand_inputs(args.filenames):
+            try:
+                run_object(filename, args.optimize)
+            except KasmError as error:
+                failures += 1
+                print(f"{filename}: {error.message}", file=sys.stderr)
+            except OSError as error:
+                failures += 1
+                print(f"{filename}: {error.strerror}", file=sys.stderr)
+        sys.exit(1 if failures else 0)
+    elif args.watch:
+        import kwatch
+        kwatch.watch(args.filenames, formats, cache, optimize=args.optimize, data_image=args.data_image)
+    elif args.stream:
+        if args.data_image:
+            sys.exit("--stream can't write a data image")
+        if not args.format and args.output and os.path.splitext(args.output)[1] == ".img":
+            formats = ("img",)
+        if len(args.filenames) != 1 or len(formats) != 1 or formats[0] not in stream_formats:
+            sys.exit(f"--stream takes one input and one of these formats: {', '.join(stream_formats)}")
+        filename = args.filenames[0]
+        if args.output is None and filename == "-":
+            sys.exit("--stream from stdin needs an output file (-o)")
+        output = args.output or os.path.splitext(filename)[0] + output_formats[formats[0]][0]
+        try:
+            run_stream(filename, output, formats[0])
+        except KasmError as error:
+            sys.exit(error.message)
+    elif len(args.filenames) == 1 and os.path.isfile(args.filenames[0]):
+        filename = args.filenames[0]
+        if os.path.splitext(filename)[1] == ".k86":
+            profile = {} if args.profile else None
+            try:
+                run(filename, formats, cache, args.optimize, args.data_image, profile)
+            except KasmError as error:
+                sys.exit(error.message)
+            if args.profile:
+                write_profile(profile, args.profile)
         else:
             sys.exit("KASM can only process .k86 files!")
+    else:
+        filenames = expand_inputs(args.filenames)
+        if not filenames:
+            sys.exit("No .k86 files found!")
+        profiles = [] if args.profile else None
+        failures = run_batch(filenames, formats, args.jobs, cache, args.optimize, args.data_image, profiles)
+        if args.profile:
+            write_profile(profiles, args.profile)
+        sys.exit(1 if failures else 0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,307 @@
+#     KASM Benchmark
+#     Times the assembler on generated programs, phase by phase, and compares the results with a saved baseline
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import kasm
+
+# Where the recorded baseline lives, next to this file
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kbench_baseline.json")
+
+# Least total time each case is timed for. Small cases are run more times than --repeat until they reach it,
+# since the best of a few sub-millisecond runs is mostly noise. A case timed again because it looked slower
+# than the baseline gets longer, so it can outlast a slow spell of the machine
+min_case_seconds = 0.2
+min_retry_seconds = 1.0
+
+# Lines for reference_work to chew on
+reference_lines = [f"LABEL_{index}: ADD R{index % 16}, R{index * 3 % 16}" for index in range(500)]
+
+# Instructions the generated programs are made of, a mix of one and two word instructions. The memory
+# operands are numbers, since the scale suite's data memory starts past what a 12-bit field can hold
+instruction_mix = [
+    "ADD R1, R2",
+    "LOADI R3, 42",
+    "CMP R1, R3",
+    "JNZ START",
+    "LOADM R4, 0x800",
+    "STORE R4, 0x801",
+    "PRINT R4",
+    "NOP",
+]
+
+
+# Builds a .k86 program with roughly `words` instruction words
+def generate_program(words):
+    lines = [".code", "START:"]
+    count = 0
+    index = 0
+    while count < words:
+        instruction = instruction_mix[index % len(instruction_mix)]
+        lines.append(instruction)
+        count += 2 if instruction.startswith(("LOADI", "LOADM", "STORE")) else 1
+        index += 1
+    return "\n".join(lines) + "\n"
+
+
+# A fixed bit of string and dict work, like the assembler does, timed next to every case. The machine can run a
+# lot slower for seconds at a time, and this gets slower with it, so the cases are compared relative to it
+def reference_work():
+    table = {}
+    for line in reference_lines:
+        parts = line.replace(",", " ").split()
+        table[parts[0]] = [part.upper() for part in parts[1:]]
+    return table
+
+
+# Makes up operands for one instruction from the kinds in kasm.instruction_table, using `index` to vary them.
+# Jumps go to the label `target`, memory instructions use one of the variables
+def make_operands(kinds, index, target, variables):
+    operands = []
+    for position, kind in enumerate(kinds):
+        if kind == "register":
+            operands.append(f"R{(index + position * 5) % 16}")
+        elif kind == "number":
+            operands.append(str(index % 16) if position == 1 and len(operands) == 1 else str(index * 7 % 1000))
+        elif variables and position == 1:
+            operands.append(variables[index % len(variables)])
+        else:
+            operands.append(target)
+    return operands
+
+
+# Builds a program of roughly `words` words that uses every instruction, so every encoder is timed. A label
+# goes in every 16 instructions and the jumps go to the next one, so most names are forward references
+def generate_mix(words):
+    names = list(kasm.instruction_table)
+    variables = [f"v{index}" for index in range(8)]
+    lines = [".data"] + [f"{name} {index}" for index, name in enumerate(variables)] + [".code"]
+    count = 4 * len(variables)
+    index = 0
+    while count < words:
+        if index % 16 == 0:
+            lines.append(f"L{index // 16}:")
+        name = names[index % len(names)]
+        opcode, encoder, operand_count, kinds = kasm.instruction_table[name]
+        operands = make_operands(kinds, index, f"L{index // 16 + 1}", variables)
+        lines.append(f"{name} {', '.join(operands)}".strip())
+        count += 2 if name in kasm.two_word_instructions else 1
+        index += 1
+    lines.append(f"L{index // 16 + 1}:")
+    return "\n".join(lines) + "\n"
+
+
+# Builds a program of roughly `words` words where every instruction has a label and jumps to a label far
+# ahead of it, so nearly every word needs a fix-up at the end
+def generate_labels(words):
+    lines = [".code"]
+    for index in range(words):
+        lines.append(f"LABEL_{index}:")
+        lines.append(f"JNZ LABEL_{min(index + words // 2, words - 1)}" if index % 2 else f"JMP LABEL_{words - 1 - index}")
+    return "\n".join(lines) + "\n"
+
+
+# Builds a program with about `words` words of data memory, as single variables, arrays and strings,
+# and code that reads every variable back
+def generate_data(words):
+    lines = [".data"]
+    names = []
+    count = 0
+    index = 0
+    while count < words:
+        name = f"d{index}"
+        kind = index % 4
+        if kind == 0 or count + 16 > words:
+            lines.append(f"{name} {index}")
+            count += 1
+        elif kind == 1:
+            lines.append(f"{name}[8] " + ", ".join(str(value) for value in range(index, index + 5)))
+            count += 8
+        elif kind == 2:
+            lines.append(f'{name} "string {index:05}"')
+            count += 13
+        else:
+            lines.append(f"{name}[] 1 2 3 4")
+            count += 4
+        names.append(name)
+        index += 1
+    lines.append(".code")
+    lines += [f"LOADM R1, {name}" for name in names[:256]]
+    return "\n".join(lines) + "\n"
+
+
+# The programs to time, as (suite, case name, source, assembler options). The mix, labels and data suites are
+# as big as the default memory sizes allow. scale grows past them with a bigger instruction memory, to show
+# how the time grows with the program
+def benchmark_cases(suites):
+    cases = []
+    if "scale" in suites:
+        sizes = [256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+        for words in sizes:
+            cases.append(("scale", f"scale-{words}", generate_program(words),
+                          {"instruction_memory_size": sizes[-1] + 16}))
+    if "mix" in suites:
+        for words in (512, kasm.instruction_memory_size - 16):
+            cases.append(("mix", f"mix-{words}", generate_mix(words), {}))
+            cases.append(("mix", f"mix-{words}-O", generate_mix(words), {"optimize": True}))
+    if "labels" in suites:
+        for words in (512, kasm.instruction_memory_size - 1):
+            cases.append(("labels", f"labels-{words}", generate_labels(words), {}))
+    if "data" in suites:
+        cases.append(("data", "data-400", generate_data(400), {}))
+        cases.append(("data", f"data-{kasm.data_memory_size}-image", generate_data(kasm.data_memory_size),
+                      {"data_image": True}))
+    return cases
+
+
+# Times one program. The total is the best of at least `repeat` runs of the plain assembler, run for at least
+# min_seconds, and the reference is the best of reference_work timed after each run. The phases are the best of
+# `repeat` runs of the profiling assembler, which is a little slower since it reads the clock so often
+def time_case(source, options, repeat, directory, min_seconds=min_case_seconds):
+    # One untimed run first, so costs paid once per process (like -O importing kopt) don't land in the first case
+    kasm.Assembler(**options).assemble(source)
+    times = []
+    reference = None
+    while len(times) < repeat or sum(times) < min_seconds:
+        assembler = kasm.Assembler(**options)
+        start = time.perf_counter()
+        words = assembler.assemble(source)
+        times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        reference_work()
+        elapsed = time.perf_counter() - start
+        reference = elapsed if reference is None else min(reference, elapsed)
+    best = min(times)
+
+    phases = None
+    for _ in range(repeat):
+        assembler = kasm.ProfilingAssembler(**options)
+        assembler.assemble(source)
+        start = time.perf_counter()
+        kasm.write_outputs(os.path.join(directory, "bench"), tuple(kasm.output_formats), assembler.words,
+                           assembler.data, assembler.data_image)
+        seconds = dict(assembler.profile["seconds"], output=time.perf_counter() - start)
+        phases = seconds if phases is None else {name: min(phases[name], seconds[name]) for name in seconds}
+    return {
+        "words": len(words),
+        "lines": assembler.profile["counts"]["lines"],
+        "seconds": best,
+        "reference": reference,
+        "us_per_word": best / max(len(words), 1) * 1e6,
+        "phases": phases,
+        "counts": assembler.profile["counts"],
+    }
+
+
+# How long a case took in the baseline, scaled by how much faster or slower the machine is now going by the
+# reference work. Baselines from before the reference was recorded are used as they are
+def expected_seconds(result, before):
+    if "reference" not in before:
+        return before["seconds"]
+    return before["seconds"] * result["reference"] / before["reference"]
+
+
+# Whether result is slower than before, the same case in the baseline: by more than threshold, and by at
+# least min_delta seconds, so a sub-millisecond case can't count as slower from noise alone
+def is_slower(result, before, threshold, min_delta):
+    expected = expected_seconds(result, before)
+    return result["seconds"] / expected - 1 > threshold and result["seconds"] - expected >= min_delta
+
+
+# Runs every case and returns the results in the same layout the baseline file uses. With a baseline, a case
+# that looks slower than it is timed again up to retries more times and the fastest try counts, since the
+# machine can be slower for a few seconds at a time and every case timed in that window would look slower
+def run_benchmarks(suites, repeat, baseline=None, threshold=0, min_delta=0, retries=0):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for suite, name, source, options in benchmark_cases(suites):
+            result = time_case(source, options, repeat, directory)
+            before = baseline["results"].get(name) if baseline else None
+            tries = 0
+            while before and tries < retries and is_slower(result, before, threshold, min_delta):
+                again = time_case(source, options, repeat, directory, min_retry_seconds)
+                if again["seconds"] < result["seconds"]:
+                    result = again
+                tries += 1
+            results[name] = result
+    return {
+        "isa": kasm.isa_version,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def print_results(report):
+    phase_names = ["read", "parse", "allocate", "optimize", "resolve", "output"]
+    print(f"{'case':<18} {'words':>6} {'ms':>8} {'us/word':>8}  " + " ".join(f"{name:>8}" for name in phase_names))
+    for name, result in report["results"].items():
+        phases = " ".join(f"{result['phases'][phase] * 1000:8.2f}" for phase in phase_names)
+        print(f"{name:<18} {result['words']:>6} {result['seconds'] * 1000:8.2f} {result['us_per_word']:8.2f}  {phases}")
+
+
+# Prints how every case compares with the baseline, and returns how many got slower (see is_slower). The
+# change is against the baseline time scaled by the reference work, so it can differ from the two times shown
+def compare(report, baseline, threshold, min_delta):
+    if baseline.get("isa") != report["isa"]:
+        print("note: the baseline was recorded with a different instruction set")
+    slower = 0
+    print(f"{'case':<18} {'baseline ms':>12} {'now ms':>8} {'change':>8}")
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]
+        change = result["seconds"] / expected_seconds(result, before) - 1
+        flag = ""
+        if is_slower(result, before, threshold, min_delta):
+            flag = "  SLOWER"
+            slower += 1
+        print(f"{name:<18} {before['seconds'] * 1000:12.2f} {result['seconds'] * 1000:8.2f} {change:+8.1%}{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="kbench.py", description="Benchmarks the KASM assembler.")
+    parser.add_argument("--suite", action="append", choices=["scale", "mix", "labels", "data"],
+                        help="suites to run, can be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="least runs of each case, the best one counts. Small cases "
+                        "are run more times, for at least 0.2 seconds")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON, to use as a baseline later")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=default_baseline,
+                        help="compare with a saved baseline (default: kbench_baseline.json) and exit with 1 if "
+                             "anything got slower than the threshold")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="how much slower a case can get before it counts as a regression (default: 0.25)")
+    parser.add_argument("--min-delta", type=float, default=0.2,
+                        help="least number of milliseconds slower a case has to get to count as a regression, "
+                             "on top of the threshold (default: 0.2)")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="times a case that looks slower than the baseline is timed again before it counts "
+                             "as a regression (default: 5)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    report = run_benchmarks(args.suite or ["scale", "mix", "labels", "data"], args.repeat, baseline,
+                            args.threshold, args.min_delta / 1000, args.retries)
+    print_results(report)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    if baseline:
+        print()
+        return 1 if compare(report, baseline, args.threshold, args.min_delta / 1000) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#     KASM Builder
+#     Builds a K86 program from Python calls instead of KASM text, for compilers that generate code in-process.
+#
+#     b = Builder()
+#     b.data("count", 10)
+#     b.loadm(R1, "count")
+#     b.label("LOOP")
+#     b.subi(R1, 1)
+#     b.jnz("LOOP")
+#     b.halt()
+#     words = b.build()
+
+import keyword
+
+import kasm
+
+# Register operands, the same names KASM uses
+(R0, R1, R2, R3, R4, R5, R6, R7, R8, R9, R10, R11, R12, R13, R14, R15) = tuple(kasm.registers)
+
+
+# Gives an Assembler its program one call at a time. Each call is handled like a line of source in the .code
+# section, with the same encoders, checks and errors, so a program built here gives the same words as the same
+# program written as text. The line number in an error is the number of the call, counting from 1
+class Builder:
+    def __init__(self, instruction_memory_size=kasm.instruction_memory_size, data_memory_size=kasm.data_memory_size,
+                 optimize=False, data_image=False):
+        self.assembler = kasm.Assembler(instruction_memory_size, data_memory_size, optimize, data_image)
+        self.assembler.mode = 2
+        self.built = False
+
+    # Address of a label or variable, or None if there isn't one with that name
+    def address(self, name):
+        assembler = self.assembler
+        return assembler.subprocess_names.get(name, assembler.user_defined_tokens.get(name))
+
+    # Starting contents of data memory, only used with data_image
+    def data_memory(self):
+        return self.assembler.data
+
+    # Marks the address of the next instruction with a label, and returns the address
+    def label(self, name):
+        assembler = self.next_call()
+        if not isinstance(name, str):
+            assembler.fail(f"Invalid format at line {assembler.linenumber}.")
+        if name in kasm.k86_tokens or name in kasm.registers:
+            assembler.fail(f"Error at line {assembler.linenumber}:  Provided token is a K86 token.")
+        assembler.subprocess_names[name] = assembler.next_instr_addr
+        return assembler.next_instr_addr
+
+    # Declares a variable, the same as a line of the .data section: data("x", 5) is "x 5", data("table", 1, 2, 3)
+    # is "table[] 1 2 3", data("buffer", size=16) is "buffer[16]" and data("message", "hi") is 'message "hi"'.
+    # Without a data image, the code that sets the variable up goes where the call is, so like a .data section
+    # it's best at the start. Returns the variable's address
+    def data(self, name, *values, size=None):
+        assembler = self.next_call()
+        if not isinstance(name, str):
+            assembler.fail(f"Invalid format at line {assembler.linenumber}.")
+        if name in kasm.k86_tokens or name in kasm.registers:
+            assembler.fail(f"Error at line {assembler.linenumber}:  Provided token is a K86 token.")
+        if name in assembler.user_defined_tokens:
+            assembler.fail(f"Error at line {assembler.linenumber}:  Duplicate token.")
+        if len(values) == 1 and isinstance(values[0], str):
+            values = [ord(char) for char in values[0]] + [0]
+        else:
+            values = [0 if value is None else value for value in values]
+            for value in values:
+                if not isinstance(value, int):
+                    assembler.fail(f"Invalid value format: {value!r}")
+                assembler.check_range(value, 16, signed=True)
+        if size is not None:
+            if not isinstance(size, int) or size < 1:
+                assembler.fail(f"Error at line {assembler.linenumber}: Invalid array size.")
+            if len(values) > size:
+                assembler.fail(f"Error at line {assembler.linenumber}: Array has more than {size} values.")
+            values += [0] * (size - len(values))
+        if not values:
+            assembler.fail(f"Error at line {assembler.linenumber}: Array needs a size or a list of values.")
+        assembler.memalloc(name, values)
+        return assembler.user_defined_tokens[name]
+
+    # Puts words into the program as they are, the same as .word
+    def word(self, *values):
+        assembler = self.next_call()
+        for value in values:
+            if not isinstance(value, (int, str)):
+                assembler.fail(f"Invalid value format: {value!r}")
+        address = assembler.next_instr_addr
+        assembler.raw_words(values)
+        return address
+
+    # Adds any instruction by its mnemonic: instruction("ADDI", R1, 5) is the same as addi(R1, 5). Registers are
+    # their names, numbers are ints, and addresses are label or variable names (with an optional +offset, like
+    # "table+3") or ints. Returns the address of the instruction
+    def instruction(self, mnemonic, *operands):
+        assembler = self.next_call()
+        entry = kasm.instruction_table.get(mnemonic)
+        if entry is None:
+            assembler.fail(f"Unexpected token at line {assembler.linenumber}")
+        opcode, encoder, count, kinds = entry
+        if len(operands) != count:
+            assembler.fail(f"Error at line {assembler.linenumber}: Invalid instruction syntax.")
+        for kind, operand in zip(kinds, operands):
+            if not isinstance(operand, (int, str)):
+                assembler.fail(f"Invalid format at line {assembler.linenumber}.")
+            if kind == "address" and isinstance(operand, int):
+                assembler.check_range(operand, 12)
+        address = assembler.next_instr_addr
+        encoder(assembler, mnemonic, *operands)
+        return address
+
+    # Resolves the names, adds a HALT if there isn't one, and returns the words. Building again returns the
+    # same words
+    def build(self):
+        assembler = self.assembler
+        if not self.built:
+            if assembler.optimize:
+                assembler.run_optimizer()
+            assembler.resolve()
+            self.built = True
+        return assembler.words
+
+    # Writes the program in any of kasm.py's output formats, base is the file name without the extension
+    def write(self, base, formats=("bin",)):
+        assembler = self.assembler
+        kasm.write_outputs(base, formats, self.build(), assembler.data, assembler.data_image)
+
+    # Counts a call as the next line, and returns the assembler. Nothing can be added once the program is built
+    def next_call(self):
+        if self.built:
+            raise kasm.KasmError("The program is already built")
+        self.assembler.linenumber += 1
+        return self.assembler
+
+
+# Makes the method for one mnemonic, so b.addi(R1, 5) is b.instruction("ADDI", R1, 5)
+def instruction_method(mnemonic):
+    def method(self, *operands):
+        return self.instruction(mnemonic, *operands)
+    method.__name__ = method_name(mnemonic)
+    return method
+
+
+# Method name for a mnemonic: the mnemonic in lower case, with a _ after it if it's a Python keyword (and_, or_
+# and not_)
+def method_name(mnemonic):
+    name = mnemonic.lower()
+    return name + "_" if keyword.iskeyword(name) else name
+
+
+for _mnemonic in kasm.instruction_table:
+    setattr(Builder, method_name(_mnemonic), instruction_method(_mnemonic))
@@ -0,0 +1,350 @@
+#     K86 Cycle Analyzer
+#     Works out what a program costs in cycles without running it: every basic block, every loop and the longest path
+
+import argparse
+import json
+import os
+import sys
+
+import kasm
+import ksim
+from ksim import JMP, JNP, SKIPZ, SKIPNP, PUSHPC, RET, HALT, ILLEGAL
+
+
+# A straight run of instructions that is only ever entered at the top and left at the bottom
+class Block:
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+        self.end = address  # address just after the last instruction
+        self.instructions = 0
+        self.cycles = 0
+        self.successors = []  # addresses of the blocks that can run next
+        self.call = None  # address of the subroutine called by a PUSHPC and jump at the end of the block
+        self.falls_off = False  # can run past the end of the program
+
+
+# Decodes the words into (address, instruction number, first field, length in words) for every instruction
+def decode(words):
+    instructions = []
+    address = 0
+    while address < len(words):
+        number, first, second, size = ksim.decode_table[words[address]]
+        if number == ILLEGAL and words[address] >> 12 == 0:
+            number = ksim.NOP  # the all zeros opcode acts as a NOP
+        instructions.append((address, number, first, size))
+        address += size
+    return instructions
+
+
+# Splits the program into basic blocks and works out where each one can go next. labels is name -> address
+# and names the blocks, any other block is named after its address. Returns address -> Block
+def build_blocks(words, labels):
+    instructions = decode(words)
+    sizes = {address: size for address, number, first, size in instructions}
+    names = {}
+    for name, address in sorted(labels.items(), key=lambda item: item[1], reverse=True):
+        names[address] = name
+
+    # A block starts at the entry, at every label and jump target, after every jump, skip or end of flow,
+    # and after the instruction a skip can skip
+    leaders = {0} | {address for address in labels.values() if address in sizes}
+    for address, number, first, size in instructions:
+        after = address + size
+        if number <= JNP:
+            leaders.add(after)
+            if first in sizes:
+                leaders.add(first)
+        elif SKIPZ <= number <= SKIPNP:
+            leaders.add(after)
+            leaders.add(after + sizes.get(after, 1))
+        elif number in (RET, HALT, ILLEGAL):
+            leaders.add(after)
+
+    blocks = {}
+    block = None
+    previous = None
+    for address, number, first, size in instructions:
+        if address in leaders:
+            block = blocks[address] = Block(address, names.get(address, f"L_{address:04X}"))
+        block.end = address + size
+        block.instructions += 1
+        block.cycles += ksim.cycle_costs[number]
+        if number <= JNP:
+            # PUSHPC then a jump is a call, which comes back to the address after the jump
+            if previous == PUSHPC:
+                block.call = first
+                block.successors = [block.end]
+            elif number == JMP:
+                block.successors = [first]
+            else:
+                block.successors = [first, block.end]
+        elif SKIPZ <= number <= SKIPNP:
+            block.successors = [block.end, block.end + sizes.get(block.end, 1)]
+        elif number in (RET, HALT, ILLEGAL):
+            block.successors = []
+        else:
+            block.successors = [block.end]
+        previous = number
+
+    for block in blocks.values():
+        if any(successor not in blocks for successor in block.successors):
+            block.falls_off = True
+            block.successors = [successor for successor in block.successors if successor in blocks]
+        block.successors = list(dict.fromkeys(block.successors))
+    return blocks
+
+
+# Finds the blocks of one function, everything reachable from its entry without following calls, and the edges
+# that go back to a block still being searched (the back edges of the loops). Returns the blocks in an order where
+# every block comes before the blocks it leads to once back edges are ignored, and the set of back edges
+def search_function(blocks, entry):
+    order = []
+    back_edges = set()
+    state = {entry: 1}  # 1 while a block's successors are being searched, 2 once they're done
+    stack = [(entry, iter(blocks[entry].successors))]
+    while stack:
+        address, successors = stack[-1]
+        for successor in successors:
+            if state.get(successor) == 1:
+                back_edges.add((address, successor))
+            elif successor not in state:
+                state[successor] = 1
+                stack.append((successor, iter(blocks[successor].successors)))
+                break
+        else:
+            state[address] = 2
+            order.append(address)
+            stack.pop()
+    order.reverse()
+    return order, back_edges
+
+
+# Everything about one function (the program itself, or a subroutine called with PUSHPC): its blocks, loops
+# and its longest path in cycles
+class Function:
+    def __init__(self, blocks, entry):
+        self.entry = entry
+        self.order, self.back_edges = search_function(blocks, entry)
+        self.blocks = set(self.order)
+
+
+# Analyzes a whole program. Functions are found from address 0 and every call, and each call costs the longest
+# path through the function it calls, on top of the block that makes it
+class Analysis:
+    def __init__(self, words, labels):
+        self.blocks = build_blocks(words, labels)
+        self.functions = {}
+        pending = [0] if self.blocks else []
+        while pending:
+            entry = pending.pop()
+            if entry in self.functions or entry not in self.blocks:
+                continue
+            function = self.functions[entry] = Function(self.blocks, entry)
+            pending += [self.blocks[address].call for address in function.order if self.blocks[address].call is not None]
+        self.costs = {}  # function entry -> longest path, None while it's being worked out (for recursion)
+        self.recursive = set()
+
+    # Cycles for running a block once, including the whole of any function it calls
+    def block_cost(self, address):
+        block = self.blocks[address]
+        cost = block.cycles
+        if block.call is not None and block.call in self.functions:
+            cost += self.function_cost(block.call)
+        return cost
+
+    # The longest path through a function, following every edge except the loop back edges
+    def function_cost(self, entry):
+        if entry in self.costs:
+            if self.costs[entry] is None:
+                self.recursive.add(entry)  # a recursive call is counted as free, the depth can't be known
+                return 0
+            return self.costs[entry]
+        self.costs[entry] = None
+        cost, path = self.longest_path(self.functions[entry], entry)
+        self.costs[entry] = cost
+        return cost
+
+    # Longest path through a function from the start block to any of the ends (any block at all if ends is None),
+    # staying within the given blocks. Returns (cycles, list of block addresses)
+    def longest_path(self, function, start, within=None, ends=None):
+        best = {}
+        before = {}
+        for address in function.order:
+            if within is not None and address not in within:
+                continue
+            if address == start:
+                best[address] = self.block_cost(address)
+            if address not in best:
+                continue
+            for successor in self.blocks[address].successors:
+                if (address, successor) in function.back_edges or (within is not None and successor not in within):
+                    continue
+                cost = best[address] + self.block_cost(successor)
+                if cost > best.get(successor, -1):
+                    best[successor] = cost
+                    before[successor] = address
+        candidates = [address for address in best if ends is None or address in ends]
+        if not candidates:
+            return 0, []
+        last = max(candidates, key=lambda address: best[address])
+        path = [last]
+        while path[-1] in before:
+            path.append(before[path[-1]])
+        return best[last], path[::-1]
+
+    # Shortest path from the start block to any of the ends, over the same edges as longest_path
+    def shortest_path(self, function, start, within, ends):
+        best = {start: self.block_cost(start)}
+        for address in function.order:
+            if address not in best or address not in within:
+                continue
+            for successor in self.blocks[address].successors:
+                if (address, successor) in function.back_edges or successor not in within:
+                    continue
+                cost = best[address] + self.block_cost(successor)
+                if cost < best.get(successor, cost + 1):
+                    best[successor] = cost
+        return min((best[address] for address in ends if address in best), default=0)
+
+    # Every loop, found from the back edges of each function. A loop is named after its header block, the one
+    # its back edges go to, and its body is every block that can get back to the header without leaving through
+    # it. An iteration costs a path from the header around to a back edge, with inner loops counted once
+    def loops(self):
+        found = []
+        for entry, function in self.functions.items():
+            latches = {}
+            for source, header in function.back_edges:
+                latches.setdefault(header, set()).add(source)
+            for header, sources in latches.items():
+                body = {header}
+                pending = list(sources)
+                while pending:
+                    address = pending.pop()
+                    if address in body:
+                        continue
+                    body.add(address)
+                    pending += [other for other in function.blocks
+                                if address in self.blocks[other].successors and other not in body]
+                longest, path = self.longest_path(function, header, body, sources)
+                shortest = self.shortest_path(function, header, body, sources)
+                found.append({"header": header, "function": entry, "blocks": sorted(body),
+                              "min_cycles": shortest, "max_cycles": longest, "path": path})
+
+        for loop in found:
+            loop["depth"] = sum(1 for other in found if other is not loop and other["function"] == loop["function"]
+                                and loop["header"] in other["blocks"] and set(loop["blocks"]) < set(other["blocks"]))
+        return found
+
+    def name(self, address):
+        return self.blocks[address].name if address in self.blocks else f"{address:04X}"
+
+    # Everything the analysis found, as a dictionary that can be written as JSON
+    def report(self):
+        main_cost, main_path = self.longest_path(self.functions[0], 0) if 0 in self.functions else (0, [])
+        for entry in self.functions:
+            self.function_cost(entry)
+        reachable = set().union(*(function.blocks for function in self.functions.values()))
+        return {
+            "blocks": [{"address": block.address, "name": block.name, "instructions": block.instructions,
+                        "cycles": block.cycles, "successors": [self.name(address) for address in block.successors],
+                        "calls": self.name(block.call) if block.call is not None else None,
+                        "falls_off": block.falls_off, "reachable": block.address in reachable}
+                       for block in sorted(self.blocks.values(), key=lambda block: block.address)],
+            "functions": [{"entry": entry, "name": self.name(entry), "blocks": len(function.blocks),
+                           "longest_path_cycles": self.costs[entry], "recursive": entry in self.recursive}
+                          for entry, function in sorted(self.functions.items())],
+            "loops": [dict(loop, header=self.name(loop["header"]), function=self.name(loop["function"]),
+                           blocks=[self.name(address) for address in loop["blocks"]],
+                           path=[self.name(address) for address in loop["path"]])
+                      for loop in sorted(self.loops(), key=lambda loop: -loop["max_cycles"])],
+            "longest_path": {"cycles": main_cost, "path": [self.name(address) for address in main_path]},
+        }
+
+
+# Cycle cost of every instruction, for the table printed by --costs
+def cost_table():
+    return {name: ksim.cycle_cost(name) for name in kasm.k86_tokens}
+
+
+# Reads a program and its labels. A .k86 file is assembled so its labels can name the blocks, an assembled
+# format gets them from the .map file next to it, if there is one
+def load(filename, optimize=False):
+    if filename.endswith(".k86"):
+        with open(filename, "r") as reader:
+            assembler = kasm.Assembler(optimize=optimize)
+            words = assembler.assemble(reader.read())
+        return words, assembler.subprocess_names
+    labels = {}
+    map_path = os.path.splitext(filename)[0] + ".map"
+    if os.path.exists(map_path):
+        symbols, lines = kasm.read_map(map_path)
+        labels = {name: address for name, (address, kind, size) in symbols.items() if kind == "label"}
+    return kasm.read_words(filename), labels
+
+
+def print_report(report):
+    print(f"{'block':<20} {'address':>7} {'instrs':>6} {'cycles':>6}  next")
+    for block in report["blocks"]:
+        following = ", ".join(block["successors"])
+        if block["calls"]:
+            following = f"call {block['calls']}, then {following}"
+        if block["falls_off"]:
+            following += " (runs off the end)"
+        if not block["reachable"]:
+            following += " (never runs)"
+        print(f"{block['name']:<20} {block['address']:>7X} {block['instructions']:>6} {block['cycles']:>6}  {following}")
+
+    print()
+    print(f"{'function':<20} {'blocks':>6} {'longest path':>13}")
+    for function in report["functions"]:
+        note = "  (recursive, calls to itself counted as 0)" if function["recursive"] else ""
+        print(f"{function['name']:<20} {function['blocks']:>6} {function['longest_path_cycles']:>13}{note}")
+
+    print()
+    if report["loops"]:
+        print(f"{'loop':<20} {'in':<20} {'depth':>5} {'blocks':>6} {'cycles per iteration':>21}")
+        for loop in report["loops"]:
+            cycles = f"{loop['min_cycles']}" if loop["min_cycles"] == loop["max_cycles"] \
+                else f"{loop['min_cycles']}-{loop['max_cycles']}"
+            print(f"{loop['header']:<20} {loop['function']:<20} {loop['depth']:>5} {len(loop['blocks']):>6} {cycles:>21}")
+    else:
+        print("No loops")
+
+    print()
+    path = report["longest_path"]
+    print(f"Longest path without repeating a loop: {path['cycles']} cycles, {' -> '.join(path['path'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="kcycles.py",
+                                     description="Works out the cycle cost of a K86 program's blocks, loops and paths.")
+    parser.add_argument("filename", nargs="?", help="a .k86 file or an assembled image")
+    parser.add_argument("-O", "--optimize", action="store_true", help="analyze the program as kasm.py -O builds it")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--costs", action="store_true", help="print the cycle cost of every instruction")
+    args = parser.parse_args()
+
+    if args.costs:
+        for name, cost in cost_table().items():
+            words = 2 if name in kasm.two_word_instructions else 1
+            print(f"{name:<8} {words} word{'s' if words == 2 else ' '}  {cost} cycles")
+        if not args.filename:
+            return
+    if not args.filename:
+        parser.error("a file name is needed")
+    try:
+        words, labels = load(args.filename, args.optimize)
+    except kasm.KasmError as error:
+        sys.exit(error.message)
+    except OSError as error:
+        sys.exit(f"{error.strerror}: {args.filename}")
+    report = Analysis(words, labels).report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#     KASM Disassembler
+#     Turns K86 machine words (.bin, .img, .hex, .dp, or a memory dump) back into KASM that assembles to the same words
+
+import argparse
+import os
+import sys
+
+import kasm
+import ksim
+
+# What the rest of an instruction looks like after its first word
+PLAIN = 0  # nothing, the text is the whole instruction
+JUMP = 1  # a 12-bit address in the low bits of the word
+IMMEDIATE = 2  # a number in the second word
+MEMORY = 3  # an address in the second word
+RAW = 4  # not an instruction, written as .word
+
+# Register name for each register number
+register_names = {number: name for name, number in kasm.register_numbers.items()}
+
+# Most illegal words in a row that go on one .word line
+raw_per_line = 8
+
+
+# Builds the text table, one entry for every possible 16-bit word, made from ksim.decode_table so it agrees
+# with the simulator. Each entry is (kind, text), where the text is the whole instruction for PLAIN words and
+# everything before the operand that needs the rest of the program (a label or the second word) otherwise
+def build_text_table():
+    table = [None] * 65536
+    for word in range(65536):
+        number, first, second, size = ksim.decode_table[word]
+        if number == ksim.ILLEGAL:
+            table[word] = (RAW, f"0x{word:04X}")
+            continue
+        name = ksim.mnemonics[number]
+        kinds = kasm.instruction_table[name][3]
+        if name in ksim.jump_family:
+            table[word] = (JUMP, name)
+        elif size == 2:
+            table[word] = (IMMEDIATE if kinds[1] == "number" else MEMORY, f"{name} {register_names[first]}, ")
+        elif kinds == ("register", "number"):
+            table[word] = (PLAIN, f"{name} {register_names[first]}, {second}")
+        elif len(kinds) == 2:
+            table[word] = (PLAIN, f"{name} {register_names[first]}, {register_names[second]}")
+        elif len(kinds) == 1:
+            table[word] = (PLAIN, f"{name} {register_names[first]}")
+        else:
+            table[word] = (PLAIN, name)
+    return table
+
+
+text_table = build_text_table()
+
+# Number of words for every possible first word, and whether it's a jump, as bytes for the first pass
+size_table = bytes(entry[3] for entry in ksim.decode_table)
+jump_table = bytes(entry[0] == JUMP for entry in text_table)
+
+
+# Finds where every instruction starts, and which of those a jump goes to
+def scan(words):
+    starts = bytearray(len(words) + 1)
+    targets = set()
+    sizes = size_table
+    jumps = jump_table
+    count = len(words)
+    address = 0
+    while address < count:
+        word = words[address]
+        starts[address] = 1
+        if jumps[word]:
+            targets.add(word & kasm.ADDRESS_FIELD)
+        address += sizes[word]
+    starts[count] = 1  # a label can go after the last instruction
+    return starts, targets
+
+
+# Names every address that gets a label: the labels from a .map if there is one, and a made up L_ name for
+# every other jump target. A target in the middle of an instruction can't have a label, so it stays a number
+def name_labels(starts, targets, labels=None):
+    names = {}
+    for name, address in (labels or {}).items():
+        if address < len(starts) and starts[address] and address not in names:
+            names[address] = name
+    used = set(names.values())
+    for address in sorted(targets):
+        if address < len(starts) and starts[address] and address not in names:
+            name = f"L_{address:04X}"
+            while name in used:
+                name += "_"
+            names[address] = name
+    return names
+
+
+# Names for the addresses memory operands can use, like "table+2" for the third word of table.
+# variables is name -> (address, size) and labels_at is address -> label
+def operand_names(variables, labels_at):
+    names = {}
+    for name, (start, size) in variables.items():
+        names[start] = name
+        for offset in range(1, size):
+            names.setdefault(start + offset, f"{name}+{offset}")
+    names.update(labels_at)
+    return names
+
+
+# Writes the .data section for a data image: the variables from a .map where there are some, and arrays named
+# after their address for any words they don't cover. Variables are declared in address order, so every one
+# ends up where it was
+def data_lines(data, variables, data_address):
+    lines = [".data"]
+    covered = {}
+    for name, (start, size) in variables.items():
+        if size > 0:
+            covered[start - data_address] = (name, size)
+    offset = 0
+    while offset < len(data):
+        if offset in covered and offset + covered[offset][1] <= len(data):
+            name, size = covered[offset]
+        else:
+            name = f"d_{data_address + offset:04X}"
+            size = 1
+            while offset + size < len(data) and size < 16 and offset + size not in covered:
+                size += 1
+        values = list(data[offset:offset + size])
+        while len(values) > 1 and values[-1] == 0:
+            values.pop()
+        if size == 1:
+            lines.append(f"{name} {values[0]}")
+        else:
+            lines.append(f"{name}[{size}] {', '.join(str(value) for value in values)}")
+        offset += size
+    lines.append("")
+    return lines
+
+
+# Disassembles the words, one line of KASM at a time. labels and variables come from a .map (name -> address,
+# and name -> (address, size)). Variable names are only used for memory operands when there's a data image,
+# since that's when the .data section declares them, otherwise they're a comment. With addresses, every line
+# ends with a comment of its address and words, for comparing against a memory dump. Words without a HALT get
+# .nohalt, so the assembler doesn't add one at the end
+def disassemble(words, labels=None, variables=None, data=(), addresses=False,
+                data_address=kasm.instruction_memory_size):
+    starts, targets = scan(words)
+    names = name_labels(starts, targets, labels)
+    variables = variables or {}
+    operands = operand_names(variables if data else {}, names)
+    comments = operand_names(variables, {}) if not data else {}
+    if data:
+        yield from data_lines(data, variables, data_address)
+    yield ".code"
+    if not kasm.has_halt(words):
+        yield ".nohalt"
+
+    table = text_table
+    count = len(words)
+    address = 0
+    raw = []
+    while address < count:
+        if address in names:
+            if raw:
+                yield f"    .word {', '.join(raw)}"
+                raw = []
+            yield f"{names[address]}:"
+        word = words[address]
+        kind, text = table[word]
+
+        # Most instructions are one word with nothing to look up
+        if kind == PLAIN and not raw and not addresses:
+            yield "    " + text
+            address += 1
+            continue
+
+        size = 1
+        comment = ""
+        if kind == PLAIN:
+            line = text
+        elif kind == JUMP:
+            target = word & kasm.ADDRESS_FIELD
+            line = f"{text} {names[target]}" if target in names else f"{text} 0x{target:03X}"
+        elif kind == RAW or address + 1 >= count:
+            line = None
+            if kind != RAW:
+                comment = " # the second word is missing"
+        else:
+            size = 2
+            operand = words[address + 1]
+            if kind == IMMEDIATE:
+                line = f"{text}{ksim.to_signed(operand)}"
+            elif operand > kasm.ADDRESS_FIELD:
+                line = None  # the assembler can't make an address this big, so the words are written as they are
+            elif operand in operands:
+                line = text + operands[operand]
+            else:
+                line = f"{text}0x{operand:03X}"
+                if operand in comments:
+                    comment = f" # {comments[operand]}"
+
+        if line is None:
+            raw.extend(f"0x{value:04X}" for value in words[address:address + size])
+            if len(raw) >= raw_per_line or addresses or comment:
+                if addresses:
+                    comment = f"{comment} # {address:04X}"
+                yield f"    .word {', '.join(raw)}{comment}"
+                raw = []
+            address += size
+            continue
+        if raw:
+            yield f"    .word {', '.join(raw)}"
+            raw = []
+        if addresses:
+            comment += f" # {address:04X}: " + " ".join(f"{value:04X}" for value in words[address:address + size])
+        yield f"    {line}{comment}"
+        address += size
+    if raw:
+        yield f"    .word {', '.join(raw)}"
+    if count in names:
+        yield f"{names[count]}:"
+
+
+# Reads a program, its data image and the labels and variables of the .map next to it, if there is one
+def load(filename, map_path=None):
+    words = kasm.read_words(filename)
+    data = kasm.read_data(filename)
+    labels = {}
+    variables = {}
+    map_path = map_path or os.path.splitext(filename)[0] + ".map"
+    if os.path.exists(map_path):
+        symbols, lines = kasm.read_map(map_path)
+        for name, (address, kind, size) in symbols.items():
+            if kind == "label":
+                labels[name] = address
+            else:
+                variables[name] = (address, size)
+    return words, data, labels, variables
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="kdis.py", description="Disassembles K86 machine words back into KASM.")
+    parser.add_argument("filename", help="a .bin, .img, .hex or .dp file")
+    parser.add_argument("-o", "--output", help="file to write the KASM to (default: stdout)")
+    parser.add_argument("--map", help="symbol map to take names from (default: the .map next to the input)")
+    parser.add_argument("-a", "--addresses", action="store_true",
+                        help="end every line with its address and words, for comparing against a memory dump")
+    parser.add_argument("--trim", action="store_true",
+                        help="leave out the zero words at the end, like the unused part of a memory dump")
+    args = parser.parse_args()
+
+    try:
+        words, data, labels, variables = load(args.filename, args.map)
+    except (OSError, ValueError) as error:
+        sys.exit(f"{args.filename}: {error}")
+    if args.trim:
+        end = len(words)
+        while end > 0 and words[end - 1] == 0:
+            end -= 1
+        del words[end:]
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        output.write(f"# Disassembled from {os.path.basename(args.filename)} by kdis.py, {len(words)} words\n")
+        if data:
+            output.write("# The .data section is a data image, assemble this with kasm.py -D to get the same words\n")
+        output.writelines(line + "\n" for line in disassemble(words, labels, variables, data, args.addresses))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
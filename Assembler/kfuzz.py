@@ -0,0 +1,464 @@
+#     KASM Fuzzer
+#     Assembles random programs made from the instruction table, and checks the words against an encoding worked
+#     out separately, and against a disassemble and reassemble round trip. Failing programs are shrunk and saved
+#     as .k86 files that can be replayed
+
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import kasm
+import kdis
+
+# Names the programs use. Labels and variables come from small pools so jumps and loads hit them often
+label_pool = [f"L{index}" for index in range(8)]
+variable_pool = [f"v{index}" for index in range(6)]
+mnemonic_pool = list(kasm.instruction_table)
+
+# Programs checked by each job sent to a worker
+batch_size = 1000
+
+# Fraction of programs with .nohalt
+nohalt_rate = 0.1
+
+# How the programs are written, each one picks a random style for every line
+separators = [", ", ",", " ", " , ", ",\t"]
+indents = ["", "    ", "\t", "  "]
+
+
+# One line of a generated program, as (kind, text, payload, invalid). The kinds are
+#   "data"   a .data declaration, the payload is (name, values)
+#   "label"  a label, the payload is its name
+#   "instr"  an instruction, the payload is (mnemonic, operands), see write_operand() for the operands
+#   "raw"    a .word line, the payload is the values
+#   "nohalt" the .nohalt directive, there's no payload
+# invalid is True for a line the assembler has to reject, made by mutate()
+def item(kind, text, payload, invalid=False):
+    return (kind, text, payload, invalid)
+
+
+# Writes a number in a random but valid way: decimal or hex, in either case
+def write_number(rng, value):
+    style = rng.randrange(4)
+    if style == 0 or value < 0:
+        return str(value)
+    if style == 1:
+        return f"0x{value:X}"
+    if style == 2:
+        return f"0x{value:x}"
+    return f"0X{value:X}"
+
+
+# Writes one operand. Operands are ("reg", number), ("num", value), ("label", name), ("var", name, offset)
+# or ("addr", value)
+def write_operand(rng, operand):
+    kind = operand[0]
+    if kind == "reg":
+        return f"R{operand[1]}"
+    if kind == "label":
+        return operand[1]
+    if kind == "var":
+        return operand[1] if operand[2] == 0 and rng.random() < 0.7 else f"{operand[1]}+{operand[2]}"
+    return write_number(rng, operand[1])
+
+
+# Makes up the operands of one instruction. variables is name -> size
+def make_operands(rng, mnemonic, variables):
+    kinds = kasm.instruction_table[mnemonic][3]
+    operands = []
+    for kind in kinds:
+        if kind == "register":
+            operands.append(("reg", rng.randrange(16)))
+        elif kind == "number" and mnemonic in kasm.shift_instructions:
+            operands.append(("num", rng.randrange(16)))
+        elif kind == "number":
+            operands.append(("num", rng.choice([rng.randrange(-32768, 65536), rng.randrange(-8, 16), -1, 65535])))
+        elif mnemonic in kasm.two_word_memory_instructions and variables and rng.random() < 0.8:
+            name = rng.choice(list(variables))
+            operands.append(("var", name, rng.randrange(variables[name])))
+        elif mnemonic not in kasm.two_word_memory_instructions and rng.random() < 0.8:
+            operands.append(("label", rng.choice(label_pool)))
+        else:
+            operands.append(("addr", rng.randrange(4096)))
+    return operands
+
+
+def instruction_text(rng, mnemonic, operands):
+    text = mnemonic
+    if operands:
+        text += " " + rng.choice(separators).join(write_operand(rng, operand) for operand in operands)
+    return text
+
+
+# Makes a random valid program as a list of items
+def generate(rng):
+    items = []
+    variables = {}
+    for name in rng.sample(variable_pool, rng.randrange(len(variable_pool) + 1)):
+        style = rng.randrange(4)
+        if style == 0:
+            values = [rng.randrange(-32768, 65536)]
+            text = f"{name} {write_number(rng, values[0])}"
+        elif style == 1:
+            size = rng.randrange(1, 6)
+            values = [rng.randrange(-100, 100) for _ in range(rng.randrange(size + 1))]
+            text = f"{name}[{size}] " + rng.choice(separators).join(str(value) for value in values)
+            values += [0] * (size - len(values))
+        elif style == 2:
+            values = [rng.randrange(-100, 100) for _ in range(rng.randrange(1, 5))]
+            text = f"{name}[] " + rng.choice(separators).join(str(value) for value in values)
+        else:
+            chars = "".join(rng.choice("abc XYZ#,019") for _ in range(rng.randrange(6)))
+            values = [ord(char) for char in chars] + [0]
+            text = f'{name} "{chars}"'
+        variables[name] = len(values)
+        items.append(item("data", text, (name, values)))
+
+    defined = set()
+    for _ in range(rng.randrange(1, 40)):
+        choice = rng.random()
+        if choice < 0.15:
+            name = rng.choice(label_pool)
+            if name not in defined:
+                defined.add(name)
+                items.append(item("label", f"{name}:", name))
+            continue
+        if choice < 0.18:
+            values = [rng.randrange(-32768, 65536) for _ in range(rng.randrange(1, 4))]
+            items.append(item("raw", ".word " + ", ".join(write_number(rng, value) for value in values), values))
+            continue
+        mnemonic = rng.choice(mnemonic_pool)
+        operands = make_operands(rng, mnemonic, variables)
+        items.append(item("instr", instruction_text(rng, mnemonic, operands), (mnemonic, operands)))
+
+    # Every label that's used gets defined somewhere
+    used = {operand[1] for kind, text, payload, invalid in items if kind == "instr"
+            for operand in payload[1] if operand[0] == "label"}
+    for name in sorted(used - defined):
+        items.insert(rng.randrange(len(items) + 1), item("label", f"{name}:", name))
+    items.sort(key=lambda entry: entry[0] != "data")  # the .data section goes first, the order is kept otherwise
+    return items
+
+
+# Turns one line into a line the assembler has to reject
+def mutate(rng, entry):
+    kind, text, payload, invalid = entry
+    if kind == "data":
+        name, values = payload
+        text = rng.choice([f"{name} {rng.choice([65536, -32769, 100000])}", f"{name} 1.5", f"{name}[0]",
+                           f"{name}[2] 1 2 3", f"{name}[]", f'{name} "open', f"ADD 5", f"{name} 1 2"])
+        return item(kind, text, payload, True)
+    if kind != "instr":
+        return item(kind, text.rstrip(":") + " extra" if kind == "label" else ".word 1.5", payload, True)
+    mnemonic, operands = payload
+    kinds = kasm.instruction_table[mnemonic][3]
+    choices = ["mnemonic", "extra"]
+    if kinds:
+        choices.append("missing")
+    if "register" in kinds:
+        choices.append("register")
+    if "number" in kinds:
+        choices += ["range", "float"]
+    if "address" in kinds:
+        choices += ["address", "undefined", "offset"]
+    mutation = rng.choice(choices)
+    words = [write_operand(rng, operand) for operand in operands]
+    if mutation == "mnemonic":
+        return item(kind, " ".join([mnemonic + rng.choice(["X", "1", "_"])] + words), payload, True)
+    if mutation == "extra":
+        return item(kind, " ".join([mnemonic] + words + [rng.choice(["R1", "5", "L0"])]), payload, True)
+    if mutation == "missing":
+        return item(kind, " ".join([mnemonic] + words[:-1]), payload, True)
+    if mutation == "register":
+        position = kinds.index("register")
+        words[position] = rng.choice(["R16", "R-1", "RX", "r1", "5", "R01"])
+    elif mutation == "range":
+        position = kinds.index("number")
+        if mnemonic in kasm.shift_instructions:
+            words[position] = str(rng.choice([16, 17, 255, -1]))
+        else:
+            words[position] = str(rng.choice([65536, -32769, 1 << 20]))
+    elif mutation == "float":
+        words[kinds.index("number")] = rng.choice(["1.5", "1e3", "0x", "--1", "nan"])
+    elif mutation == "address":
+        words[kinds.index("address")] = str(rng.choice([4096, 65535, -1]))
+    elif mutation == "undefined":
+        words[kinds.index("address")] = "NOWHERE"
+    else:
+        words[kinds.index("address")] = rng.choice(["v0+", "v0+x", "v0+5000", "L0+1.5"])
+    return item(kind, " ".join([mnemonic] + words), payload, True)
+
+
+# Makes program number `index` of a run. The same seed and index always give the same program
+def make_case(seed, index, invalid_rate):
+    rng = random.Random(seed * 1000003 + index)
+    items = generate(rng)
+    if items and rng.random() < invalid_rate:
+        position = rng.randrange(len(items))
+        items[position] = mutate(rng, items[position])
+    # Some programs turn off the HALT at the end, anywhere after the .data section
+    if rng.random() < nohalt_rate:
+        start = sum(entry[0] == "data" for entry in items)
+        items.insert(rng.randrange(start, len(items) + 1), item("nohalt", ".nohalt", None))
+    return items
+
+
+# The source text of a program, in a random but repeatable style
+def source_text(items):
+    lines = []
+    if any(entry[0] == "data" for entry in items):
+        lines.append(".data")
+    code_started = False
+    for number, (kind, text, payload, invalid) in enumerate(items):
+        if kind != "data" and not code_started:
+            lines.append(".code")
+            code_started = True
+        indent = indents[number % len(indents)] if kind != "label" else ""
+        comment = "  # comment, with a comma" if number % 5 == 3 else ""
+        lines.append(indent + text + comment)
+    if not code_started:
+        lines.append(".code")
+    return "\n".join(lines) + "\n"
+
+
+# Works out the words and data image a valid program has to assemble to, without using the assembler's
+# encoders: the layout from the sizes of the items, and every word from the opcode table and the ISA fields
+def expected_output(items):
+    data = []
+    variables = {}
+    labels = {}
+    address = 0
+    for kind, text, payload, invalid in items:
+        if kind == "data":
+            variables[payload[0]] = kasm.instruction_memory_size + len(data)
+            data.extend(value & 0xFFFF for value in payload[1])
+        elif kind == "label":
+            labels[payload] = address
+        elif kind == "raw":
+            address += len(payload)
+        elif kind == "instr":
+            address += 2 if payload[0] in kasm.two_word_instructions else 1
+
+    def value_of(operand):
+        if operand[0] == "label":
+            return labels[operand[1]]
+        if operand[0] == "var":
+            return variables[operand[1]] + operand[2]
+        return operand[1]
+
+    words = []
+    halted = False
+    for kind, text, payload, invalid in items:
+        if kind == "raw":
+            words.extend(value & 0xFFFF for value in payload)
+            halted |= any(value & 0xFFFF == kasm.HALT_WORD for value in payload)
+            continue
+        if kind != "instr":
+            continue
+        mnemonic, operands = payload
+        opcode = kasm.opcodes[mnemonic]
+        values = [value_of(operand) for operand in operands]
+        bits = len(kasm.k86_tokens[mnemonic])
+        if bits == 4:
+            words.append(opcode | values[0] & kasm.ADDRESS_FIELD)
+        elif bits == 8:
+            words.append(opcode | values[0] << 4 | values[1])
+        elif mnemonic in kasm.two_word_instructions:
+            words += [opcode | values[0], values[1] & 0xFFFF]
+        elif bits == 12:
+            words.append(opcode | values[0])
+        else:
+            words.append(opcode)
+            halted |= mnemonic == "HALT"
+    if not halted and not any(entry[0] == "nohalt" for entry in items):
+        words.append(kasm.HALT_WORD)
+    return words, data
+
+
+# Assembles a program and returns a short description of what went wrong, or None if nothing did. The
+# description is the same for the same kind of failure, so a program can be shrunk while it keeps failing
+# the same way
+def check(items):
+    source = source_text(items)
+    valid = not any(entry[3] for entry in items)
+    failure = check_source(source, valid)
+    if failure is not None or not valid:
+        return failure
+    words, data = expected_output(items)
+    assembler = kasm.Assembler(data_image=True)
+    if list(assembler.assemble(source)) != words:
+        return "wrong words"
+    if list(assembler.data) != data:
+        return "wrong data"
+    return None
+
+
+# The checks that only need the source: valid programs assemble and survive a round trip through kdis.py,
+# with and without -O, and invalid ones fail with a KasmError and nothing else. Saved cases are replayed with this
+def check_source(source, valid, words=None):
+    assembler = kasm.Assembler(data_image=True)
+    try:
+        assembled = list(assembler.assemble(source))
+    except kasm.KasmError:
+        return "rejects a valid program" if valid else None
+    except Exception as error:
+        return f"crashes with {type(error).__name__}"
+    if not valid:
+        return "accepts an invalid program"
+    if words is not None and assembled != words:
+        return "wrong words"
+    failure = round_trip(assembled, list(assembler.data))
+    if failure is not None:
+        return failure
+
+    # -O images often have no HALT, which kdis.py has to keep that way with .nohalt
+    optimized = kasm.Assembler(optimize=True, data_image=True)
+    try:
+        assembled = list(optimized.assemble(source))
+    except Exception as error:
+        return f"optimized program crashes with {type(error).__name__}"
+    failure = round_trip(assembled, list(optimized.data))
+    return None if failure is None else f"optimized program {failure}"
+
+
+# Disassembles the words and assembles them again, they have to come back the same
+def round_trip(words, data):
+    text = "\n".join(kdis.disassemble(words, data=data))
+    again = kasm.Assembler(data_image=True)
+    try:
+        if list(again.assemble(text)) != words or list(again.data) != data:
+            return "round trip changes the words"
+    except Exception as error:
+        return f"round trip fails with {type(error).__name__}"
+    return None
+
+
+# Removes as many lines as it can while the program still fails the same way, first in big chunks then
+# one line at a time
+def shrink(items, failure):
+    chunk = max(len(items) // 2, 1)
+    while True:
+        index = 0
+        removed = False
+        while index < len(items):
+            candidate = items[:index] + items[index + chunk:]
+            if candidate and check(candidate) == failure:
+                items = candidate
+                removed = True
+            else:
+                index += chunk
+        if chunk == 1 and not removed:
+            return items
+        chunk = max(chunk // 2, 1)
+
+
+# Checks programs start to start + count - 1 of a run. Returns how many were checked, how many of those were
+# invalid, and the failures as (index, failure, shrunk source, expected words)
+def run_batch(seed, start, count, invalid_rate):
+    failures = []
+    invalid = 0
+    seen = set()
+    for index in range(start, start + count):
+        items = make_case(seed, index, invalid_rate)
+        invalid += any(entry[3] for entry in items)
+        try:
+            failure = check(items)
+        except Exception as error:
+            failure = f"the checker crashes with {type(error).__name__}: {error}"
+        if failure is None or failure in seen:
+            continue
+        seen.add(failure)  # one of each kind is enough from a batch
+        items = shrink(items, failure)
+        valid = not any(entry[3] for entry in items)
+        words = expected_output(items)[0] if valid else None
+        failures.append((index, failure, source_text(items), words))
+    return count, invalid, failures
+
+
+# Saves a shrunk failing program. The header says what the assembler should do with it, which is what
+# replay checks
+def save_case(directory, seed, index, failure, source, words):
+    os.makedirs(directory, exist_ok=True)
+    slug = "-".join(failure.lower().split()[:3])
+    path = os.path.join(directory, f"{slug}-{seed}-{index}.k86")
+    with open(path, "w") as file:
+        file.write(f"# kfuzz: seed {seed}, program {index}, {failure}\n")
+        file.write(f"# expect: {'ok' if words is not None else 'error'}\n")
+        if words is not None:
+            file.write("# words: " + " ".join(f"{word:04X}" for word in words) + "\n")
+        file.write(source)
+    return path
+
+
+# Checks a saved case again. Returns the failure, or None if the assembler now does what the header says
+def replay_case(path):
+    with open(path, "r") as file:
+        source = file.read()
+    valid = True
+    words = None
+    for line in source.splitlines():
+        if line.startswith("# expect:"):
+            valid = line.split(":", 1)[1].strip() == "ok"
+        elif line.startswith("# words:"):
+            words = [int(word, 16) for word in line.split(":", 1)[1].split()]
+    return check_source(source, valid, words)
+
+
+def replay(paths):
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, "*.k86"))) if os.path.isdir(path) else [path]
+    failed = 0
+    for path in files:
+        failure = replay_case(path)
+        if failure is not None:
+            failed += 1
+            print(f"{path}: {failure}")
+    print(f"replayed {len(files)} cases, {failed} failed")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="kfuzz.py", description="Fuzzes the KASM assembler with random programs.")
+    parser.add_argument("-n", "--count", type=int, default=100000, help="programs to check (default: 100000)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the run, to check the same programs again")
+    parser.add_argument("--invalid", type=float, default=0.3,
+                        help="fraction of programs with a line the assembler has to reject (default: 0.3)")
+    parser.add_argument("--save-dir", default="kfuzz_cases", help="where shrunk failing programs go")
+    parser.add_argument("--replay", nargs="+", metavar="PATH",
+                        help="check saved cases (files or directories) instead of fuzzing")
+    args = parser.parse_args()
+
+    if args.replay:
+        return replay(args.replay)
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+    print(f"seed {seed}")
+    start = time.perf_counter()
+    checked = invalid = 0
+    saved = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = [pool.submit(run_batch, seed, first, min(batch_size, args.count - first), args.invalid)
+                for first in range(0, args.count, batch_size)]
+        for job in jobs:
+            count, bad, failures = job.result()
+            checked += count
+            invalid += bad
+            for index, failure, source, words in failures:
+                if failure in saved:
+                    continue
+                saved[failure] = save_case(args.save_dir, seed, index, failure, source, words)
+                print(f"program {index}: {failure}, saved as {saved[failure]}")
+    elapsed = time.perf_counter() - start
+    print(f"checked {checked} programs ({invalid} invalid) in {elapsed:.1f}s, "
+          f"{checked / elapsed * 3600:,.0f} an hour, {len(saved)} kinds of failure")
+    return 1 if saved else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#     KASM Linker
+#     Lays out relocatable objects (kasm.py -c) in memory, resolves the names they share, and writes one program
+
+import argparse
+import os
+import sys
+from array import array
+
+import kasm
+
+
+# Raised for anything that stops the modules from being linked
+class LinkError(kasm.KasmError):
+    pass
+
+
+# Reads a module from an object file, or from a .k86 file. A .k86 file is assembled into its object first,
+# unless the object next to it is newer than the source, so only the modules that changed are assembled again
+def load_module(filename, optimize=False):
+    base, extension = os.path.splitext(filename)
+    if extension != ".k86":
+        return kasm.read_object(filename)
+    object_path = base + ".ko"
+    if os.path.exists(object_path) and os.stat(object_path).st_mtime >= os.stat(filename).st_mtime:
+        try:
+            module = kasm.read_object(object_path)
+            if module["optimized"] == optimize:
+                return module
+        except kasm.KasmError:
+            pass  # made by another version of the assembler, so it's assembled again
+    return kasm.run_object(filename, optimize)
+
+
+# Names a module uses that it doesn't define itself
+def imported_names(module):
+    return {name for _, name, _, _ in module["relocations"] if name not in module["symbols"]}
+
+
+# Works out which modules the program needs: the first one, and every module that defines a global name used by
+# a module that's needed. Returns the indexes of the needed modules in the order they were given, and the global
+# symbols as name -> (module index, section, offset)
+def select_modules(modules, names):
+    exports = {}
+    for index, module in enumerate(modules):
+        for name, (section, offset, is_global) in module["symbols"].items():
+            if not is_global:
+                continue
+            if name in exports:
+                raise LinkError(f"{name} is defined in both {names[exports[name][0]]} and {names[index]}")
+            exports[name] = (index, section, offset)
+
+    needed = {0}
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        for name in sorted(imported_names(modules[index])):
+            if name not in exports:
+                raise LinkError(f"Undefined token {name} in {names[index]}")
+            owner = exports[name][0]
+            if owner not in needed:
+                needed.add(owner)
+                pending.append(owner)
+    return sorted(needed), exports
+
+
+# Links the modules into one program, the first module is where it starts. Without data_image, code that sets
+# up every data word goes in front of the first module, the same way kasm.py sets up a single file's .data
+# section. The first module gets a HALT after its code when kasm.py would give it one, so the program doesn't
+# run on into the next module. Returns the code words, the data image, and (module index, code address, data
+# address) for each module that was kept
+def link(modules, names, data_image=False, instruction_memory_size=kasm.instruction_memory_size,
+         data_memory_size=kasm.data_memory_size):
+    needed, exports = select_modules(modules, names)
+
+    # Every module's code and data go right after the module before it
+    data_size = sum(len(modules[index]["data"]) for index in needed)
+    code_address = 0 if data_image else 4 * data_size
+    data_address = 0
+    layout = []
+    for index in needed:
+        layout.append((index, code_address, data_address))
+        code_address += len(modules[index]["code"])
+        if index == 0 and modules[index]["needs_halt"]:
+            code_address += 1  # the HALT after the first module
+        data_address += len(modules[index]["data"])
+    if code_address > instruction_memory_size:
+        raise LinkError("Out of instruction memory!")
+    if data_address > data_memory_size:
+        raise LinkError("Out of data memory!")
+    code_bases = {index: code for index, code, _ in layout}
+    data_bases = {index: instruction_memory_size + data for index, _, data in layout}
+
+    words = array('H')
+    data = array('H')
+    for index, _, _ in layout:
+        data.extend(modules[index]["data"])
+    if not data_image:
+        for offset, value in enumerate(data):
+            words.extend((kasm.opcodes["LOADI"], value, kasm.opcodes["STORE"], instruction_memory_size + offset))
+
+    for index, _, _ in layout:
+        module = modules[index]
+        code = array('H', module["code"])
+        for offset, name, mask, linenumber in module["relocations"]:
+            if name in module["symbols"]:
+                owner = index
+                section, value, _ = module["symbols"][name]
+            else:
+                owner, section, value = exports[name]
+            address = value + (code_bases[owner] if section == "code" else data_bases[owner])
+            try:
+                code[offset] = kasm.relocate(code[offset], address, mask, linenumber)
+            except kasm.KasmError as error:
+                raise LinkError(f"{names[index]}: {error.message}")
+        words.extend(code)
+        if index == 0 and module["needs_halt"]:
+            words.append(kasm.HALT_WORD)
+    return words, data, layout
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="klink.py", description="Links KASM objects into one K86 program.")
+    parser.add_argument("filenames", nargs="+", metavar="filename",
+                        help="objects (.ko) or sources (.k86) to link, the first one is where the program starts. "
+                             "Sources are assembled into objects first if they've changed")
+    parser.add_argument("-o", "--output", help="output file name, without the extension (default: the first input's)")
+    parser.add_argument("-f", "--format", type=kasm.format_list, action="append",
+                        help="output formats, the same as kasm.py (default: bin)")
+    parser.add_argument("-D", "--data-image", action="store_true",
+                        help="write the data memory as its own image instead of setting it up with code")
+    parser.add_argument("-O", "--optimize", action="store_true", help="optimize sources that get assembled")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print where each module ended up")
+    args = parser.parse_args()
+    formats = [name for names in args.format for name in names] if args.format else ["bin"]
+    formats = tuple(dict.fromkeys(formats))
+    if any(name in kasm.listing_formats for name in formats):
+        parser.error("listings are made by kasm.py, klink.py only writes the program")
+
+    modules = []
+    for filename in args.filenames:
+        try:
+            modules.append(load_module(filename, args.optimize))
+        except kasm.KasmError as error:
+            sys.exit(f"{filename}: {error.message}")
+        except OSError as error:
+            sys.exit(f"{filename}: {error.strerror}")
+    try:
+        words, data, layout = link(modules, args.filenames, args.data_image)
+    except kasm.KasmError as error:
+        sys.exit(error.message)
+    kasm.write_outputs(args.output or os.path.splitext(args.filenames[0])[0], formats, words, data, args.data_image)
+
+    if args.verbose:
+        kept = {index for index, _, _ in layout}
+        for index, code, data_address in layout:
+            module = modules[index]
+            print(f"{args.filenames[index]}: code {code:04X}, {len(module['code'])} words, "
+                  f"data {kasm.instruction_memory_size + data_address:04X}, {len(module['data'])} words")
+        for index, filename in enumerate(args.filenames):
+            if index not in kept:
+                print(f"{filename}: not used, left out")
+
+
+if __name__ == "__main__":
+    main()
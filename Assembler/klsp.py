@@ -0,0 +1,480 @@
+#     KASM Language Server
+#     Speaks the language server protocol over stdin and stdout, so an editor can check .k86 files while they're typed
+
+import json
+import re
+import sys
+from array import array
+
+import kasm
+import ksim
+
+# Operands are separated by commas, spaces or both, the same as kasm.tokenize, but here their columns are kept
+token_pattern = re.compile(r"[^\s,]+")
+
+# Errors from the assembler say which line they're on, the editor already knows that
+line_reference = re.compile(r"(Error )?at line \d+:?\s*")
+
+# Diagnostic severities from the protocol
+ERROR = 1
+WARNING = 2
+
+# Completion item kinds from the protocol
+KEYWORD = 14
+VARIABLE = 6
+REFERENCE = 18
+MODULE = 9
+
+# The parse of one line of source. Lines only depend on their text and on the section they're in, so one
+# LineInfo can be shared by every line with the same text and section
+class LineInfo:
+    def __init__(self, text, mode):
+        self.text = text
+        self.mode = mode  # section the line starts in, 0 before any section, 1 for .data and 2 for .code
+        self.next_mode = mode  # section the next line starts in
+        self.tokens = []  # (text, first column, column after the end)
+        self.words = array('H')  # the words it makes, with names left as zero
+        self.relocations = []  # (index into words, name, mask), the offset after a + is already in the word
+        self.code_size = 0  # words of instruction memory it takes
+        self.data_size = 0  # words of data memory it takes
+        self.label = None
+        self.variable = None
+        self.globals = []
+        self.externs = []
+        self.error = None
+
+
+# Parses one line the same way kasm.py does, with a scratch Assembler that only ever sees this line
+def analyze_line(assembler, text, mode):
+    info = LineInfo(text, mode)
+    statement = kasm.strip_comment(text)
+    info.tokens = [(match.group(), match.start(), match.end()) for match in token_pattern.finditer(statement)]
+    assembler.reset()
+    assembler.mode = mode
+    try:
+        assembler.read_line(text)
+    except kasm.KasmError as error:
+        info.error = line_reference.sub("", error.message).strip() or error.message
+    except Exception as error:  # a bug in the assembler, shown on the line that found it instead of stopping the server
+        info.error = f"The assembler failed on this line: {type(error).__name__}: {error}"
+    info.next_mode = assembler.mode
+    # A line that failed part way can have relocations for words it never made. kasm.py stops there anyway,
+    # so the line's code is left out, and the lines after it are laid out as if it wasn't there
+    if info.error is None:
+        info.words = assembler.words
+        info.relocations = [(index, name, mask) for index, name, mask, linenumber in assembler.relocations]
+        info.code_size = assembler.next_instr_addr
+    info.data_size = assembler.next_data_addr
+    info.label = next(iter(assembler.subprocess_names), None)
+    info.variable = next(iter(assembler.user_defined_tokens), None)
+    info.globals = list(assembler.global_names)
+    info.externs = list(assembler.extern_names)
+
+    # The scratch assembler doesn't know where the variable ends up, so the STOREs that set it up are
+    # filled in from the variable's address like any other name
+    if info.variable is not None and info.error is None and not assembler.data_image:
+        for offset in range(info.data_size):
+            index = 4 * offset + 3
+            info.words[index] = (info.words[index] & ~kasm.ADDRESS_FIELD) | offset
+            info.relocations.append((index, info.variable, kasm.ADDRESS_FIELD))
+    return info
+
+
+# One open .k86 file. Keeps every line's parse, where each line's code and data start, and the names it defines
+class Document:
+    def __init__(self, uri, text, cache):
+        self.uri = uri
+        self.cache = cache  # (text, mode) -> LineInfo, shared by all documents
+        # The scratch assembler has plenty of data memory, running out is checked for the whole file instead.
+        # Instruction memory is the real size, so the addresses of the STOREs that set up a variable fit
+        self.assembler = kasm.Assembler(data_memory_size=1 << 20)
+        self.lines = text.split("\n")
+        self.infos = []
+        self.code_addresses = array('I')
+        self.data_addresses = array('I')
+        self.update(0, 0, len(self.lines))
+
+    def analyze(self, text, mode):
+        key = (text, mode)
+        info = self.cache.get(key)
+        if info is None:
+            if len(self.cache) > 100000:
+                self.cache.clear()
+            info = self.cache[key] = analyze_line(self.assembler, text, mode)
+        return info
+
+    # Applies one change from the editor, a range of the text replaced with new text, or the whole text if
+    # there's no range. Only the lines in the range are parsed again, plus any after them whose section changed
+    def change(self, change):
+        if "range" not in change:
+            old_count = len(self.lines)
+            self.lines = change["text"].split("\n")
+            self.update(0, old_count, len(self.lines))
+            return
+        start = change["range"]["start"]
+        end = change["range"]["end"]
+        first = self.lines[start["line"]] if start["line"] < len(self.lines) else ""
+        last = self.lines[end["line"]] if end["line"] < len(self.lines) else ""
+        new_lines = (first[:start["character"]] + change["text"] + last[end["character"]:]).split("\n")
+        self.lines[start["line"]:end["line"] + 1] = new_lines
+        self.update(start["line"], end["line"] + 1 - start["line"], len(new_lines))
+
+    # Parses the count new lines at first, which replaced old_count lines, then carries the section and the
+    # addresses on through the rest of the file
+    def update(self, first, old_count, count):
+        mode = self.infos[first - 1].next_mode if first > 0 else 0
+        new_infos = []
+        for text in self.lines[first:first + count]:
+            info = self.analyze(text, mode)
+            new_infos.append(info)
+            mode = info.next_mode
+        self.infos[first:first + old_count] = new_infos
+
+        # A line whose section changed has to be parsed again, once the sections agree the rest is the same
+        for index in range(first + count, len(self.infos)):
+            if self.infos[index].mode == mode:
+                break
+            self.infos[index] = self.analyze(self.lines[index], mode)
+            mode = self.infos[index].next_mode
+
+        # Addresses before the first changed line can't have moved
+        del self.code_addresses[first:]
+        del self.data_addresses[first:]
+        code = self.code_addresses[-1] + self.infos[first - 1].code_size if first > 0 else 0
+        data = self.data_addresses[-1] + self.infos[first - 1].data_size if first > 0 else 0
+        for info in self.infos[first:]:
+            self.code_addresses.append(code)
+            self.data_addresses.append(data)
+            code += info.code_size
+            data += info.data_size
+        self.find_names()
+
+    # Collects the labels and variables from every line, name -> line index
+    def find_names(self):
+        self.labels = {}
+        self.variables = {}
+        self.duplicates = []  # (line index, name, is a variable)
+        self.globals = {}
+        self.externs = set()
+        for index, info in enumerate(self.infos):
+            if info.label is not None:
+                if info.label in self.labels:
+                    self.duplicates.append((index, info.label, False))
+                self.labels[info.label] = index  # like kasm.py, the last definition is the one used
+            if info.variable is not None:
+                if info.variable in self.variables:
+                    self.duplicates.append((index, info.variable, True))
+                else:
+                    self.variables[info.variable] = index
+            for name in info.globals:
+                self.globals.setdefault(name, index)
+            self.externs.update(info.externs)
+
+    # Address a name stands for, or None if it isn't defined
+    def address_of(self, name):
+        if name in self.labels:
+            return self.code_addresses[self.labels[name]]
+        if name in self.variables:
+            return kasm.instruction_memory_size + self.data_addresses[self.variables[name]]
+        return None
+
+    # Every problem in the file, as protocol diagnostics
+    def diagnostics(self):
+        results = []
+
+        def add(index, start, end, message, severity=ERROR):
+            results.append({"range": {"start": {"line": index, "character": start},
+                                      "end": {"line": index, "character": end}},
+                            "severity": severity, "source": "kasm", "message": message})
+
+        code_full = data_full = False
+        for index, info in enumerate(self.infos):
+            if info.error is not None:
+                start = info.tokens[0][1] if info.tokens else 0
+                add(index, start, len(info.text), info.error)
+            for word_index, name, mask in info.relocations:
+                message = None
+                address = self.address_of(name)
+                if address is not None:
+                    try:
+                        kasm.relocate(info.words[word_index], address, mask, index + 1)
+                    except kasm.KasmError as error:
+                        message = line_reference.sub("", error.message)
+                elif name not in self.externs:
+                    message = f"Undefined token {name}"
+                if message is not None:
+                    for text, start, end in info.tokens[1:]:
+                        if kasm.split_offset(text)[0] == name:
+                            add(index, start, start + len(name), message)
+                            break
+            if not code_full and info.code_size and \
+                    self.code_addresses[index] + info.code_size > kasm.instruction_memory_size:
+                code_full = True
+                add(index, 0, len(info.text), "Out of instruction memory!")
+            if not data_full and info.data_size and \
+                    self.data_addresses[index] + info.data_size > kasm.data_memory_size:
+                data_full = True
+                add(index, 0, len(info.text), "Out of data memory!")
+        for index, name, is_variable in self.duplicates:
+            start, end = self.name_columns(index, name)
+            if is_variable:
+                add(index, start, end, "Duplicate token.")
+            else:
+                add(index, start, end, f"Label {name} is defined again, this one is used", WARNING)
+        for name, index in self.globals.items():
+            if name not in self.labels and name not in self.variables:
+                start, end = self.name_columns(index, name)
+                add(index, start, end, f"Undefined global token {name}")
+        return results
+
+    # Columns of a name on a line, or the whole line if it isn't there
+    def name_columns(self, index, name):
+        for text, start, end in self.infos[index].tokens:
+            if text.rstrip(":").split("[")[0] == name:
+                return start, start + len(name)
+        return 0, len(self.lines[index])
+
+    # The token under a position, as (text, first column, column after the end, its position on the line)
+    def token_at(self, line, character):
+        if line >= len(self.infos):
+            return None
+        for position, (text, start, end) in enumerate(self.infos[line].tokens):
+            if start <= character <= end:
+                return text, start, end, position
+        return None
+
+    # The words a line makes, with its names filled in from where they are now. A name that's undefined, or
+    # whose address doesn't fit, is left as it is, diagnostics() reports both
+    def line_words(self, index):
+        info = self.infos[index]
+        words = array('H', info.words)
+        for word_index, name, mask in info.relocations:
+            address = self.address_of(name)
+            if address is not None:
+                try:
+                    words[word_index] = kasm.relocate(words[word_index], address, mask, index + 1)
+                except kasm.KasmError:
+                    pass
+        return words
+
+
+# Hover text for a token
+def hover_text(document, line, token, position):
+    name = token.rstrip(":")
+    info = document.infos[line]
+    if position == 0 and token in kasm.k86_tokens:
+        opcode, encoder, count, kinds = kasm.instruction_table[token]
+        bits = kasm.k86_tokens[token]
+        size = 2 if token in kasm.two_word_instructions else 1
+        text = [f"**{token}** opcode `{bits}` ({len(bits)} bits), {size} word{'s' if size == 2 else ''}, "
+                f"{ksim.cycle_cost(token)} cycles",
+                f"Operands: {', '.join(kinds) if kinds else 'none'}"]
+        if info.words and info.error is None:
+            address = document.code_addresses[line]
+            words = " ".join(f"{word:04X}" for word in document.line_words(line))
+            text.append(f"This line: `{words}` at {address:04X}")
+        return "\n\n".join(text)
+    if token in kasm.registers:
+        return f"**{token}** register {kasm.register_numbers[token]} (`{kasm.registers[token]}`)"
+    base, offset = kasm.split_offset(name.split("[")[0])
+    if base in document.labels:
+        return f"**{base}** label at {document.address_of(base):04X}, line {document.labels[base] + 1}"
+    if base in document.variables:
+        index = document.variables[base]
+        size = document.infos[index].data_size
+        return (f"**{base}** variable at {document.address_of(base):04X}, {size} word{'s' if size != 1 else ''}, "
+                f"line {index + 1}")
+    if base in document.externs:
+        return f"**{base}** defined in another module (.extern)"
+    return None
+
+
+# Completions for a position: instructions and directives at the start of a line, otherwise whatever the
+# instruction's operand at that position can be
+def completions(document, line, character):
+    info = document.infos[line] if line < len(document.infos) else None
+    position = 0
+    if info is not None:
+        position = sum(1 for text, start, end in info.tokens if end < character)
+    if position == 0:
+        items = [{"label": name, "kind": KEYWORD, "detail": f"{kasm.k86_tokens[name]}"} for name in kasm.k86_tokens]
+        items += [{"label": name, "kind": KEYWORD} for name in (".data", ".code", ".global", ".extern", ".word", ".nohalt")]
+        return items
+    mnemonic = info.tokens[0][0]
+    kinds = kasm.instruction_table[mnemonic][3] if mnemonic in kasm.instruction_table else ()
+    kind = kinds[position - 1] if position - 1 < len(kinds) else None
+    if kind == "register":
+        return [{"label": name, "kind": KEYWORD} for name in kasm.registers]
+    if kind == "address":
+        items = [{"label": name, "kind": REFERENCE, "detail": f"label {document.address_of(name):04X}"}
+                 for name in document.labels]
+        items += [{"label": name, "kind": VARIABLE, "detail": f"variable {document.address_of(name):04X}"}
+                  for name in document.variables]
+        items += [{"label": name, "kind": MODULE, "detail": "extern"} for name in document.externs]
+        return items
+    return []
+
+
+# The server itself: reads requests and notifications, keeps the open documents, and answers
+class Server:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.documents = {}
+        self.cache = {}
+        self.running = True
+        self.shutting_down = False
+        self.handlers = {
+            "initialize": self.initialize,
+            "shutdown": self.shutdown,
+            "textDocument/hover": self.hover,
+            "textDocument/definition": self.definition,
+            "textDocument/completion": self.completion,
+        }
+        self.notifications = {
+            "exit": self.exit,
+            "textDocument/didOpen": self.did_open,
+            "textDocument/didChange": self.did_change,
+            "textDocument/didClose": self.did_close,
+        }
+
+    # Reads one message, or returns None at the end of the input
+    def read_message(self):
+        length = None
+        while True:
+            header = self.reader.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode("ascii").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        if length is None:
+            return None
+        return json.loads(self.reader.read(length))
+
+    def send(self, message):
+        body = json.dumps(message, separators=(",", ":")).encode()
+        self.writer.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+        self.writer.flush()
+
+    def serve(self):
+        while self.running:
+            message = self.read_message()
+            if message is None:
+                break
+            self.handle(message)
+        return 0 if self.shutting_down else 1
+
+    def handle(self, message):
+        method = message.get("method")
+        params = message.get("params") or {}
+        if "id" not in message:
+            # Notifications have no reply, so anything that goes wrong is logged and the server keeps going
+            if method in self.notifications:
+                try:
+                    self.notifications[method](params)
+                except Exception as error:
+                    self.log(f"{method} failed: {type(error).__name__}: {error}")
+            return
+        handler = self.handlers.get(method)
+        if handler is None:
+            self.send({"jsonrpc": "2.0", "id": message["id"],
+                       "error": {"code": -32601, "message": f"Method not found: {method}"}})
+            return
+        try:
+            result = handler(params)
+        except (KeyError, IndexError, TypeError, ValueError) as error:
+            self.send({"jsonrpc": "2.0", "id": message["id"], "error": {"code": -32602, "message": str(error)}})
+            return
+        except Exception as error:
+            self.send({"jsonrpc": "2.0", "id": message["id"],
+                       "error": {"code": -32603, "message": f"{type(error).__name__}: {error}"}})
+            return
+        self.send({"jsonrpc": "2.0", "id": message["id"], "result": result})
+
+    # Shows a message in the editor's log for the server
+    def log(self, text):
+        self.send({"jsonrpc": "2.0", "method": "window/logMessage", "params": {"type": 1, "message": text}})
+
+    def publish(self, document):
+        self.send({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics",
+                   "params": {"uri": document.uri, "diagnostics": document.diagnostics()}})
+
+    def initialize(self, params):
+        return {
+            "capabilities": {
+                "textDocumentSync": {"openClose": True, "change": 2},  # 2 is incremental
+                "hoverProvider": True,
+                "definitionProvider": True,
+                "completionProvider": {"triggerCharacters": [" ", ","]},
+            },
+            "serverInfo": {"name": "klsp", "version": str(kasm.assembler_version)},
+        }
+
+    def shutdown(self, params):
+        self.shutting_down = True
+        return None
+
+    def exit(self, params):
+        self.running = False
+
+    def did_open(self, params):
+        item = params["textDocument"]
+        document = self.documents[item["uri"]] = Document(item["uri"], item["text"], self.cache)
+        self.publish(document)
+
+    def did_change(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        for change in params["contentChanges"]:
+            document.change(change)
+        self.publish(document)
+
+    def did_close(self, params):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.send({"jsonrpc": "2.0", "method": "textDocument/publishDiagnostics",
+                   "params": {"uri": uri, "diagnostics": []}})
+
+    def hover(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        line, character = params["position"]["line"], params["position"]["character"]
+        found = document.token_at(line, character)
+        if found is None:
+            return None
+        token, start, end, position = found
+        text = hover_text(document, line, token, position)
+        if text is None:
+            return None
+        return {"contents": {"kind": "markdown", "value": text},
+                "range": {"start": {"line": line, "character": start}, "end": {"line": line, "character": end}}}
+
+    def definition(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        line, character = params["position"]["line"], params["position"]["character"]
+        found = document.token_at(line, character)
+        if found is None:
+            return None
+        name = kasm.split_offset(found[0].rstrip(":").split("[")[0])[0]
+        index = document.labels.get(name, document.variables.get(name))
+        if index is None:
+            return None
+        start, end = document.name_columns(index, name)
+        return {"uri": document.uri,
+                "range": {"start": {"line": index, "character": start}, "end": {"line": index, "character": end}}}
+
+    def completion(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        return completions(document, params["position"]["line"], params["position"]["character"])
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] not in ("--stdio",):
+        sys.exit("Usage: klsp.py [--stdio]\nRuns a language server for .k86 files over stdin and stdout.")
+    sys.exit(Server(sys.stdin.buffer, sys.stdout.buffer).serve())
+
+
+if __name__ == "__main__":
+    main()
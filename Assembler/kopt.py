@@ -0,0 +1,270 @@
+#     KASM Optimizer
+#     Peephole and dead code pass, run on the assembled words before names are resolved (kasm.py -O)
+
+from array import array
+
+import kasm
+import ksim
+from ksim import JMP, JNP, CMP, TEST, LOADR, LOADI, LOADM, LOADA, STORE, PUSH, PRINT, SKIPZ, SKIPNP, PUSHPC, RET, NOP, HALT
+
+# Conditional jumps and the skips that test the same flag, JZ becomes SKIPZ and so on
+skip_for_jump = {number: SKIPZ + number - 1 for number in range(JMP + 1, JNP + 1)}
+
+# Instructions that only load a register, without reading anything else from it or touching the flags
+plain_loads = {LOADI, LOADM, LOADA, LOADR}
+
+
+# One instruction of the program being optimized
+class Instruction:
+    def __init__(self, address, words, relocations, line):
+        self.address = address
+        self.words = words  # the instruction's words, one or two
+        self.line = line  # source line it came from
+        self.relocations = relocations  # (offset within the instruction, name, mask, line number)
+        number, first, second, size = ksim.decode_table[words[0]]
+        self.number = number
+        self.first = first  # register field, or the address field of a jump
+        self.second = second
+        self.pinned = False  # must stay exactly where it is, like the instruction a SKIP skips
+
+    # The name this instruction's address field refers to, if it has one
+    def name(self):
+        return self.relocations[0][1] if self.relocations else None
+
+    def is_jump(self):
+        return self.number <= JNP
+
+    def is_skip(self):
+        return SKIPZ <= self.number <= SKIPNP
+
+    # True if the next instruction never runs straight after this one
+    def ends_flow(self):
+        return self.number in (JMP, RET, HALT)
+
+    # The memory operand of LOADM and STORE, as the name and offset or the number it was written with
+    def memory_operand(self):
+        return (self.name(), self.words[1] & kasm.ADDRESS_FIELD) if self.relocations else self.words[1] & kasm.ADDRESS_FIELD
+
+
+# Optimizes the program held by an Assembler in place, after parsing and before resolve(). The words, relocations
+# and label addresses are all rewritten, and a HALT is added if the end of the program can be reached. Returns
+# False (and changes nothing) for programs that use numeric code addresses, since those can't be moved safely.
+# roots are labels other code can jump to, like the .global labels of an object, so they're kept
+def optimize(assembler, roots=()):
+    instructions = split_instructions(assembler)
+    if instructions is None:
+        return False
+    labels = dict(assembler.subprocess_names)
+    roots = [name for name in roots if name in labels]
+
+    changed = True
+    passes = 0
+    while changed and passes < 16:
+        passes += 1
+        index_of = address_index(instructions)
+        changed = thread_jumps(instructions, labels, index_of)
+        changed |= jumps_to_skips(instructions, labels, index_of)
+        mark_pinned(instructions)
+        keep = find_reachable(instructions, labels, index_of, roots)[:-1]
+        remove_redundant(instructions, labels, index_of, keep)
+        if not all(keep):
+            changed = True
+            instructions, labels = rebuild(instructions, labels, keep)
+
+    # Only add a HALT if running off the end of the program is actually possible
+    falls_off = find_reachable(instructions, labels, address_index(instructions), roots)[-1]
+    assembler.words = array('H', [word for instruction in instructions for word in instruction.words])
+    assembler.word_lines = array('I', [instruction.line for instruction in instructions for word in instruction.words])
+    assembler.relocations = []
+    for instruction in instructions:
+        for offset, name, mask, linenumber in instruction.relocations:
+            assembler.relocations.append((instruction.address + offset, name, mask, linenumber))
+    assembler.subprocess_names = labels
+    assembler.next_instr_addr = len(assembler.words)
+    if falls_off and not assembler.no_halt:
+        assembler.words.append(kasm.HALT_WORD)
+        assembler.word_lines.append(0)
+    assembler.halt_added = True
+    return True
+
+
+# Splits the words into instructions. Returns None if the program jumps to a numeric address, reads code memory
+# with a numeric address or an offset from a label, or uses a name that isn't a label, variable or .extern, since
+# moving code would break those
+def split_instructions(assembler):
+    relocations = {}
+    for index, name, mask, linenumber in assembler.relocations:
+        if name not in assembler.subprocess_names and name not in assembler.user_defined_tokens \
+                and name not in assembler.extern_names:
+            return None  # leave the error for resolve() to report
+        if name in assembler.subprocess_names and assembler.words[index] & mask:
+            return None
+        relocations[index] = (name, mask, linenumber)
+
+    instructions = []
+    words = assembler.words
+    address = 0
+    while address < len(words):
+        size = ksim.decode_table[words[address]][3]
+        fixups = [(offset, *relocations[address + offset]) for offset in range(size) if address + offset in relocations]
+        instruction = Instruction(address, list(words[address:address + size]), fixups, assembler.word_lines[address])
+        instructions.append(instruction)
+        if instruction.is_jump():
+            if not fixups or fixups[0][1] in assembler.user_defined_tokens:
+                return None
+        elif instruction.number in (LOADM, LOADA, STORE) and not fixups:
+            if instruction.words[1] & kasm.ADDRESS_FIELD < assembler.instruction_memory_size:
+                return None
+        address += size
+    return instructions
+
+
+# Maps the address of every instruction to its index, and the address just past the last one to the end
+def address_index(instructions):
+    index_of = {instruction.address: index for index, instruction in enumerate(instructions)}
+    index_of[sum(len(instruction.words) for instruction in instructions)] = len(instructions)
+    return index_of
+
+
+# The instruction at an address, or None if there isn't one there
+def instruction_at(instructions, address, index_of):
+    index = index_of.get(address, len(instructions))
+    return instructions[index] if index < len(instructions) else None
+
+
+# Pins the instructions whose position matters to something other than a label: whatever follows a SKIP, since
+# the skip doesn't name it, and the jump after a PUSHPC, since the return address is counted from the PUSHPC
+def mark_pinned(instructions):
+    for index, instruction in enumerate(instructions):
+        instruction.pinned = index > 0 and instructions[index - 1].number in range(SKIPZ, PUSHPC + 1)
+
+
+# Makes jumps to an unconditional JMP go straight to where that JMP goes
+def thread_jumps(instructions, labels, index_of):
+    changed = False
+    for instruction in instructions:
+        if not instruction.is_jump():
+            continue
+        name = instruction.name()
+        seen = {name}
+        target = instruction_at(instructions, labels.get(name), index_of)
+        while target is not None and target.number == JMP and target.name() not in seen:
+            name = target.name()
+            seen.add(name)
+            target = instruction_at(instructions, labels.get(name), index_of)
+        if name != instruction.name():
+            offset, _, mask, linenumber = instruction.relocations[0]
+            instruction.relocations[0] = (offset, name, mask, linenumber)
+            changed = True
+    return changed
+
+
+# A conditional jump over exactly one instruction is the same as the skip for its condition, which needs no
+# address. So "CMP R1, R2 / JZ L / ADD R3, R4 / L:" becomes "CMP R1, R2 / SKIPZ / ADD R3, R4"
+def jumps_to_skips(instructions, labels, index_of):
+    changed = False
+    for index, instruction in enumerate(instructions[:-1]):
+        if instruction.number in skip_for_jump and not (index > 0 and SKIPZ <= instructions[index - 1].number <= PUSHPC):
+            following = instructions[index + 1]
+            if labels.get(instruction.name()) == following.address + len(following.words):
+                instruction.number = skip_for_jump[instruction.number]
+                instruction.words = [kasm.opcodes[ksim.mnemonics[instruction.number]]]
+                instruction.relocations = []
+                changed = True
+    return changed
+
+
+# Works out which instructions can ever run, starting from address 0, the root labels, every label whose address
+# is used as data, and every return address of a PUSHPC. Returns a list of booleans, one for each instruction and
+# a last one for whether the program can run off its end
+def find_reachable(instructions, labels, index_of, roots=()):
+    count = len(instructions)
+    reachable = [False] * (count + 1)
+    pending = [0] + [index_of[labels[name]] for name in roots if labels[name] in index_of]
+    for instruction in instructions:
+        if instruction.number in (LOADM, LOADA, STORE) and instruction.relocations:
+            name = instruction.name()
+            if name in labels and labels[name] in index_of:
+                pending.append(index_of[labels[name]])
+    for index, instruction in enumerate(instructions):
+        if instruction.number == PUSHPC:
+            pending.append(index + 2)
+
+    while pending:
+        index = pending.pop()
+        if index > count or reachable[index]:
+            continue
+        reachable[index] = True
+        if index == count:
+            continue
+        instruction = instructions[index]
+        if instruction.is_jump():
+            address = labels.get(instruction.name())
+            if address in index_of:
+                pending.append(index_of[address])
+        if instruction.is_skip():
+            pending.append(index + 2)
+        if not instruction.ends_flow():
+            pending.append(index + 1)
+    return reachable
+
+
+# Finds instructions that can be dropped without changing what the program does, and marks them in keep:
+# jumps to the very next instruction, NOPs, a load that is overwritten by the next instruction, a STORE that is
+# overwritten by the next instruction, a LOADM right after a STORE of the same register to the same place,
+# and a LOADI of a value the register is already known to hold
+def remove_redundant(instructions, labels, index_of, keep):
+    leaders = {0} | {index_of[address] for address in labels.values() if address in index_of}
+    for index, instruction in enumerate(instructions):
+        if instruction.is_jump() or instruction.is_skip() or instruction.ends_flow() or instruction.number == PUSHPC:
+            leaders.add(index + 1)
+            if instruction.is_skip():
+                leaders.add(index + 2)
+
+    known = {}  # register -> value it was given by a LOADI in this block
+    for index, instruction in enumerate(instructions):
+        if not keep[index]:
+            continue
+        if index in leaders:
+            known = {}
+        following = instructions[index + 1] if index + 1 < len(instructions) else None
+        number = instruction.number
+        removable = not instruction.pinned
+
+        if removable and number == NOP:
+            keep[index] = False
+        elif removable and instruction.is_jump() and following is not None and labels.get(instruction.name()) == following.address:
+            keep[index] = False
+        elif removable and number in plain_loads and following is not None and following.number in plain_loads \
+                and following.first == instruction.first and not (following.number == LOADR and following.second == instruction.first):
+            keep[index] = False
+        elif removable and number == STORE and following is not None and following.number == STORE \
+                and following.memory_operand() == instruction.memory_operand():
+            keep[index] = False
+        elif removable and number == LOADM and index not in leaders and index > 0 and keep[index - 1] \
+                and instructions[index - 1].number == STORE and instructions[index - 1].first == instruction.first \
+                and instructions[index - 1].memory_operand() == instruction.memory_operand():
+            keep[index] = False
+        elif removable and number == LOADI and known.get(instruction.first) == instruction.words[1] and not instruction.relocations:
+            keep[index] = False
+        elif number == LOADI:
+            known[instruction.first] = instruction.words[1]
+        elif number not in (STORE, PRINT, PUSH, CMP, TEST, NOP):
+            known = {}
+
+
+# Drops the instructions that aren't kept, gives everything its new address, and moves each label to the
+# first kept instruction at or after where it was
+def rebuild(instructions, labels, keep):
+    moved = {}
+    kept = []
+    address = 0
+    for instruction, wanted in zip(instructions, keep):
+        moved[instruction.address] = address
+        if wanted:
+            instruction.address = address
+            address += len(instruction.words)
+            kept.append(instruction)
+    old_end = max(moved, default=-1)
+    labels = {name: moved.get(old, address) if old <= old_end else address for name, old in labels.items()}
+    return kept, labels
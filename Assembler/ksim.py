@@ -0,0 +1,408 @@
+#     K86 Simulator
+#     Runs the machine words made by kasm.py without the Multisim circuit
+#     kvec.py runs the same machine on many inputs at once, the only difference is that a STORE into
+#     instruction memory changes the program here, and is an address fault there
+
+import sys
+
+import kasm
+
+# Cycles for each part of the fetch-decode-execute loop. Every word of an instruction is a
+# separate fetch, and instructions that touch data memory or the stack need one more cycle
+fetch_cycles = 1
+decode_cycles = 1
+execute_cycles = 1
+memory_cycles = 1
+
+# Instructions that access memory while executing
+memory_instructions = {"LOADM", "STORE", "PUSH", "POP", "PUSHPC", "RET"}
+
+# Instructions that have a second word holding their operand
+two_word_instructions = kasm.two_word_instructions
+
+# Number of values the stack can hold
+stack_size = 256
+
+# Mnemonics in opcode order, an instruction's position in this list is the number the decoder gives it
+mnemonics = list(kasm.k86_tokens)
+ILLEGAL = len(mnemonics)
+op = {name: index for index, name in enumerate(mnemonics)}
+
+# Instruction numbers as plain integers, so the run loop compares against constants
+(JMP, JZ, JNZ, JC, JNC, JGT, JLT, JO, JNO, JP, JNP,
+ ADD, SUB, MULT, DIV, AND, OR, XOR, SHL, SHR, ROL, ROR, LOADR, SWAP, CMP, TEST,
+ ADDI, SUBI, MULTI, DIVI, LOADI, LOADM, LOADA, STORE, CLEAR, NOT, NEG, PUSH, POP, PRINT,
+ SKIPZ, SKIPNZ, SKIPC, SKIPNC, SKIPGT, SKIPLT, SKIPO, SKIPNO, SKIPP, SKIPNP,
+ PUSHPC, RET, INPUT, NOP, SYS, HALT) = (op[name] for name in (
+    "JMP", "JZ", "JNZ", "JC", "JNC", "JGT", "JLT", "JO", "JNO", "JP", "JNP",
+    "ADD", "SUB", "MULT", "DIV", "AND", "OR", "XOR", "SHL", "SHR", "ROL", "ROR", "LOADR", "SWAP", "CMP", "TEST",
+    "ADDI", "SUBI", "MULTI", "DIVI", "LOADI", "LOADM", "LOADA", "STORE", "CLEAR", "NOT", "NEG", "PUSH", "POP", "PRINT",
+    "SKIPZ", "SKIPNZ", "SKIPC", "SKIPNC", "SKIPGT", "SKIPLT", "SKIPO", "SKIPNO", "SKIPP", "SKIPNP",
+    "PUSHPC", "RET", "INPUT", "NOP", "SYS", "HALT"))
+
+# Jumps have a 12-bit address field instead of register fields
+jump_family = {name for name, bits in kasm.k86_tokens.items() if len(bits) == 4}
+
+
+# Total cycles for one instruction
+def cycle_cost(mnemonic):
+    words = 2 if mnemonic in two_word_instructions else 1
+    cost = words * fetch_cycles + decode_cycles + execute_cycles
+    if mnemonic in memory_instructions:
+        cost += memory_cycles
+    return cost
+
+
+# Builds the decode table, one entry for every possible 16-bit word. Opcodes are variable length but
+# no opcode is the prefix of another, so each opcode owns one block of words and is filled in as a slice.
+# Each entry is (instruction number, first operand field, second operand field, length in words)
+def build_decode_table():
+    table = [(ILLEGAL, 0, 0, 1)] * 65536
+    for name, bits in kasm.k86_tokens.items():
+        shift = 16 - len(bits)
+        first = int(bits, 2) << shift
+        size = 2 if name in two_word_instructions else 1
+        number = op[name]
+        if name in jump_family:
+            table[first:first + (1 << shift)] = [(number, word & 0xFFF, 0, size) for word in range(first, first + (1 << shift))]
+        elif shift == 8:
+            table[first:first + 256] = [(number, (word >> 4) & 0xF, word & 0xF, size) for word in range(first, first + 256)]
+        elif shift == 4:
+            table[first:first + 16] = [(number, word & 0xF, 0, size) for word in range(first, first + 16)]
+        else:
+            table[first] = (number, 0, 0, size)
+    return table
+
+
+decode_table = build_decode_table()
+
+
+# Raised when the program does something the machine can't do, like running off the end of memory
+class SimulatorError(Exception):
+    pass
+
+
+# Converts an unsigned 16-bit value to a signed one
+def to_signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# Holds the state of one K86 machine
+class Simulator:
+    def __init__(self, words, inputs=None, output=None,
+                 instruction_memory_size=kasm.instruction_memory_size, data_memory_size=kasm.data_memory_size, data=()):
+        if len(words) > instruction_memory_size:
+            raise SimulatorError("Program does not fit in instruction memory")
+        if len(data) > data_memory_size:
+            raise SimulatorError("Data image does not fit in data memory")
+        self.memory = [0] * (instruction_memory_size + data_memory_size)
+        self.memory[0:len(words)] = [word & 0xFFFF for word in words]
+        self.memory[instruction_memory_size:instruction_memory_size + len(data)] = [word & 0xFFFF for word in data]
+        self.registers = [0] * 16
+        self.stack = []
+        self.pc = 0
+        self.zero = self.carry = self.greater = self.less = self.overflow = self.parity = False
+        self.halted = False
+        self.cycles = 0
+        self.instructions = 0
+        self.inputs = inputs
+        self.output = output
+        self.printed = []
+        if inputs is not None and not hasattr(inputs, "get"):
+            self.inputs = iter(inputs)
+
+    # Gets the value for an INPUT instruction, from the supplied queue or iterable, or stdin if there's neither
+    def read_input(self):
+        if self.inputs is None:
+            text = sys.stdin.readline()
+            if not text:
+                raise SimulatorError("INPUT with no more input")
+            return int(text.strip(), 0) & 0xFFFF
+        if hasattr(self.inputs, "get"):
+            return int(self.inputs.get()) & 0xFFFF
+        try:
+            return int(next(self.inputs)) & 0xFFFF
+        except StopIteration:
+            raise SimulatorError("INPUT with no more input") from None
+
+    # Sends the value of a PRINT instruction to the supplied queue or callable, or stdout if there's neither
+    def write_output(self, value):
+        value = to_signed(value)
+        self.printed.append(value)
+        if self.output is None:
+            print(value)
+        elif hasattr(self.output, "put"):
+            self.output.put(value)
+        else:
+            self.output(value)
+
+    # Runs until HALT, or until max_cycles have passed. Returns True if the program halted.
+    # The machine state is kept in local variables while running, which is much faster than attributes
+    def run(self, max_cycles=None):
+        memory = self.memory
+        memory_size = len(memory)
+        table = decode_table
+        costs = cycle_costs
+        regs = self.registers
+        stack = self.stack
+        pc = self.pc
+        z, c, gt, lt, o, p = self.zero, self.carry, self.greater, self.less, self.overflow, self.parity
+        cycles = self.cycles
+        count = self.instructions
+        limit = float("inf") if max_cycles is None else cycles + max_cycles
+        halted = self.halted
+
+        try:
+            while not halted and cycles < limit:
+                if pc >= memory_size:
+                    raise SimulatorError(f"Program counter ran past the end of memory ({pc})")
+                number, a, b, size = table[memory[pc]]
+                cycles += costs[number]
+                count += 1
+                if size == 2:
+                    if pc + 1 >= memory_size:
+                        raise SimulatorError(f"Program counter ran past the end of memory ({pc + 1})")
+                    b = memory[pc + 1]
+                pc += size
+
+                # Jumps, the low 12 bits are the target address
+                if number <= JNP:
+                    if number == JMP:
+                        taken = True
+                    elif number == JZ:
+                        taken = z
+                    elif number == JNZ:
+                        taken = not z
+                    elif number == JC:
+                        taken = c
+                    elif number == JNC:
+                        taken = not c
+                    elif number == JGT:
+                        taken = gt
+                    elif number == JLT:
+                        taken = lt
+                    elif number == JO:
+                        taken = o
+                    elif number == JNO:
+                        taken = not o
+                    elif number == JP:
+                        taken = p
+                    else:
+                        taken = not p
+                    if taken:
+                        pc = a
+                    continue
+
+                # Arithmetic on a register, with either a second register or an immediate value
+                if number <= DIV or ADDI <= number <= DIVI:
+                    x = regs[a]
+                    y = b if number >= ADDI else regs[b]
+                    kind = number - ADDI if number >= ADDI else number - ADD
+                    if kind == 0:
+                        full = x + y
+                        result = full & 0xFFFF
+                        c = full > 0xFFFF
+                        o = bool(~(x ^ y) & (x ^ result) & 0x8000)
+                    elif kind == 1:
+                        result = (x - y) & 0xFFFF
+                        c = y > x
+                        o = bool((x ^ y) & (x ^ result) & 0x8000)
+                    elif kind == 2:
+                        full = x * y
+                        result = full & 0xFFFF
+                        c = full > 0xFFFF
+                        o = not -0x8000 <= to_signed(x) * to_signed(y) <= 0x7FFF
+                    else:
+                        if y == 0:
+                            raise SimulatorError(f"Division by zero at address {pc - size}")
+                        result = x // y
+                        c = o = False
+                    regs[a] = result
+                elif number <= XOR:
+                    if number == AND:
+                        result = regs[a] & regs[b]
+                    elif number == OR:
+                        result = regs[a] | regs[b]
+                    else:
+                        result = regs[a] ^ regs[b]
+                    regs[a] = result
+                    c = o = False
+                elif number <= ROR:
+                    x = regs[a]
+                    if number == SHL:
+                        c = bool((x << b) & 0x10000)
+                        result = (x << b) & 0xFFFF
+                    elif number == SHR:
+                        c = bool(b and (x >> (b - 1)) & 1)
+                        result = x >> b
+                    elif number == ROL:
+                        result = ((x << b) | (x >> (16 - b))) & 0xFFFF
+                    else:
+                        result = ((x >> b) | (x << (16 - b))) & 0xFFFF
+                    regs[a] = result
+                    o = False
+                elif number == LOADR:
+                    regs[a] = regs[b]
+                    continue
+                elif number == SWAP:
+                    regs[a], regs[b] = regs[b], regs[a]
+                    continue
+                elif number == CMP:
+                    x = regs[a]
+                    y = regs[b]
+                    result = (x - y) & 0xFFFF
+                    c = y > x
+                    o = bool((x ^ y) & (x ^ result) & 0x8000)
+                    z = x == y
+                    gt = to_signed(x) > to_signed(y)
+                    lt = to_signed(x) < to_signed(y)
+                    p = not result.bit_count() & 1
+                    continue
+                elif number == TEST:
+                    result = regs[a] & regs[b]
+                    c = o = False
+                elif number == LOADI:
+                    regs[a] = b
+                    continue
+                elif number == LOADM:
+                    b &= 0xFFF
+                    if b >= memory_size:
+                        raise SimulatorError(f"LOADM from address {b} outside of memory")
+                    regs[a] = memory[b]
+                    continue
+                elif number == LOADA:
+                    regs[a] = b & 0xFFF
+                    continue
+                elif number == STORE:
+                    b &= 0xFFF
+                    if b >= memory_size:
+                        raise SimulatorError(f"STORE to address {b} outside of memory")
+                    memory[b] = regs[a]
+                    continue
+                elif number == CLEAR:
+                    result = regs[a] = 0
+                    c = o = False
+                elif number == NOT:
+                    result = regs[a] = regs[a] ^ 0xFFFF
+                    c = o = False
+                elif number == NEG:
+                    x = regs[a]
+                    result = regs[a] = -x & 0xFFFF
+                    c = x != 0
+                    o = x == 0x8000
+                elif number == PUSH:
+                    if len(stack) >= stack_size:
+                        raise SimulatorError(f"Stack overflow at address {pc - size}")
+                    stack.append(regs[a])
+                    continue
+                elif number == POP:
+                    if not stack:
+                        raise SimulatorError(f"Stack underflow at address {pc - size}")
+                    regs[a] = stack.pop()
+                    continue
+                elif number == PRINT:
+                    self.write_output(regs[a])
+                    continue
+                elif number <= SKIPNP:
+                    if number == SKIPZ:
+                        taken = z
+                    elif number == SKIPNZ:
+                        taken = not z
+                    elif number == SKIPC:
+                        taken = c
+                    elif number == SKIPNC:
+                        taken = not c
+                    elif number == SKIPGT:
+                        taken = gt
+                    elif number == SKIPLT:
+                        taken = lt
+                    elif number == SKIPO:
+                        taken = o
+                    elif number == SKIPNO:
+                        taken = not o
+                    elif number == SKIPP:
+                        taken = p
+                    else:
+                        taken = not p
+                    if taken and pc < memory_size:
+                        pc += table[memory[pc]][3]
+                    continue
+                elif number == PUSHPC:
+                    # Pushes the address after the jump that follows, so PUSHPC then JMP works as a call
+                    if len(stack) >= stack_size:
+                        raise SimulatorError(f"Stack overflow at address {pc - size}")
+                    stack.append(pc + 1)
+                    continue
+                elif number == RET:
+                    if not stack:
+                        raise SimulatorError(f"Stack underflow at address {pc - size}")
+                    pc = stack.pop()
+                    continue
+                elif number == INPUT:
+                    regs[0] = self.read_input()
+                    continue
+                elif number == NOP or number == SYS:
+                    continue
+                elif number == HALT:
+                    halted = True
+                    continue
+                elif memory[pc - size] >> 12 == 0:
+                    # The all zeros opcode isn't assigned, memory starts out zeroed so it acts as a NOP
+                    continue
+                else:
+                    raise SimulatorError(f"Illegal instruction {memory[pc - size]:04X} at address {pc - size}")
+
+                # Everything that gets here produced a result, the rest of the flags come from it
+                z = result == 0
+                signed = to_signed(result)
+                gt = signed > 0
+                lt = signed < 0
+                p = not result.bit_count() & 1
+        finally:
+            self.halted = halted
+            self.pc = pc
+            self.zero, self.carry, self.greater, self.less, self.overflow, self.parity = z, c, gt, lt, o, p
+            self.cycles = cycles
+            self.instructions = count
+        return self.halted
+
+
+# Cycle cost of every instruction number, the last entry covers illegal and unassigned words
+cycle_costs = [cycle_cost(name) for name in mnemonics] + [fetch_cycles + decode_cycles + execute_cycles]
+
+
+# Reads a program from a .k86 source file, or any of the output formats kasm.py writes
+def load_program(filename):
+    if filename.endswith(".k86"):
+        with open(filename, "r") as reader:
+            return kasm.Assembler().assemble(reader.read())
+    return kasm.read_words(filename)
+
+
+# Reads the data memory image that goes with a program, if it has one. A .k86 file never does,
+# since load_program() assembles it with the code that sets up the .data section
+def load_data(filename):
+    if filename.endswith(".k86"):
+        return []
+    return kasm.read_data(filename)
+
+
+def main():
+    args = sys.argv[1:]
+    max_cycles = None
+    if len(args) >= 3 and args[-2] == "--max-cycles":
+        max_cycles = int(args[-1])
+        args = args[:-2]
+    if len(args) != 1:
+        sys.exit("Usage: ksim.py [file name] [--max-cycles N]")
+    try:
+        simulator = Simulator(load_program(args[0]), data=load_data(args[0]))
+        halted = simulator.run(max_cycles)
+    except (kasm.KasmError, SimulatorError) as error:
+        sys.exit(str(error))
+    print(f"{'Halted' if halted else 'Stopped'} after {simulator.instructions} instructions, "
+          f"{simulator.cycles} cycles", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
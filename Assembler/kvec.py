@@ -0,0 +1,436 @@
+#     K86 Vector Executor
+#     Runs one program on many K86 machines at once with NumPy, for sweeping a program over lots of inputs
+#     Every machine runs the same as ksim.py, with one difference: instruction memory is shared by all the
+#     machines, so a STORE into it is an address fault here, where ksim.py changes the program
+#     Speed: about 40 million machine cycles a second in total, around 15 times ksim.py running the machines
+#     one after another. A sweep takes seconds only while the machines halt quickly: all 65536 inputs of
+#     factorial.k86 with --max-cycles 2000 take about 3 seconds, but with --max-cycles 200000 most inputs
+#     loop until the limit and the sweep takes about 4.5 minutes
+
+import argparse
+import sys
+
+import numpy as np
+
+import kasm
+import ksim
+from ksim import (JMP, JNP, ADD, DIV, AND, OR, XOR, SHL, SHR, ROL, ROR, LOADR, SWAP, CMP, TEST,
+                  ADDI, DIVI, LOADI, LOADM, LOADA, STORE, CLEAR, NOT, NEG, PUSH, POP, PRINT,
+                  SKIPZ, SKIPNP, PUSHPC, RET, INPUT, NOP, SYS, HALT, ILLEGAL)
+
+# Reasons a machine can stop other than HALT, kept per machine in VectorMachine.faults
+NO_FAULT = 0
+ILLEGAL_INSTRUCTION = 1
+DIVISION_BY_ZERO = 2
+STACK_OVERFLOW = 3
+STACK_UNDERFLOW = 4
+BAD_ADDRESS = 5
+NO_INPUT = 6
+fault_names = ["", "illegal instruction", "division by zero", "stack overflow", "stack underflow",
+               "address outside of memory", "INPUT with no more input"]
+
+# Flag each conditional jump and skip tests, and whether it jumps when the flag is clear instead of set
+conditions = ["", "zero", "zero", "carry", "carry", "greater", "less", "overflow", "overflow", "parity", "parity"]
+inverted = [False, False, True, False, True, False, False, False, True, False, True]
+
+# The decoder table from the simulator as arrays, so a whole vector of words can be decoded in one step
+decode_numbers = np.array([entry[0] for entry in ksim.decode_table], dtype=np.int64)
+decode_first = np.array([entry[1] for entry in ksim.decode_table], dtype=np.int64)
+decode_second = np.array([entry[2] for entry in ksim.decode_table], dtype=np.int64)
+decode_sizes = np.array([entry[3] for entry in ksim.decode_table], dtype=np.int64)
+decode_costs = np.asarray(ksim.cycle_costs, dtype=np.int64)[decode_numbers]
+
+
+# Converts unsigned 16-bit values to signed ones
+def to_signed(values):
+    return np.where(values & 0x8000, values - 0x10000, values)
+
+
+# Even parity of the low 16 bits of each value
+def even_parity(values):
+    values = values ^ (values >> 8)
+    values = values ^ (values >> 4)
+    values = values ^ (values >> 2)
+    values = values ^ (values >> 1)
+    return (values & 1) == 0
+
+
+# The state of `count` K86 machines that all run the same program. Every machine has its own registers, flags,
+# program counter, stack and data memory. Instruction memory is shared and read-only, so a program that stores
+# into its own code faults instead of being simulated
+class VectorMachine:
+    def __init__(self, words, count, inputs=None, max_prints=64,
+                 instruction_memory_size=kasm.instruction_memory_size, data_memory_size=kasm.data_memory_size, data=()):
+        if len(words) > instruction_memory_size:
+            raise ksim.SimulatorError("Program does not fit in instruction memory")
+        if len(data) > data_memory_size:
+            raise ksim.SimulatorError("Data image does not fit in data memory")
+        self.count = count
+        self.instruction_memory_size = instruction_memory_size
+        self.data_memory_size = data_memory_size
+
+        # Predecode every address of the program once, the second word of two word instructions included
+        code = np.zeros(instruction_memory_size + 1, dtype=np.int64)
+        code[:len(words)] = np.asarray(words, dtype=np.int64) & 0xFFFF
+        self.code = code[:instruction_memory_size]
+        self.numbers = decode_numbers[self.code]
+        self.first = decode_first[self.code]
+        self.sizes = decode_sizes[self.code]
+        self.second = np.where(self.sizes == 2, code[1:], decode_second[self.code])
+        self.costs = decode_costs[self.code]
+
+        self.registers = np.zeros((count, 16), dtype=np.int64)
+        self.data = np.zeros((count, data_memory_size), dtype=np.uint16)
+        self.data[:, :len(data)] = np.asarray(data, dtype=np.int64) & 0xFFFF
+        self.stack = np.zeros((count, ksim.stack_size), dtype=np.int64)
+        self.stack_pointer = np.zeros(count, dtype=np.int64)
+        self.pc = np.zeros(count, dtype=np.int64)
+        self.flags = {name: np.zeros(count, dtype=bool) for name in ("zero", "carry", "greater", "less",
+                                                                     "overflow", "parity")}
+        self.halted = np.zeros(count, dtype=bool)
+        self.faults = np.zeros(count, dtype=np.int64)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.instructions = np.zeros(count, dtype=np.int64)
+
+        # INPUT reads the next column of this machine's row of inputs
+        if inputs is None:
+            inputs = np.zeros((count, 0), dtype=np.int64)
+        inputs = np.asarray(inputs, dtype=np.int64)
+        self.inputs = (inputs.reshape(count, 1) if inputs.ndim == 1 else inputs) & 0xFFFF
+        self.input_position = np.zeros(count, dtype=np.int64)
+
+        # PRINT writes the next column of this machine's row of outputs, anything past max_prints is only counted
+        self.outputs = np.zeros((count, max_prints), dtype=np.int64)
+        self.output_count = np.zeros(count, dtype=np.int64)
+
+    # Stops the machines in lanes with a fault
+    def fault(self, lanes, code):
+        self.faults[lanes] = code
+
+    # Sets the zero, greater, less and parity flags from the results of an instruction
+    def set_result_flags(self, lanes, result):
+        signed = to_signed(result)
+        self.flags["zero"][lanes] = result == 0
+        self.flags["greater"][lanes] = signed > 0
+        self.flags["less"][lanes] = signed < 0
+        self.flags["parity"][lanes] = even_parity(result)
+
+    # Runs every machine until it halts or faults, or until max_cycles have passed. Each step fetches one
+    # instruction for every running machine, then sorts the machines by instruction so every group can be
+    # executed with one set of array operations. Returns True if every machine stopped
+    def run(self, max_cycles=None):
+        limit = None if max_cycles is None else self.cycles + max_cycles
+        while True:
+            running = ~self.halted & (self.faults == NO_FAULT)
+            if limit is not None:
+                running &= self.cycles < limit
+            lanes = np.flatnonzero(running)
+            if lanes.size == 0:
+                break
+            pcs = self.pc[lanes]
+            if (pcs < self.instruction_memory_size - 1).all():
+                numbers, first, second = self.numbers[pcs], self.first[pcs], self.second[pcs]
+                costs, sizes = self.costs[pcs], self.sizes[pcs]
+            else:
+                lanes, pcs, numbers, first, second, costs, sizes = self.decode(lanes, pcs)
+            self.cycles[lanes] += costs
+            self.instructions[lanes] += 1
+            self.pc[lanes] = pcs + sizes
+
+            order = np.argsort(numbers, kind="stable")
+            numbers = numbers[order]
+            starts = np.flatnonzero(np.diff(numbers, prepend=-1))
+            ends = np.append(starts[1:], numbers.size)
+            for start, end in zip(starts, ends):
+                group = order[start:end]
+                self.execute(int(numbers[start]), lanes[group], first[group], second[group])
+        return not (~self.halted & (self.faults == NO_FAULT)).any()
+
+    # Decodes the instruction at each machine's pc from memory instead of the predecoded program. This is for
+    # machines that ran past the program into data memory, which ksim.py keeps running, or whose two word
+    # instruction is at the last address of instruction memory. A machine whose pc is past the end of memory
+    # faults, and is left out of the lanes returned
+    def decode(self, lanes, pcs):
+        words = self.fetch(lanes, pcs)
+        seconds = self.fetch(lanes, pcs + 1)
+        bad = (words < 0) | ((decode_sizes[words] == 2) & (seconds < 0))
+        if bad.any():
+            self.fault(lanes[bad], BAD_ADDRESS)
+            lanes, pcs, words, seconds = lanes[~bad], pcs[~bad], words[~bad], seconds[~bad]
+        sizes = decode_sizes[words]
+        second = np.where(sizes == 2, seconds, decode_second[words])
+        return lanes, pcs, decode_numbers[words], decode_first[words], second, decode_costs[words], sizes
+
+    # The word at an address for each machine in lanes, from the shared program or the machine's own data
+    # memory. An address past the end of memory gives -1
+    def fetch(self, lanes, addresses):
+        in_code = addresses < self.instruction_memory_size
+        in_data = ~in_code & (addresses < self.instruction_memory_size + self.data_memory_size)
+        words = np.full(lanes.size, -1, dtype=np.int64)
+        words[in_code] = self.code[addresses[in_code]]
+        words[in_data] = self.data[lanes[in_data], addresses[in_data] - self.instruction_memory_size]
+        return words
+
+    # Tests a jump or skip condition for each lane, offset is the instruction number of JMP or SKIPZ - 1
+    def condition(self, number, offset, lanes):
+        kind = number - offset
+        if kind == 0:
+            return np.ones(lanes.size, dtype=bool)
+        taken = self.flags[conditions[kind]][lanes]
+        return ~taken if inverted[kind] else taken
+
+    # Executes instruction `number` on every machine in lanes. first and second are each machine's operand fields
+    def execute(self, number, lanes, first, second):
+        regs = self.registers
+        flags = self.flags
+
+        if number <= JNP:
+            taken = self.condition(number, JMP, lanes)
+            self.pc[lanes[taken]] = first[taken]
+
+        elif number <= DIV or ADDI <= number <= DIVI:
+            x = regs[lanes, first]
+            y = second if number >= ADDI else regs[lanes, second]
+            kind = number - ADDI if number >= ADDI else number - ADD
+            if kind == 0:
+                full = x + y
+                result = full & 0xFFFF
+                flags["carry"][lanes] = full > 0xFFFF
+                flags["overflow"][lanes] = (~(x ^ y) & (x ^ result) & 0x8000) != 0
+            elif kind == 1:
+                result = (x - y) & 0xFFFF
+                flags["carry"][lanes] = y > x
+                flags["overflow"][lanes] = ((x ^ y) & (x ^ result) & 0x8000) != 0
+            elif kind == 2:
+                full = x * y
+                result = full & 0xFFFF
+                signed = to_signed(x) * to_signed(y)
+                flags["carry"][lanes] = full > 0xFFFF
+                flags["overflow"][lanes] = (signed < -0x8000) | (signed > 0x7FFF)
+            else:
+                zero = y == 0
+                if zero.any():
+                    self.fault(lanes[zero], DIVISION_BY_ZERO)
+                    lanes, first, x, y = lanes[~zero], first[~zero], x[~zero], y[~zero]
+                result = x // y
+                flags["carry"][lanes] = False
+                flags["overflow"][lanes] = False
+            regs[lanes, first] = result
+            self.set_result_flags(lanes, result)
+
+        elif number <= XOR or number == TEST:
+            x = regs[lanes, first]
+            y = regs[lanes, second]
+            if number == AND or number == TEST:
+                result = x & y
+            elif number == OR:
+                result = x | y
+            else:
+                result = x ^ y
+            if number != TEST:
+                regs[lanes, first] = result
+            flags["carry"][lanes] = False
+            flags["overflow"][lanes] = False
+            self.set_result_flags(lanes, result)
+
+        elif number <= ROR:
+            x = regs[lanes, first]
+            amount = second
+            if number == SHL:
+                flags["carry"][lanes] = ((x << amount) & 0x10000) != 0
+                result = (x << amount) & 0xFFFF
+            elif number == SHR:
+                flags["carry"][lanes] = (amount > 0) & (((x >> np.maximum(amount - 1, 0)) & 1) == 1)
+                result = x >> amount
+            elif number == ROL:
+                result = ((x << amount) | (x >> (16 - amount))) & 0xFFFF
+            else:
+                result = ((x >> amount) | (x << (16 - amount))) & 0xFFFF
+            regs[lanes, first] = result
+            flags["overflow"][lanes] = False
+            self.set_result_flags(lanes, result)
+
+        elif number == LOADR:
+            regs[lanes, first] = regs[lanes, second]
+
+        elif number == SWAP:
+            x = regs[lanes, first]
+            regs[lanes, first] = regs[lanes, second]
+            regs[lanes, second] = x
+
+        elif number == CMP:
+            x = regs[lanes, first]
+            y = regs[lanes, second]
+            result = (x - y) & 0xFFFF
+            flags["carry"][lanes] = y > x
+            flags["overflow"][lanes] = ((x ^ y) & (x ^ result) & 0x8000) != 0
+            flags["zero"][lanes] = x == y
+            flags["greater"][lanes] = to_signed(x) > to_signed(y)
+            flags["less"][lanes] = to_signed(x) < to_signed(y)
+            flags["parity"][lanes] = even_parity(result)
+
+        elif number == LOADI:
+            regs[lanes, first] = second
+
+        elif number == LOADM:
+            values = self.fetch(lanes, second & 0xFFF)
+            bad = values < 0
+            if bad.any():
+                self.fault(lanes[bad], BAD_ADDRESS)
+            regs[lanes[~bad], first[~bad]] = values[~bad]
+
+        elif number == LOADA:
+            regs[lanes, first] = second & 0xFFF
+
+        elif number == STORE:
+            address = (second & 0xFFF) - self.instruction_memory_size
+            bad = (address < 0) | (address >= self.data_memory_size)
+            if bad.any():
+                self.fault(lanes[bad], BAD_ADDRESS)
+                lanes, first, address = lanes[~bad], first[~bad], address[~bad]
+            self.data[lanes, address] = regs[lanes, first]
+
+        elif number == CLEAR or number == NOT or number == NEG:
+            x = regs[lanes, first]
+            if number == CLEAR:
+                result = np.zeros_like(x)
+                flags["carry"][lanes] = False
+                flags["overflow"][lanes] = False
+            elif number == NOT:
+                result = x ^ 0xFFFF
+                flags["carry"][lanes] = False
+                flags["overflow"][lanes] = False
+            else:
+                result = -x & 0xFFFF
+                flags["carry"][lanes] = x != 0
+                flags["overflow"][lanes] = x == 0x8000
+            regs[lanes, first] = result
+            self.set_result_flags(lanes, result)
+
+        elif number == PUSH or number == PUSHPC:
+            full = self.stack_pointer[lanes] >= ksim.stack_size
+            if full.any():
+                self.fault(lanes[full], STACK_OVERFLOW)
+                lanes, first = lanes[~full], first[~full]
+            # PUSHPC pushes the address after the jump that follows it, like the simulator
+            values = regs[lanes, first] if number == PUSH else self.pc[lanes] + 1
+            self.stack[lanes, self.stack_pointer[lanes]] = values
+            self.stack_pointer[lanes] += 1
+
+        elif number == POP or number == RET:
+            empty = self.stack_pointer[lanes] == 0
+            if empty.any():
+                self.fault(lanes[empty], STACK_UNDERFLOW)
+                lanes, first = lanes[~empty], first[~empty]
+            self.stack_pointer[lanes] -= 1
+            values = self.stack[lanes, self.stack_pointer[lanes]]
+            if number == POP:
+                regs[lanes, first] = values
+            else:
+                self.pc[lanes] = values
+
+        elif number == PRINT:
+            slots = self.output_count[lanes]
+            room = slots < self.outputs.shape[1]
+            self.outputs[lanes[room], slots[room]] = to_signed(regs[lanes[room], first[room]])
+            self.output_count[lanes] += 1
+
+        elif SKIPZ <= number <= SKIPNP:
+            taken = self.condition(number, SKIPZ - 1, lanes)
+            lanes = lanes[taken]
+            words = self.fetch(lanes, self.pc[lanes])
+            inside = words >= 0
+            self.pc[lanes[inside]] += decode_sizes[words[inside]]
+
+        elif number == INPUT:
+            positions = self.input_position[lanes]
+            empty = positions >= self.inputs.shape[1]
+            if empty.any():
+                self.fault(lanes[empty], NO_INPUT)
+                lanes, positions = lanes[~empty], positions[~empty]
+            regs[lanes, 0] = self.inputs[lanes, positions]
+            self.input_position[lanes] += 1
+
+        elif number == HALT:
+            self.halted[lanes] = True
+
+        elif number == NOP or number == SYS:
+            pass
+
+        elif number == ILLEGAL:
+            # The all zeros opcode isn't assigned, memory starts out zeroed so it acts as a NOP
+            illegal = (self.fetch(lanes, self.pc[lanes] - 1) >> 12) != 0
+            self.fault(lanes[illegal], ILLEGAL_INSTRUCTION)
+
+    # Each machine's printed values as a list
+    def printed(self, lane):
+        return self.outputs[lane, :min(self.output_count[lane], self.outputs.shape[1])].tolist()
+
+
+# Runs the program once for each row of inputs, in batches of lanes machines at a time to bound memory use.
+# Returns (outputs, output counts, halt cycles, faults) as arrays with one row per input, where the halt
+# cycle is -1 for a machine that didn't halt
+def sweep(words, inputs, max_cycles=None, lanes=8192, max_prints=64, data=()):
+    inputs = np.asarray(inputs, dtype=np.int64)
+    if inputs.ndim == 1:
+        inputs = inputs.reshape(-1, 1)
+    total = inputs.shape[0]
+    outputs = np.zeros((total, max_prints), dtype=np.int64)
+    output_counts = np.zeros(total, dtype=np.int64)
+    halt_cycles = np.full(total, -1, dtype=np.int64)
+    faults = np.zeros(total, dtype=np.int64)
+    for start in range(0, total, lanes):
+        end = min(start + lanes, total)
+        machine = VectorMachine(words, end - start, inputs[start:end], max_prints, data=data)
+        machine.run(max_cycles)
+        outputs[start:end] = machine.outputs
+        output_counts[start:end] = machine.output_count
+        halt_cycles[start:end] = np.where(machine.halted, machine.cycles, -1)
+        faults[start:end] = machine.faults
+    return outputs, output_counts, halt_cycles, faults
+
+
+# Reads an --inputs range like "0:65536" or a list like "1,2,3"
+def input_values(text):
+    if ":" in text:
+        parts = [int(part, 0) for part in text.split(":")]
+        return np.arange(*parts, dtype=np.int64)
+    return np.array([int(part, 0) for part in text.split(",")], dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="kvec.py", description="Runs a K86 program once for every input value.")
+    parser.add_argument("filename", help="a .k86 file or an assembled image")
+    parser.add_argument("--inputs", type=input_values, default=input_values("0:65536"),
+                        help="values for INPUT, a range start:stop[:step] or a comma separated list "
+                             "(default: every 16-bit value)")
+    parser.add_argument("--max-cycles", type=int, default=1_000_000, help="cycle limit for each machine")
+    parser.add_argument("--lanes", type=int, default=8192, help="machines to run at once")
+    parser.add_argument("--csv", help="write input, halt cycle, fault and printed values for every machine here")
+    args = parser.parse_args()
+
+    try:
+        words = ksim.load_program(args.filename)
+        data = ksim.load_data(args.filename)
+    except kasm.KasmError as error:
+        sys.exit(error.message)
+    outputs, counts, halt_cycles, faults = sweep(words, args.inputs, args.max_cycles, args.lanes, data=data)
+
+    halted = halt_cycles >= 0
+    print(f"{len(args.inputs)} runs: {halted.sum()} halted, {(faults != NO_FAULT).sum()} faulted, "
+          f"{(~halted & (faults == NO_FAULT)).sum()} hit the cycle limit")
+    if halted.any():
+        print(f"halt cycles: min {halt_cycles[halted].min()}, max {halt_cycles[halted].max()}, "
+              f"mean {halt_cycles[halted].mean():.1f}")
+    for code in np.unique(faults[faults != NO_FAULT]):
+        print(f"{fault_names[code]}: {(faults == code).sum()} runs")
+    if args.csv:
+        with open(args.csv, "w") as file:
+            file.write("input,halt_cycle,fault,printed\n")
+            for lane, value in enumerate(args.inputs):
+                printed = " ".join(str(v) for v in outputs[lane, :min(counts[lane], outputs.shape[1])])
+                file.write(f"{value},{halt_cycles[lane]},{fault_names[faults[lane]]},{printed}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#     KASM Watch Mode
+#     Keeps the assembler loaded and reassembles .k86 files as soon as they're saved
+
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import os
+import select
+import struct
+import sys
+import time
+
+import kasm
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Each inotify event starts with this header, followed by the file name padded with zeros
+event_header = struct.Struct("iIII")
+
+# How long to wait for more saves after the first one, editors often write a file more than once per save
+default_debounce = 0.005
+
+# How often the polling watcher looks at the files when inotify isn't available
+default_poll_interval = 0.1
+
+
+# Watches directories with Linux inotify, the kernel tells us about a change as soon as it happens
+class InotifyWatcher:
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+            self.directories[wd] = directory
+
+    # Waits up to timeout seconds (forever for None) and returns the set of paths that changed
+    def wait(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        changed = set()
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self.directories and name:
+                changed.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Watches directories by checking the modification time of every .k86 file, for systems without inotify
+class PollingWatcher:
+    def __init__(self, directories, interval=default_poll_interval):
+        self.directories = list(directories)
+        self.interval = interval
+        self.seen = self.scan()
+
+    def scan(self):
+        stamps = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as scan:
+                    for entry in scan:
+                        if entry.name.endswith(".k86"):
+                            stat = entry.stat()
+                            stamps[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+        return stamps
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stamps = self.scan()
+            changed = {path for path, stamp in stamps.items() if self.seen.get(path) != stamp}
+            self.seen = stamps
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+# Uses inotify when the system has it, polling when it doesn't
+def make_watcher(directories):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directories)
+
+
+# Works out which directories to watch, and which files in them to reassemble. A file name only matches
+# itself, a directory matches every .k86 file in it and its subdirectories, and a pattern like "*.k86"
+# (quoted, so the shell leaves it alone) matches every file it fits, including ones made later.
+# Returns (directories, files, patterns)
+def watch_targets(inputs):
+    directories = set()
+    files = set()
+    patterns = set()
+    for name in inputs:
+        if os.path.isdir(name):
+            for directory, _, _ in os.walk(name):
+                directories.add(os.path.normpath(directory))
+        elif glob.has_magic(name):
+            pattern = os.path.normpath(name)
+            patterns.add(pattern)
+            # The directory before the first wildcard, and everything under it if a directory name has one
+            top = os.path.dirname(pattern)
+            while glob.has_magic(top):
+                top = os.path.dirname(top)
+            top = top or "."
+            if glob.has_magic(os.path.dirname(pattern)):
+                for directory, _, _ in os.walk(top):
+                    directories.add(os.path.normpath(directory))
+            else:
+                directories.add(top)
+        else:
+            files.add(os.path.normpath(name))
+            directories.add(os.path.dirname(os.path.normpath(name)) or ".")
+    return sorted(directories), files, patterns
+
+
+# A changed path is rebuilt if it was named on the command line, fits one of the patterns, or is a .k86
+# file under one of the directories named on the command line
+def wanted(path, files, patterns, watched_dirs):
+    path = os.path.normpath(path)
+    if path in files or any(fnmatch.fnmatch(path, pattern) for pattern in patterns):
+        return True
+    return path.endswith(".k86") and any(path.startswith(directory + os.sep) or directory == "."
+                                         for directory in watched_dirs)
+
+
+# Reassembles one file and prints the result with how long it took
+def rebuild(filename, formats, cache=None, optimize=False, data_image=False):
+    start = time.perf_counter()
+    try:
+        words, cached = kasm.run(filename, formats, cache, optimize, data_image)
+    except kasm.KasmError as error:
+        print(f"{time.strftime('%H:%M:%S')}  FAIL  {filename}: {error.message}", flush=True)
+        return False
+    except OSError as error:
+        print(f"{time.strftime('%H:%M:%S')}  FAIL  {filename}: {error.strerror}", flush=True)
+        return False
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{time.strftime('%H:%M:%S')}  OK    {filename}: {len(words)} words in {elapsed:.1f} ms", flush=True)
+    return True
+
+
+# Assembles everything once, then reassembles files as they change until interrupted
+def watch(inputs, formats=("bin",), cache=None, debounce=default_debounce, optimize=False, data_image=False):
+    directories, files, patterns = watch_targets(inputs)
+    watched_dirs = {os.path.normpath(name) for name in inputs if os.path.isdir(name)}
+
+    for filename in kasm.expand_inputs(inputs):
+        rebuild(filename, formats, cache, optimize, data_image)
+    watcher = make_watcher(directories)
+    print(f"Watching {len(directories)} director{'y' if len(directories) == 1 else 'ies'} "
+          f"with {type(watcher).__name__}, press Ctrl+C to stop", flush=True)
+    try:
+        while True:
+            changed = watcher.wait()
+            # Keep collecting until the burst of saves is over
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            for path in sorted(changed):
+                if wanted(path, files, patterns, watched_dirs) and os.path.isfile(path):
+                    rebuild(path, formats, cache, optimize, data_image)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
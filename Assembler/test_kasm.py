@@ -0,0 +1,94 @@
+#     Tests for the KASM assembler
+#     Run from this folder with: python -m unittest
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import kasm
+
+
+# Writes a source file into directory and returns its path
+def write_source(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, "w") as file:
+        file.write(text)
+    return path
+
+
+class AddressTests(unittest.TestCase):
+    # A variable's address used to be masked to 12 bits without a check, so it wrapped once memory was bigger
+    def test_variable_address_out_of_range(self):
+        assembler = kasm.Assembler(instruction_memory_size=4096)
+        with self.assertRaises(kasm.KasmError) as caught:
+            assembler.assemble(".data\nx 1\n.code\nNOP\n")
+        self.assertEqual(caught.exception.message, "Error at line 2: 4096 does not fit in a 12-bit field.")
+
+    def test_variable_address_in_range(self):
+        words = kasm.Assembler().assemble(".data\nx 1\n.code\nLOADM R1, x\n")
+        self.assertEqual(list(words), [0xFF40, 1, 0xFF70, 0x800, 0xFF51, 0x800, kasm.HALT_WORD])
+
+    def test_number_out_of_range(self):
+        with self.assertRaises(kasm.KasmError):
+            kasm.Assembler().assemble(".code\nJMP 4096\n")
+
+    # The field holds the offset, and the address of the name is added to it
+    def test_name_plus_offset_out_of_range(self):
+        with self.assertRaises(kasm.KasmError) as caught:
+            kasm.Assembler().assemble(".data\nv 1\n.code\nLOADM R1, v+2048\n")
+        self.assertEqual(caught.exception.message, "Error at line 4: 4096 does not fit in a 12-bit field.")
+
+    def test_streaming_name_plus_offset_out_of_range(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = write_source(directory, "a.k86", ".data\nv 1\n.code\nLOADM R1, v+2048\n")
+            with self.assertRaises(kasm.KasmError):
+                kasm.run_stream(source, os.path.join(directory, "a.img"))
+
+
+class StreamTests(unittest.TestCase):
+    def test_writes_the_words(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = write_source(directory, "a.k86", ".code\nNOP\n")
+            output = os.path.join(directory, "a.img")
+            self.assertEqual(kasm.run_stream(source, output), 2)
+            with open(output, "rb") as file:
+                self.assertEqual(file.read(), bytes.fromhex("fffdffff"))
+
+    # A failed stream used to leave the words it had written so far
+    def test_error_leaves_no_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = write_source(directory, "a.k86", ".code\nJMP NOPE\n")
+            output = os.path.join(directory, "a.img")
+            with self.assertRaises(kasm.KasmError):
+                kasm.run_stream(source, output)
+            self.assertEqual(os.listdir(directory), ["a.k86"])
+
+    def test_error_keeps_the_last_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "a.img")
+            kasm.run_stream(write_source(directory, "a.k86", ".code\nNOP\n"), output)
+            with self.assertRaises(kasm.KasmError):
+                kasm.run_stream(write_source(directory, "a.k86", ".code\nNOP\nJMP NOPE\n"), output)
+            with open(output, "rb") as file:
+                self.assertEqual(file.read(), bytes.fromhex("fffdffff"))
+            self.assertEqual(sorted(os.listdir(directory)), ["a.img", "a.k86"])
+
+
+class OptionTests(unittest.TestCase):
+    # --profile used to be ignored without a word when given with these
+    def test_profile_rejected(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = write_source(directory, "a.k86", ".code\nNOP\n")
+            for option in ("-c", "--stream", "--watch"):
+                done = subprocess.run([sys.executable, os.path.abspath(kasm.__file__), "--profile",
+                                       os.path.join(directory, "p.json"), option, source],
+                                      capture_output=True, text=True, timeout=30)
+                self.assertEqual(done.returncode, 1)
+                self.assertIn("--profile can't be used", done.stderr)
+            self.assertEqual(os.listdir(directory), ["a.k86"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+#     Tests for the KASM benchmark's comparison with a baseline
+#     Run from this folder with: python -m unittest
+
+import unittest
+
+import kbench
+
+
+# A case's result, in the layout kbench saves
+def result(milliseconds, reference=1.0):
+    return {"seconds": milliseconds / 1000, "reference": reference}
+
+
+class CompareTests(unittest.TestCase):
+    def test_much_slower(self):
+        self.assertTrue(kbench.is_slower(result(20), result(10), 0.25, 0.0002))
+
+    # A sub-millisecond case used to count as slower from noise alone
+    def test_small_case_under_min_delta(self):
+        self.assertFalse(kbench.is_slower(result(0.45), result(0.33), 0.25, 0.0002))
+
+    def test_under_threshold(self):
+        self.assertFalse(kbench.is_slower(result(12), result(10), 0.25, 0.0002))
+
+    # The reference work got slower by as much as the case, so the machine is slower, not the assembler
+    def test_machine_slower(self):
+        self.assertFalse(kbench.is_slower(result(17, 1.7), result(10, 1.0), 0.25, 0.0002))
+
+    def test_baseline_without_reference(self):
+        self.assertTrue(kbench.is_slower(result(20), {"seconds": 0.01}, 0.25, 0.0002))
+
+
+if __name__ == "__main__":
+    unittest.main()
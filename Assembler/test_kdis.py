@@ -0,0 +1,61 @@
+#     Tests for the KASM disassembler
+#     Run from this folder with: python -m unittest
+
+import unittest
+
+import kasm
+import kdis
+
+
+# Disassembles the words and assembles them again
+def round_trip(words, data=()):
+    text = "\n".join(kdis.disassemble(words, data=list(data)))
+    assembler = kasm.Assembler(data_image=bool(data))
+    return list(assembler.assemble(text)), text
+
+
+class RoundTripTests(unittest.TestCase):
+    # -O leaves out the HALT when the program can't run off its end, and reassembling used to add one back
+    def test_optimized_image_without_halt(self):
+        words = list(kasm.Assembler(optimize=True).assemble(".code\nL:\nINPUT\nPRINT R0\nJMP L\n"))
+        self.assertEqual(words, [0xFFFC, 0xFFE0, 0x1000])
+        again, text = round_trip(words)
+        self.assertEqual(again, words)
+        self.assertIn(".nohalt", text.splitlines())
+
+    def test_image_with_halt(self):
+        words = list(kasm.Assembler().assemble(".code\nLOADI R1, 5\nPRINT R1\nHALT\n"))
+        again, text = round_trip(words)
+        self.assertEqual(again, words)
+        self.assertNotIn(".nohalt", text.splitlines())
+
+    def test_empty_image(self):
+        self.assertEqual(round_trip([])[0], [])
+
+    def test_illegal_words(self):
+        words = [0x0123, 0xC000, 0xFFD0, 0x1000]
+        self.assertEqual(round_trip(words)[0], words)
+
+    def test_data_image(self):
+        assembler = kasm.Assembler(data_image=True)
+        words = list(assembler.assemble(".data\nx 5\ntable[] 1 2 3\n.code\nLOADM R1, table+2\nPRINT R1\n"))
+        text = "\n".join(kdis.disassemble(words, data=list(assembler.data)))
+        again = kasm.Assembler(data_image=True)
+        self.assertEqual(list(again.assemble(text)), words)
+        self.assertEqual(list(again.data), list(assembler.data))
+
+
+class NoHaltTests(unittest.TestCase):
+    def test_no_halt_added(self):
+        self.assertEqual(list(kasm.Assembler().assemble(".code\n.nohalt\nNOP\n")), [kasm.opcodes["NOP"]])
+
+    def test_halt_added_without_it(self):
+        self.assertEqual(list(kasm.Assembler().assemble(".code\nNOP\n")), [kasm.opcodes["NOP"], kasm.HALT_WORD])
+
+    def test_no_operands(self):
+        with self.assertRaises(kasm.KasmError):
+            kasm.Assembler().assemble(".code\n.nohalt 1\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+#     Tests that run a short fuzzing batch, so the fuzzer's checks run with the rest of the tests
+#     Run from this folder with: python -m unittest
+
+import unittest
+
+import kfuzz
+
+
+class FuzzTests(unittest.TestCase):
+    def test_batch(self):
+        count, invalid, failures = kfuzz.run_batch(1, 0, 500, 0.3)
+        self.assertEqual(count, 500)
+        self.assertGreater(invalid, 0)
+        self.assertEqual([(index, failure) for index, failure, source, words in failures], [])
+
+    # Images without a HALT used to come back from kdis.py with one added
+    def test_case_without_halt(self):
+        items = kfuzz.make_case(1, 2, 0)
+        self.assertIn("nohalt", [entry[0] for entry in items])
+        self.assertIsNone(kfuzz.check(items))
+
+
+if __name__ == "__main__":
+    unittest.main()
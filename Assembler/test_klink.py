@@ -0,0 +1,73 @@
+#     Tests for the KASM linker
+#     Run from this folder with: python -m unittest
+
+import unittest
+
+import kasm
+import klink
+import ksim
+
+main_source = """.code
+.extern F
+LOADI R1, 3
+JMP F
+BACK:
+.global BACK
+PRINT R1
+"""
+
+library_source = """.code
+.global F
+.extern BACK
+F:
+ADDI R1, 1
+JMP BACK
+LOADI R2, 7
+PRINT R2
+"""
+
+
+# Links sources as if they were files given to klink.py, the first one is where the program starts
+def link(*sources, optimize=False):
+    modules = [kasm.Assembler(optimize=optimize).assemble_object(source) for source in sources]
+    return klink.link(modules, [f"module{index}" for index in range(len(sources))])
+
+
+# Runs words in the simulator, returns (halted, printed values)
+def run(words):
+    simulator = ksim.Simulator(words, inputs=[], output=lambda value: None)
+    halted = simulator.run(10000)
+    return halted, simulator.printed
+
+
+class LinkTests(unittest.TestCase):
+    # The HALT used to go after the last module, so the first one ran on into the next module's code
+    def test_halt_after_first_module(self):
+        words, data, layout = link(main_source, library_source)
+        self.assertEqual(run(words), (True, [4]))
+        self.assertEqual(words[layout[1][1] - 1], kasm.HALT_WORD)
+
+    def test_same_as_assembling_alone(self):
+        source = ".code\nLOADI R1, 5\nPRINT R1\n"
+        self.assertEqual(list(link(source)[0]), list(kasm.Assembler().assemble(source)))
+
+    def test_optimized_same_as_assembling_alone(self):
+        source = ".code\nL:\nJMP L\n"
+        self.assertEqual(list(link(source, optimize=True)[0]), list(kasm.Assembler(optimize=True).assemble(source)))
+
+    def test_no_halt(self):
+        words, data, layout = link(".code\n.nohalt\n.extern F\nJMP F\n", ".code\n.global F\nF:\nHALT\n")
+        self.assertEqual(list(words), [kasm.opcodes["JMP"] | 1, kasm.HALT_WORD])
+
+    # The address of a name plus its offset has to fit in the field
+    def test_address_out_of_range(self):
+        with self.assertRaises(klink.LinkError):
+            link(".code\n.extern F\nJMP F+4095\n", ".code\n.global F\nF:\nHALT\n")
+
+    def test_undefined_token(self):
+        with self.assertRaises(klink.LinkError):
+            link(".code\n.extern F\nJMP F\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+#     Tests for the KASM language server
+#     Run from this folder with: python -m unittest
+
+import unittest
+
+import kfuzz
+import klsp
+
+
+# Diagnostic messages for a document
+def messages(text):
+    return [diagnostic["message"] for diagnostic in klsp.Document("file:///test.k86", text, {}).diagnostics()]
+
+
+class DocumentTests(unittest.TestCase):
+    # An offset too big for the field used to leave a relocation for a word the line never made, so
+    # diagnostics() raised IndexError and the file got no diagnostics at all
+    def test_offset_out_of_range(self):
+        text = ".data\nv0 1\n.code\nJNZ v0+5000\n"
+        self.assertEqual(messages(text), ["5000 does not fit in a 12-bit field."])
+        document = klsp.Document("file:///test.k86", text, {})
+        self.assertEqual(list(document.line_words(3)), [])
+
+    def test_fuzz_case_with_offset_out_of_range(self):
+        text = kfuzz.source_text(kfuzz.make_case(7, 134, 0.3))
+        self.assertEqual(messages(text), ["5000 does not fit in a 12-bit field."])
+
+    # The address of a name plus its offset has to fit too, not only the offset
+    def test_address_out_of_range(self):
+        self.assertEqual(messages(".data\nv 1\n.code\nLOADM R1, v+2048\n"), ["4096 does not fit in a 12-bit field."])
+
+    def test_undefined_token(self):
+        self.assertEqual(messages(".code\nJMP NOPE\n"), ["Undefined token NOPE"])
+
+
+if __name__ == "__main__":
+    unittest.main()
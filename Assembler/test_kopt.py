@@ -0,0 +1,56 @@
+#     Tests the optimizer against the simulator: a program assembled with -O has to do the same as without it
+#     Run from this folder with: python -m unittest
+
+import random
+import unittest
+
+import kasm
+import kfuzz
+import ksim
+
+inputs = [5, -3, 7, 0, 2, 9, 1, 4]
+
+
+# Runs words in the simulator, returns (halted, printed values, data memory). halted is None for a fault
+def run(words):
+    simulator = ksim.Simulator(words, inputs=inputs, output=lambda value: None)
+    try:
+        halted = simulator.run(20000)
+    except ksim.SimulatorError:
+        halted = None
+    return halted, simulator.printed, simulator.memory[kasm.instruction_memory_size:]
+
+
+class DifferentialTests(unittest.TestCase):
+    # Registers aren't compared, since PUSHPC can leave a code address in one and -O moves the code
+    def test_fuzz_programs(self):
+        checked = 0
+        for index in range(1000):
+            source = kfuzz.source_text(kfuzz.make_case(1, index, 0))
+            plain = run(kasm.Assembler().assemble(source))
+            if plain[0] is not True:
+                continue
+            checked += 1
+            with self.subTest(source=source):
+                self.assertEqual(run(kasm.Assembler(optimize=True).assemble(source)), plain)
+        self.assertGreater(checked, 100)
+
+    # Small loops over memory, where -O has the most to change
+    def test_loops(self):
+        rng = random.Random(7)
+        for _ in range(300):
+            lines = [".data", "x 3", "y 0", ".code", "LOADI R1, 4", "TOP:"]
+            for index in range(rng.randint(2, 10)):
+                register = rng.choice(["R2", "R3"])
+                lines.append(rng.choice([f"ADDI {register}, {rng.randint(1, 3)}", f"STORE {register}, y",
+                                         f"LOADM {register}, x", f"PRINT {register}", "NOP", "SKIPZ",
+                                         f"LOADR {register}, R1", f"JMP NEXT{index}\nNEXT{index}:"]))
+            lines += ["SUBI R1, 1", "JNZ TOP", "PRINT R2"]
+            source = "\n".join(lines) + "\n"
+            with self.subTest(source=source):
+                self.assertEqual(run(kasm.Assembler(optimize=True).assemble(source)),
+                                 run(kasm.Assembler().assemble(source)))
+
+
+if __name__ == "__main__":
+    unittest.main()
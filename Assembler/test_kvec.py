@@ -0,0 +1,63 @@
+#     Tests the vector executor against the simulator: every machine has to do what ksim.py does with its inputs
+#     Run from this folder with: python -m unittest
+
+import os
+import random
+import unittest
+
+import kasm
+import kfuzz
+import ksim
+import kvec
+
+samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Sample Programs")
+
+
+# Runs words in the simulator, returns (halt cycle or -1, whether it faulted, printed values). Only the first
+# 64 printed values are kept, like the vector executor does
+def simulate(words, inputs, max_cycles):
+    simulator = ksim.Simulator(words, inputs=inputs, output=lambda value: None)
+    try:
+        halted = simulator.run(max_cycles)
+    except ksim.SimulatorError:
+        return -1, True, simulator.printed[:64]
+    return simulator.cycles if halted else -1, False, simulator.printed[:64]
+
+
+# Whether the machine in lane faulted on a STORE into instruction memory, where ksim.py changes the program
+def stores_into_code(words, machine, lane):
+    pc = int(machine.pc[lane])
+    if machine.faults[lane] != kvec.BAD_ADDRESS or pc < 2 or pc > len(words):
+        return False
+    return ksim.decode_table[words[pc - 2]][0] == ksim.STORE and words[pc - 1] & 0xFFF < kasm.instruction_memory_size
+
+
+class DifferentialTests(unittest.TestCase):
+    def test_factorial_sweep(self):
+        with open(os.path.join(samples, "factorial.k86"), "r") as file:
+            words = list(kasm.Assembler().assemble(file.read()))
+        outputs, counts, halt_cycles, faults = kvec.sweep(words, list(range(300)), max_cycles=5000, lanes=128)
+        for value in range(300):
+            expected = simulate(words, [value], 5000)
+            got = (halt_cycles[value], faults[value] != kvec.NO_FAULT, outputs[value, :counts[value]].tolist())
+            self.assertEqual(got, expected, f"input {value}")
+
+    def test_fuzz_programs(self):
+        rng = random.Random(1)
+        for index in range(150):
+            source = kfuzz.source_text(kfuzz.make_case(1, index, 0))
+            words = list(kasm.Assembler().assemble(source))
+            inputs = [[rng.randrange(-50, 50) for _ in range(8)] for _ in range(4)]
+            machine = kvec.VectorMachine(words, len(inputs), inputs)
+            machine.run(2000)
+            for lane, row in enumerate(inputs):
+                if stores_into_code(words, machine, lane):
+                    continue
+                got = (int(machine.cycles[lane]) if machine.halted[lane] else -1,
+                       machine.faults[lane] != kvec.NO_FAULT, machine.printed(lane))
+                with self.subTest(source=source, inputs=row):
+                    self.assertEqual(got, simulate(words, row, 2000))
+
+
+if __name__ == "__main__":
+    unittest.main()
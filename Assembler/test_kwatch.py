@@ -0,0 +1,58 @@
+#     Tests for kasm.py --watch
+#     Run from this folder with: python -m unittest
+
+import os
+import tempfile
+import unittest
+
+import kwatch
+
+
+# wanted() for a path, with the targets for the inputs
+def is_wanted(path, inputs):
+    directories, files, patterns = kwatch.watch_targets(inputs)
+    watched_dirs = {os.path.normpath(name) for name in inputs if os.path.isdir(name)}
+    return kwatch.wanted(path, files, patterns, watched_dirs)
+
+
+class WatchTargetTests(unittest.TestCase):
+    def test_file(self):
+        directories, files, patterns = kwatch.watch_targets(["src/a.k86"])
+        self.assertEqual((directories, files, patterns), (["src"], {os.path.normpath("src/a.k86")}, set()))
+        self.assertTrue(is_wanted("src/a.k86", ["src/a.k86"]))
+        self.assertFalse(is_wanted("src/b.k86", ["src/a.k86"]))
+
+    # A quoted glob used to be kept as a file name, so no changed file ever matched it
+    def test_pattern(self):
+        directories, files, patterns = kwatch.watch_targets(["*.k86"])
+        self.assertEqual((directories, files, patterns), (["."], set(), {"*.k86"}))
+        self.assertTrue(is_wanted("./new.k86", ["*.k86"]))
+        self.assertFalse(is_wanted("./notes.txt", ["*.k86"]))
+
+    def test_pattern_in_directory(self):
+        directories, files, patterns = kwatch.watch_targets([os.path.join("src", "*.k86")])
+        self.assertEqual(directories, ["src"])
+        self.assertTrue(is_wanted(os.path.join("src", "a.k86"), [os.path.join("src", "*.k86")]))
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "sub"))
+            directories, files, patterns = kwatch.watch_targets([directory])
+            self.assertEqual(directories, sorted([directory, os.path.join(directory, "sub")]))
+            self.assertTrue(is_wanted(os.path.join(directory, "sub", "a.k86"), [directory]))
+            self.assertFalse(is_wanted(os.path.join(directory, "a.txt"), [directory]))
+
+
+class WatcherTests(unittest.TestCase):
+    def test_polling_sees_a_new_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            watcher = kwatch.PollingWatcher([directory], interval=0.01)
+            path = os.path.join(directory, "a.k86")
+            with open(path, "w") as file:
+                file.write(".code\nNOP\n")
+            self.assertEqual(watcher.wait(1), {path})
+            watcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()